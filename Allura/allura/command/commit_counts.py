@@ -0,0 +1,52 @@
+from pylons import c
+from ming.orm import session
+
+from allura import model as M
+from allura.lib import helpers as h
+from allura.lib import utils
+
+from . import base
+
+
+class CheckCommitCountsCommand(base.Command):
+    min_args=1
+    max_args=3
+    usage = '<ini file> [-n nbhd] [<project_shortname> [<mount_point>]]'
+    summary = ('Recompute the commit counts stored on repositories and report '
+               'those that are out of date')
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('-n', '--nbhd', dest='nbhd', type='string', default='p',
+                      help='neighborhood prefix (default: p)')
+    parser.add_option('--fix', dest='fix', action='store_true', default=False,
+                      help='store the recomputed counts')
+
+    def command(self):
+        self.basic_setup()
+        nbhd = M.Neighborhood.query.get(url_prefix='/%s/' % self.options.nbhd)
+        assert nbhd, 'Neighborhood with prefix %s not found' % self.options.nbhd
+        q = dict(neighborhood_id=nbhd._id, deleted=False)
+        if len(self.args) > 1:
+            q['shortname'] = self.args[1]
+        checked = stale = 0
+        for projects in utils.chunked_find(M.Project, q):
+            for p in projects:
+                for ac in p.app_configs:
+                    if len(self.args) > 2 and ac.options.mount_point != self.args[2]:
+                        continue
+                    with h.push_config(c, project=p):
+                        app = p.app_instance(ac)
+                        repo = getattr(app, 'repo', None)
+                        if not isinstance(repo, M.Repository): continue
+                        if repo.status != 'ready': continue
+                        checked += 1
+                        before = repo.commit_count
+                        if not repo.refresh_counts(): continue
+                        stale += 1
+                        base.log.info('%s: %s commits stored, %s counted',
+                                      repo.full_fs_path, before, repo.commit_count)
+                        if self.options.fix:
+                            session(repo).flush(repo)
+                        else:
+                            session(repo).expunge(repo)
+        base.log.info('%d repositories checked, %d out of date%s', checked, stale,
+                      ' and fixed' if self.options.fix else '')
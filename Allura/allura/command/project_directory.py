@@ -0,0 +1,25 @@
+from allura import model as M
+
+from . import base
+
+
+class RebuildProjectDirectoryCommand(base.Command):
+    min_args=1
+    max_args=1
+    usage = '<ini file>'
+    summary = 'Rebuild the project directory index used by the projects macro'
+    parser = base.Command.standard_parser(verbose=True)
+    parser.add_option('-n', '--neighborhood', dest='neighborhood', default=None,
+                      help='neighborhood to rebuild (e.g. p, default all)')
+
+    def command(self):
+        self.basic_setup()
+        neighborhood_id = None
+        if self.options.neighborhood:
+            nbhd = M.Neighborhood.query.get(
+                url_prefix='/%s/' % self.options.neighborhood)
+            assert nbhd, 'Neighborhood with prefix %s not found' % self.options.neighborhood
+            neighborhood_id = nbhd._id
+        base.log.info('Rebuilding project directory...')
+        count = M.ProjectDirectory.rebuild(neighborhood_id)
+        base.log.info('... %d projects listed', count)
@@ -1,6 +1,10 @@
 import sys
+import time
+import traceback
 from collections import defaultdict
+from contextlib import contextmanager
 from itertools import groupby
+from multiprocessing import Pool
 
 from pylons import c, g
 from pymongo.errors import DuplicateKeyError
@@ -8,8 +12,8 @@
 from ming.orm import mapper, session, Mapper
 from ming.orm.declarative import MappedClass
 
-import allura.tasks.index_tasks
-from allura.lib.exceptions import CompoundError
+from allura.tasks.index_tasks import solarize_artifacts
+from allura.lib import helpers as h
 from allura.lib import utils
 from . import base
 
@@ -42,6 +46,17 @@ class ReindexCommand(base.Command):
                       help='Solr needs artifact references to already exist.')
     parser.add_option('--refs', action='store_true', dest='refs',
                       help='Update artifact references and shortlinks')
+    parser.add_option('--chunk-size', dest='chunk_size', type='int', default=1000,
+                      help='number of artifacts to load and solarize at a time (default 1000)')
+    parser.add_option('--processes', dest='processes', type='int', default=1,
+                      help='number of processes to solarize artifacts with (default 1, in-process)')
+    parser.add_option('--solr-batch', dest='solr_batch', type='int', default=200,
+                      help='maximum number of documents per Solr add (default 200)')
+    parser.add_option('--solr-batch-bytes', dest='solr_batch_bytes', type='int',
+                      default=4*1024*1024,
+                      help='maximum size of the text of a Solr add (default 4MB)')
+    parser.add_option('--resume', action='store_true', dest='resume',
+                      help='continue an interrupted reindex with the same options')
 
     def command(self):
         from allura import model as M
@@ -60,46 +75,259 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
-        for projects in utils.chunked_find(M.Project, q_project):
-            for p in projects:
-                c.project = p
-                base.log.info('Reindex project %s', p.shortname)
-                # Clear index for this project
-                if self.options.solr:
-                    g.solr.delete(q='project_id_s:%s' % p._id)
-                if self.options.refs:
-                    M.ArtifactReference.query.remove({'artifact_reference.project_id':p._id})
-                    M.Shortlink.query.remove({'project_id':p._id})
-                app_config_ids = [ ac._id for ac in p.app_configs ]
-                # Traverse the inheritance graph, finding all artifacts that
-                # belong to this project
-                for _, a_cls in dfs(M.Artifact, graph):
-                    base.log.info('  %s', a_cls)
-                    ref_ids = []
-                    # Create artifact references and shortlinks
-                    for a in a_cls.query.find(dict(app_config_id={'$in': app_config_ids})):
-                        if self.options.verbose:
-                            base.log.info('      %s', a.shorthand_id())
-                        if self.options.refs:
-                            try:
-                                M.ArtifactReference.from_artifact(a)
-                                M.Shortlink.from_artifact(a)
-                            except:
-                                base.log.exception('Making ArtifactReference/Shortlink from %s', a)
-                                continue
-                        ref_ids.append(a.index_id())
-                    M.main_orm_session.flush()
-                    M.artifact_orm_session.clear()
-                    try:
-                        allura.tasks.index_tasks.add_artifacts(ref_ids,
-                                                               update_solr=self.options.solr,
-                                                               update_refs=self.options.refs)
-                    except CompoundError, err:
-                        base.log.exception('Error indexing artifacts:\n%r', err)
-                        base.log.error('%s', err.format_error())
-                    M.main_orm_session.flush()
-                    M.main_orm_session.clear()
+        checkpoint = ReindexCheckpoint.start(
+            self.checkpoint_id(), self.options.resume)
+        if checkpoint.project_id is not None:
+            q_project['_id'] = {'$gte': checkpoint.project_id}
+        self.num_docs = 0
+        self.start_time = time.time()
+        with _reindex_pool(self.options.processes) as pool:
+            for projects in utils.chunked_find(M.Project, q_project, sort_key='_id'):
+                for p in projects:
+                    self.reindex_project(p, graph, checkpoint, pool)
+        checkpoint.finish()
         base.log.info('Reindex done')
+        self.log_rate()
+
+    def checkpoint_id(self):
+        '''Reindexes with different options have separate checkpoints'''
+        parts = [ 'reindex',
+                  self.options.project or '*',
+                  self.options.neighborhood or '*' ]
+        if self.options.solr: parts.append('solr')
+        if self.options.refs: parts.append('refs')
+        return ':'.join(parts)
+
+    def reindex_project(self, p, graph, checkpoint, pool):
+        from allura import model as M
+        c.project = p
+        if checkpoint.project_id == p._id:
+            base.log.info('Resume reindex of project %s', p.shortname)
+        else:
+            base.log.info('Reindex project %s', p.shortname)
+            checkpoint.start_project(p._id)
+            # Clear index for this project
+            if self.options.solr:
+                g.solr.delete(q='project_id_s:%s' % p._id)
+            if self.options.refs:
+                M.ArtifactReference.query.remove({'artifact_reference.project_id':p._id})
+                M.Shortlink.query.remove({'project_id':p._id})
+                M.MarkdownCache.invalidate_links(p._id)
+        app_config_ids = [ ac._id for ac in p.app_configs ]
+        # Traverse the inheritance graph, finding all artifacts that
+        # belong to this project
+        classes = [ a_cls for _, a_cls in dfs(M.Artifact, graph) ]
+        # Create all artifact references and shortlinks first, so that
+        # find_shortlinks can resolve links between any of the artifacts
+        if self.options.refs and not checkpoint.refs_done:
+            for a_cls in classes:
+                base.log.info('  %s references', a_cls)
+                for ids in _artifact_id_chunks(
+                        a_cls, app_config_ids, self.options.chunk_size):
+                    self.make_refs(a_cls, ids)
+            checkpoint.finish_refs()
+        max_pending = 2 * max(self.options.processes, 1)
+        for a_cls in classes:
+            name = _class_name(a_cls)
+            if name in checkpoint.done_classes: continue
+            base.log.info('  %s', a_cls)
+            if checkpoint.cls == name:
+                last_id = checkpoint.last_id
+            else:
+                last_id = None
+            # Chunks are indexed in _id order, and at most max_pending chunks
+            # are in flight while we wait for Solr
+            pending = []
+            for ids in _artifact_id_chunks(
+                    a_cls, app_config_ids, self.options.chunk_size, last_id):
+                args = (a_cls, p._id, ids, self.options.refs)
+                if pool is None:
+                    result = _DoneResult(_solarize_chunk(*args))
+                else:
+                    result = pool.apply_async(_solarize_chunk, args)
+                pending.append((ids[-1], result))
+                while pending and (pending[0][1].ready() or len(pending) > max_pending):
+                    self.add_chunk(name, checkpoint, *pending.pop(0))
+            while pending:
+                self.add_chunk(name, checkpoint, *pending.pop(0))
+            checkpoint.finish_class(name)
+
+    def make_refs(self, a_cls, ids):
+        from allura import model as M
+        for a in a_cls.query.find(dict(_id={'$in': ids})):
+            if self.options.verbose:
+                base.log.info('      %s', a.shorthand_id())
+            try:
+                M.ArtifactReference.from_artifact(a)
+                M.Shortlink.from_artifact(a)
+            except:
+                base.log.exception('Making ArtifactReference/Shortlink from %s', a)
+        M.main_orm_session.flush()
+        M.artifact_orm_session.clear()
+        M.main_orm_session.clear()
+
+    def add_chunk(self, name, checkpoint, last_id, result):
+        '''Send the Solr documents of a solarized chunk, then checkpoint it'''
+        docs, errors = result.get()
+        for index_id, tb in errors:
+            base.log.error('Error indexing artifact %s:\n%s', index_id, tb)
+        if self.options.solr and docs:
+            for batch in _solr_batches(
+                    docs, self.options.solr_batch, self.options.solr_batch_bytes):
+                g.solr.add(batch, commit=False)
+            g.solr.commit()
+        self.num_docs += len(docs)
+        checkpoint.save(name, last_id)
+        self.log_rate()
+
+    def log_rate(self):
+        elapsed = time.time() - self.start_time
+        base.log.info('    %d documents, %.1f docs/s',
+                      self.num_docs, self.num_docs / max(elapsed, 1e-6))
+
+class ReindexCheckpoint(object):
+    '''Records how far ReindexCommand got: the project being reindexed,
+    whether its references are done, the artifact classes that are fully
+    indexed and the last _id indexed of the current class.'''
+
+    def __init__(self, doc):
+        self.doc = doc
+
+    @classmethod
+    def start(cls, checkpoint_id, resume):
+        from allura.model.index import ReindexCheckpointDoc
+        doc = None
+        if resume:
+            doc = ReindexCheckpointDoc.m.get(_id=checkpoint_id)
+        if doc is None:
+            doc = ReindexCheckpointDoc(dict(_id=checkpoint_id, done_classes=[]))
+        doc.m.save()
+        return cls(doc)
+
+    @property
+    def project_id(self):
+        return self.doc.project_id
+
+    @property
+    def refs_done(self):
+        return self.doc.refs_done
+
+    @property
+    def done_classes(self):
+        return self.doc.done_classes
+
+    @property
+    def cls(self):
+        return self.doc.cls
+
+    @property
+    def last_id(self):
+        return self.doc.last_id
+
+    def start_project(self, project_id):
+        self._set(project_id=project_id, refs_done=False, done_classes=[],
+                  cls=None, last_id=None)
+
+    def finish_refs(self):
+        self._set(refs_done=True)
+
+    def save(self, cls, last_id):
+        self._set(cls=cls, last_id=last_id)
+
+    def finish_class(self, cls):
+        self._set(done_classes=self.doc.done_classes + [cls],
+                  cls=None, last_id=None)
+
+    def finish(self):
+        self.doc.m.remove(dict(_id=self.doc._id))
+
+    def _set(self, **kwargs):
+        for k, v in kwargs.iteritems():
+            setattr(self.doc, k, v)
+        self.doc.m.update_partial(dict(_id=self.doc._id), {'$set': kwargs})
+
+class _DoneResult(object):
+    '''Stand-in for an AsyncResult of work that was done in-process'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+@contextmanager
+def _reindex_pool(processes):
+    '''Pool of worker processes for solarizing artifacts, or None if
+    it should happen in-process.'''
+    if processes <= 1:
+        yield None
+        return
+    pool = Pool(processes, initializer=_init_reindex_worker)
+    try:
+        yield pool
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _init_reindex_worker():
+    from allura import model as M
+    # Don't share the parent's sockets; pymongo reconnects on demand
+    M.main_doc_session.db.connection.disconnect()
+    M.project_doc_session.db.connection.disconnect()
+
+def _class_name(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+def _artifact_id_chunks(a_cls, app_config_ids, chunk_size, last_id=None):
+    '''Yield the _ids of the artifacts of a_cls in the given tools, in sorted
+    chunks, starting after last_id'''
+    query = dict(app_config_id={'$in': app_config_ids})
+    while True:
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        q = mapper(a_cls).collection.m.find(query, {'_id': 1}, validate=False)
+        ids = [ doc['_id'] for doc in q.sort('_id').limit(chunk_size) ]
+        if not ids: break
+        yield ids
+        last_id = ids[-1]
+
+def _solarize_chunk(a_cls, project_id, ids, update_refs):
+    '''Load a chunk of artifacts of one class and build their Solr documents,
+    also updating their references if update_refs.  Returns the documents and
+    a list of (index_id, traceback) for artifacts that could not be indexed.'''
+    from allura import model as M
+    with h.push_context(project_id):
+        docs, errors = solarize_artifacts(
+            a_cls.query.find(dict(_id={'$in': ids})), update_refs=update_refs)
+    M.artifact_orm_session.clear()
+    M.main_orm_session.clear()
+    return docs, [ (index_id, ''.join(traceback.format_exception(*exc_info)))
+                   for index_id, exc_info in errors ]
+
+def _solr_batches(docs, max_docs, max_bytes):
+    '''Split docs into batches of at most max_docs documents whose text
+    adds up to at most max_bytes (a bigger document gets a batch of its own)'''
+    batch = []
+    size = 0
+    for doc in docs:
+        text = doc.get('text') or ''
+        if isinstance(text, (list, tuple)):
+            text = ' '.join(text)
+        doc_size = len(text)
+        if batch and (len(batch) >= max_docs or size + doc_size > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(doc)
+        size += doc_size
+    if batch:
+        yield batch
 
 class EnsureIndexCommand(base.Command):
     min_args=1
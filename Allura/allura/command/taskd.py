@@ -4,6 +4,7 @@
 from datetime import datetime, timedelta
 import signal
 import sys
+import threading
 
 import faulthandler
 import pylons
@@ -23,6 +24,12 @@ class TaskdCommand(base.Command):
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--exclude', dest='exclude', type='string', default=None,
                       help='never handle tasks of the given name(s) (can be comma-separated list)')
+    parser.add_option('--batch-size', dest='batch_size', type='int', default=1,
+                      help='number of ready tasks to claim per query (default 1)')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='number of worker threads executing tasks (default 1)')
+    parser.add_option('--stats-interval', dest='stats_interval', type='int', default=60,
+                      help='seconds between task throughput log messages (default 60, 0 to disable)')
 
     def command(self):
         self.basic_setup()
@@ -50,11 +57,34 @@ def graceful_stop(self, signum, frame):
         self.keep_running = False
 
     def log_current_task(self, signum, frame):
-        base.log.info('taskd pid %s is currently handling task %s' % (os.getpid(), getattr(self, 'task', None)))
+        # no tasks_lock here: the signal may arrive while this (main)
+        # thread holds it, and copying the dict is atomic anyway
+        tasks = dict(getattr(self, 'tasks', {})).values() or [None]
+        for task in tasks:
+            base.log.info('taskd pid %s is currently handling task %s' % (os.getpid(), task))
+
+    def log_throughput(self, force=False):
+        interval = self.options.stats_interval
+        now = time.time()
+        elapsed = now - self.stats_start
+        if not force and (not interval or elapsed < interval):
+            return
+        with self.stats_lock:
+            count, self.stats_count = self.stats_count, 0
+            self.stats_start = now
+        base.log.info('taskd pid %s throughput: %d tasks in %.1fs (%.2f tasks/s)' % (
+            os.getpid(), count, elapsed, count / elapsed if elapsed else 0.0))
 
     def worker(self):
         from allura import model as M
         name = '%s pid %s' % (os.uname()[1], os.getpid())
+        batch_size = max(1, self.options.batch_size)
+        num_workers = max(1, self.options.workers)
+        self.tasks = {} # task running in each worker thread
+        self.tasks_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.stats_count = 0
+        self.stats_start = time.time()
         wsgi_app = loadapp('config:%s#task' % self.args[0],relative_to=os.getcwd())
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
         only = self.options.only
@@ -76,38 +106,100 @@ def waitfunc_amqp():
         def waitfunc_noq():
             time.sleep(poll_interval)
 
-        def check_running(func):
-            if self.keep_running:
-                return func()
-            else:
-                return None
+        wakeup = threading.local()
+        def waitfunc_tail():
+            if not hasattr(wakeup, 'monitor'):
+                wakeup.monitor = M.MonQWakeup()
+            wakeup.monitor.wait(poll_interval)
 
         if pylons.g.amq_conn:
             waitfunc = waitfunc_amqp
+        elif M.MonQWakeup.enabled():
+            waitfunc = waitfunc_tail
         else:
             waitfunc = waitfunc_noq
-        waitfunc = check_running(waitfunc)
-        while self.keep_running:
-            if pylons.g.amq_conn:
-                pylons.g.amq_conn.reset()
-            try:
-                while self.keep_running:
-                    self.task = M.MonQTask.get(
-                            process=name,
-                            waitfunc=waitfunc,
-                            only=only,
-                            exclude=exclude)
-                    if self.task:
-                        # Build the (fake) request
-                        r = Request.blank('/--%s--/' % self.task.task_name, dict(task=self.task))
-                        list(wsgi_app(r.environ, start_response))
-                        self.task = None
-            except Exception as e:
-                if self.keep_running:
-                    base.log.exception('taskd error %s; pausing for 10s before taking more tasks' % e)
-                    time.sleep(10)
+
+        def set_current_task(worker_name, task):
+            with self.tasks_lock:
+                if task is None:
+                    self.tasks.pop(worker_name, None)
                 else:
-                    base.log.exception('taskd error %s' % e)
+                    self.tasks[worker_name] = task
+
+        def release_tasks(tasks):
+            '''Hand claimed but unstarted tasks back to the queue'''
+            if not tasks: return
+            M.MonQTask.query.update(
+                {'_id': {'$in': [t._id for t in tasks]}, 'state': 'busy'},
+                {'$set': dict(state='ready', process=None)},
+                multi=True)
+
+        def run_task(task):
+            # Build the (fake) request; each request gets its own registry
+            # context, so c.project/app/user are isolated per worker thread
+            r = Request.blank('/--%s--/' % task.task_name, dict(task=task))
+            list(wsgi_app(r.environ, start_response))
+            with self.stats_lock:
+                self.stats_count += 1
+
+        def work(worker_name):
+            while self.keep_running:
+                if pylons.g.amq_conn:
+                    pylons.g.amq_conn.reset()
+                try:
+                    while self.keep_running:
+                        if batch_size == 1:
+                            task = M.MonQTask.get(
+                                    process=worker_name,
+                                    only=only,
+                                    exclude=exclude)
+                            tasks = [task] if task else []
+                        else:
+                            tasks = M.MonQTask.get_many(
+                                    batch_size,
+                                    process=worker_name,
+                                    only=only,
+                                    exclude=exclude)
+                        started = 0
+                        try:
+                            for task in tasks:
+                                if not self.keep_running: break
+                                started += 1
+                                set_current_task(worker_name, task)
+                                run_task(task)
+                                set_current_task(worker_name, None)
+                        finally:
+                            # on a graceful stop or a task error, the rest
+                            # of the batch goes back to the queue
+                            release_tasks(tasks[started:])
+                        self.log_throughput()
+                        if not tasks and self.keep_running:
+                            # wait here rather than passing waitfunc to
+                            # get(), so that a graceful stop is noticed
+                            waitfunc()
+                except Exception as e:
+                    set_current_task(worker_name, None)
+                    if self.keep_running:
+                        base.log.exception('taskd error %s; pausing for 10s before taking more tasks' % e)
+                        time.sleep(10)
+                    else:
+                        base.log.exception('taskd error %s' % e)
+
+        if num_workers == 1:
+            work(name)
+        else:
+            threads = []
+            for i in range(num_workers):
+                t = threading.Thread(target=work, args=('%s thread %d' % (name, i),))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            # signals are only delivered to the main thread, so wait here
+            # in short intervals instead of blocking on join()
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(1)
+        self.log_throughput(force=True)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
         if self.restart_when_done:
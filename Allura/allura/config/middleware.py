@@ -25,6 +25,7 @@
 from allura.config.environment import load_environment
 from allura.config.app_cfg import ForgeConfig
 from allura.lib.custom_middleware import AlluraTimerMiddleware
+from allura.lib.custom_middleware import QueryProfilerMiddleware
 from allura.lib.custom_middleware import SSLMiddleware
 from allura.lib.custom_middleware import StaticFilesMiddleware
 from allura.lib.custom_middleware import CSRFMiddleware
@@ -142,6 +143,10 @@ def _make_core_app(root, global_conf, full_stack=True, **app_conf):
     app = StaticFilesMiddleware(app, app_conf.get('static.script_name'))
     # Handle setup and flushing of Ming ORM sessions
     app = MingMiddleware(app)
+    # Profile the queries of each request, if enabled, including the flush
+    # of the Ming ORM sessions at its end
+    if asbool(app_conf.get('query_profiler.enabled', False)):
+        app = QueryProfilerMiddleware(app, app_conf)
     # Set up the registry for stacked object proxies (SOPs).
     #    streaming=true ensures they won't be cleaned up till
     #    the WSGI application's iterator is exhausted
@@ -332,7 +332,7 @@ def moderate(self, **kw):
             self.post.delete()
             self.thread.update_stats()
         elif kw.pop('spam', None):
-            self.post.status = 'spam'
+            self.post.spam()
             self.thread.update_stats()
         redirect(request.referer)
 
@@ -447,6 +447,7 @@ def save_moderation(self, post=[], delete=None, spam=None, approve=None, **kw):
                         posted.spam()
                     elif approve and posted.status != 'ok':
                         posted.status = 'ok'
+                        posted.thread.count_post(posted, 1)
                         posted.thread.num_replies += 1
         redirect(request.referer)
 
@@ -470,8 +471,20 @@ def reply(self, **kw):
 class ThreadRestController(ThreadController):
 
     @expose('json:')
-    def index(self, **kw):
-        return dict(thread=self.thread)
+    def index(self, limit=None, after=None, style='threaded', **kw):
+        if limit is None:
+            return dict(thread=self.thread)
+        try:
+            posts = self.thread.find_posts(
+                limit=int(limit), after=after, style=style)
+        except ValueError, e:
+            raise exc.HTTPBadRequest(str(e))
+        thread = self.thread.__json__()
+        thread['posts'] = [ dict(slug=p.slug, subject=p.subject) for p in posts ]
+        next_page = None
+        if len(posts) == int(limit):
+            next_page = self.thread.posts_token(posts[-1], style)
+        return dict(thread=thread, next_page=next_page)
 
     @h.vardec
     @expose()
@@ -186,7 +186,48 @@ def commit_browser(self):
 
     @without_trailing_slash
     @expose('json:')
-    def commit_browser_data(self):
+    @validate(dict(start=validators.Int(if_empty=0),
+                   limit=validators.Int(if_empty=500)))
+    def commit_browser_data(self, start=0, limit=500, **kw):
+        '''Rows start to start + limit of the commit browser, newest first,
+        from the layout that refresh_repo stores (see M.repo.CommitLayout).
+        Each commit has its row, its column and its edges, as [parent_row,
+        parent_column, edge_column] where edge_column is the column of the
+        vertical part of the edge.  max_row is the last row of the whole
+        graph.'''
+        start = max(start or 0, 0)
+        limit = max(min(limit or 500, 5000), 1)
+        graph = M.repo.CommitGraph.get(c.app.repo._id)
+        window = M.repo.CommitLayout.window(graph, start, limit)
+        if window is None:
+            return self._commit_browser_data_all()
+        size, width, rows = window
+        messages = dict(
+            (ci['_id'], ci.get('message', ''))
+            for ci in M.repo.CommitDoc.m.find(
+                dict(_id={'$in': [ row[0] for row in rows ]}),
+                {'message': 1}, validate=False))
+        built_tree = {}
+        for oid, row, column, edges in rows:
+            msg_split = messages.get(oid, '').splitlines()
+            built_tree[oid] = dict(
+                oid=oid,
+                row=row,
+                column=column,
+                parents=[ graph.commit_ids[size - 1 - e[0]] for e in edges ],
+                edges=edges,
+                message=msg_split[0] if msg_split else "No commit message.",
+                url=c.app.repo.url_for_commit(Object(_id=oid)))
+        return dict(
+            commits=[ row[0] for row in rows ],
+            built_tree=built_tree,
+            start=start,
+            next_column=width,
+            max_row=size - 1)
+
+    def _commit_browser_data_all(self):
+        '''Lay out the whole graph, for repos that refresh_repo has not laid
+        out yet'''
         head_ids = [ head.object_id for head in c.app.repo.heads ]
         commit_ids = list(M.repo.commitlog(head_ids))
         log.info('Grab %d commit objects by ID', len(commit_ids))
@@ -241,11 +282,17 @@ def find_column(columns):
                 columns[p_col] = p
         built_tree = dict(
                 (ci_json['oid'], ci_json) for ci_json in result)
+        for ci_json in result:
+            # parents keep their column from their first child down
+            ci_json['edges'] = [
+                (built_tree[p]['row'], built_tree[p]['column'], built_tree[p]['column'])
+                for p in ci_json['parents'] if p in built_tree ]
         return dict(
             commits=[ ci_json['oid'] for ci_json in result ],
             built_tree=built_tree,
+            start=0,
             next_column=len(columns),
-            max_row=row)
+            max_row=len(result) - 1)
 
     @expose('json:')
     def status(self, **kw):
@@ -254,8 +301,11 @@ def status(self, **kw):
 class RepoRestController(RepoRootController):
     @expose('json:')
     def index(self, **kw):
-        all_commits = c.app.repo._impl.new_commits(all_commits=True)
-        return dict(commit_count=len(all_commits))
+        commit_count = c.app.repo.commit_count
+        if commit_count is None:
+            # not refreshed since commit counts were stored
+            commit_count = len(c.app.repo._impl.new_commits(all_commits=True))
+        return dict(commit_count=commit_count)
 
     @expose('json:')
     def commits(self, **kw):
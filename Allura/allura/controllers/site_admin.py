@@ -8,6 +8,7 @@
 import pymongo
 from pylons import c, g
 from formencode import validators
+from webob import exc
 
 from allura.lib import helpers as h
 from allura.lib.security import require_access
@@ -64,7 +65,26 @@ def stats(self, limit=25):
         stats = sorted(stats.iteritems(), key=lambda x:-x[1]['total'])
         return dict(
             agg_timings=agg_timings,
-            stats=stats[:int(limit)])
+            stats=stats[:int(limit)],
+            markdown_cache=M.MarkdownCache.stats,
+            markdown_cache_hit_rate=M.MarkdownCache.hit_rate(),
+            nav_cache=M.NavCache.stats,
+            nav_cache_rebuild_rate=M.NavCache.rebuild_rate())
+
+    @expose('json:')
+    def queries(self, id=None):
+        '''The query profile of a recent request (see X-Allura-Queries), or
+        without an id, the totals per endpoint'''
+        from allura.lib.query_profiler import QueryProfiler
+        if id is not None:
+            report = QueryProfiler.get(int(id))
+            if report is None:
+                raise exc.HTTPNotFound()
+            return report
+        return dict(
+            endpoints=QueryProfiler.endpoints,
+            recent=[ dict((k, r[k]) for k in ('id', 'url', 'endpoint', 'ops', 'time'))
+                     for r in QueryProfiler.recent ])
 
     @expose('jinja:allura:templates/site_admin_api_tickets.html')
     def api_tickets(self, **data):
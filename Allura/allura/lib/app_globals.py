@@ -7,7 +7,10 @@
 import cgi
 import json
 import shlex
+import hashlib
 import datetime
+import threading
+from collections import defaultdict
 from urllib import urlencode
 from subprocess import Popen, PIPE
 
@@ -42,16 +45,76 @@
 
 log = logging.getLogger(__name__)
 
+# Per-thread cache of ForgeMarkdown engines, see Globals.forge_markdown
+_markdown_engines = threading.local()
+
 class ForgeMarkdown(markdown.Markdown):
-    def convert(self, source):
+    in_use = False
+    # ForgeExtension arguments, set by Globals.forge_markdown
+    cache_context = ()
+    # Change to invalidate all of M.MarkdownCache after changing extensions
+    cache_version = 1
+
+    def convert(self, source, use_cache=True):
+        key = None
+        if use_cache and M.MarkdownCache.enabled():
+            key = self.cache_key(source)
+            html = M.MarkdownCache.get(key)
+            if html is M.MarkdownCache.UNCACHEABLE:
+                key = None
+            elif html is not None:
+                return h.html.literal(html)
+        # Engines are reused, so start from a clean state, and mark the engine
+        # busy in case a macro converts more markdown while we are converting
+        self.reset()
+        self.in_use = True
         try:
-            return markdown.Markdown.convert(self, source)
+            html = markdown.Markdown.convert(self, source)
         except Exception as e:
             log.info('Invalid markdown: %s %s', e, source)
             escaped = h.really_unicode(source)
             escaped = cgi.escape(escaped)
             return h.html.literal(u"""<p><strong>ERROR!</strong> The markdown supplied could not be parsed correctly.
             Did you forget to surround a code snippet with "~~~~"?</p><pre>%s</pre>""" % escaped)
+        finally:
+            self.in_use = False
+        if key is not None:
+            self.cache(key, html)
+        return html
+
+    def cache_key(self, source):
+        '''Hash of the source and everything else the output depends on,
+        except for shortlinks and macros (see cache())'''
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        try:
+            trailing_slash = request.path_info.endswith('/')
+        except TypeError: # outside of a request
+            trailing_slash = None
+        key = hashlib.sha1(repr((
+            self.cache_version,
+            markdown.version,
+            self.cache_context,
+            project and project._id,
+            app and app.config._id,
+            trailing_slash)))
+        key.update(h.really_unicode(source).encode('utf-8'))
+        return key.hexdigest()
+
+    def cache(self, key, html):
+        '''Store a fresh conversion in M.MarkdownCache: macros may depend on
+        anything, so their output is not cached; links depend on which
+        artifacts exist, so their output is kept until the shortlinks of the
+        projects they point into change.'''
+        forge = self.postprocessors['forge'].parent
+        M.MarkdownCache.count('misses')
+        if not forge.cacheable:
+            M.MarkdownCache.put(key, None)
+        elif forge.uses_links:
+            if forge.link_versions:
+                M.MarkdownCache.put(key, html, link_versions=forge.link_versions)
+        else:
+            M.MarkdownCache.put(key, html)
 
 class Globals(object):
     """Container for objects available throughout the life of the application.
@@ -286,10 +349,26 @@ def highlight(self, text, lexer=None, filename=None):
         return h.html.literal(pygments.highlight(text, lexer, formatter))
 
     def forge_markdown(self, **kwargs):
-        '''return a markdown.Markdown object on which you can call convert'''
-        return ForgeMarkdown(
+        '''return a markdown.Markdown object on which you can call convert
+
+        Setting up the extensions costs more than converting a small document,
+        so engines are cached per thread and per ForgeExtension arguments.
+        A new engine is only built if the cached ones are all busy (i.e. a
+        macro is rendering markdown from within a conversion).'''
+        try:
+            engines = _markdown_engines.engines
+        except AttributeError:
+            engines = _markdown_engines.engines = defaultdict(list)
+        key = tuple(sorted(kwargs.iteritems()))
+        for md in engines[key]:
+            if not md.in_use:
+                return md
+        md = ForgeMarkdown(
                 extensions=['codehilite', ForgeExtension(**kwargs), 'tables', 'toc'],
                 output_format='html4')
+        md.cache_context = key
+        engines[key].append(md)
+        return md
 
     @property
     def markdown(self):
@@ -415,7 +494,7 @@ def docs(self):
     def __init__(self):
         self.db = {}
 
-    def add(self, objects):
+    def add(self, objects, commit=True):
         for o in objects:
             o['text'] = ''.join(o['text'])
             self.db[o['id']] = o
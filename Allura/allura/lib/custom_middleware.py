@@ -1,17 +1,20 @@
 import os
 import re
 import logging
+from collections import deque
 
 import tg
 import pkg_resources
 from paste import fileapp
 from pylons import c
 from pylons.util import call_wsgi_application
+from paste.deploy.converters import asint
 from timermiddleware import Timer, TimerMiddleware
 from webob import exc, Request
 import pysolr
 
 from allura.lib import helpers as h
+from allura.lib import query_profiler
 
 log = logging.getLogger(__name__)
 
@@ -188,3 +191,67 @@ def before_logging(self, stat_record):
         if c.app and c.app.config:
             stat_record.add('request_category', c.app.config.tool_name.lower())
         return stat_record
+
+class QueryProfilerMiddleware(object):
+    '''Profile the Mongo and Solr operations of each request (see
+    allura.lib.query_profiler).
+
+    The X-Allura-Queries response header sums up the profile of a request,
+    whose full report is at /nf/admin/queries?id=<id> until it is among the
+    query_profiler.keep oldest.  Operations of the same shape repeated
+    query_profiler.threshold times or more are N+1 suspects.  Totals per
+    endpoint (tool and first path component in it) are logged every
+    query_profiler.log_every requests to it.'''
+
+    def __init__(self, app, app_conf):
+        import pymongo
+        self.app = app
+        self.threshold = asint(app_conf.get('query_profiler.threshold', 5))
+        self.log_every = asint(app_conf.get('query_profiler.log_every', 100))
+        query_profiler.QueryProfiler.recent = deque(
+            maxlen=asint(app_conf.get('query_profiler.keep', 100)))
+        query_profiler.instrument(
+            pymongo.collection.Collection, 'mongo', 'find', 'find_one',
+            'count', 'distinct', 'insert', 'save', 'update', 'remove',
+            'find_and_modify')
+        query_profiler.instrument_cursor(
+            pymongo.cursor.Cursor, '_refresh', 'count', 'distinct')
+        query_profiler.instrument(
+            pysolr.Solr, 'solr', 'search', 'add', 'delete', 'commit')
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'].startswith('/nf/admin/queries'):
+            return self.app(environ, start_response)
+        with query_profiler.profiling(self.threshold) as profile:
+            status, headers, app_iter, exc_info = call_wsgi_application(
+                self.app, environ, catch_exc_info=True)
+            body = list(app_iter)
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            endpoint = self.endpoint(environ)
+        report = profile.report()
+        report_id = query_profiler.QueryProfiler.add(
+            endpoint, environ['PATH_INFO'], report, self.log_every)
+        headers.append(('X-Allura-Queries', '%d ops, %.1fms, %d N+1 suspects, id %d' % (
+                    report['ops'], report['time'] * 1000,
+                    len(report['suspects']), report_id)))
+        start_response(status, headers, exc_info)
+        return body
+
+    def endpoint(self, environ):
+        path = environ['PATH_INFO']
+        tool = 'site'
+        try:
+            app = c.app
+        except TypeError: # no request context
+            app = None
+        if app and app.config:
+            tool = app.config.tool_name.lower()
+            path = path.split('/%s/' % app.config.options.mount_point, 1)[-1]
+        segments = [ s for s in path.split('/') if s ]
+        if not segments:
+            return tool + ' /'
+        segment = segments[0]
+        if segment.isdigit():
+            segment = '<n>'
+        return '%s /%s' % (tool, segment)
@@ -15,7 +15,14 @@ def task(func):
     def post(*args, **kwargs):
         from allura import model as M
         return M.MonQTask.post(func, args, kwargs)
+    def post_coalesced(coalesce_key, items, *args, **kwargs):
+        '''Post the task, merging items into a pending task with the same
+        coalesce_key if there is one.  items is passed as the first argument.'''
+        from allura import model as M
+        return M.MonQTask.post(func, (items,) + args, kwargs,
+                               coalesce_key=coalesce_key)
     func.post = post
+    func.post_coalesced = post_coalesced
     return func
 
 class event_handler(object):
@@ -26,6 +26,10 @@ class parse(object):
 
     def __init__(self, context):
         self._context = context
+        # Macros may depend on the request, the user or other artifacts (and
+        # some, like img, record what they did in the request), so output
+        # with any of them expanded is not cached
+        self.cacheable = True
 
     def __call__(self, s):
         try:
@@ -36,6 +40,7 @@ def __call__(self, s):
                 if not parts: return '[[' + s + ']]'
                 macro = self._lookup_macro(parts[0])
                 if not macro: return  '[[' + s + ']]'
+                self.cacheable = False
                 for t in parts[1:]:
                     if '=' not in t:
                         return '[-%s: missing =-]' % ' '.join(parts)
@@ -138,15 +143,13 @@ def get_projects_for_macro(category=None, display_mode='grid', sort='last_update
         grid_view_tools='',
         initial_q={}):
     from allura.lib.widgets.project_list import ProjectList
-    from allura.lib import utils
     from allura import model as M
     # 'trove' is internal substitution for 'category' filter in wiki macro
     trove = category
     limit = int(limit)
-    q = dict(
-        deleted=False,
-        is_nbhd_project=False)
-    q.update(initial_q)
+    # The project directory only has listed projects (not deleted, and not
+    # neighborhood projects)
+    q = dict(initial_q)
 
     if labels:
         or_labels = labels.split('|')
@@ -158,63 +161,28 @@ def get_projects_for_macro(category=None, display_mode='grid', sort='last_update
             created_by_neighborhood_id=c.project.neighborhood_id,
             short=award)).first()
         if aw:
-            ids = [grant.granted_to_project_id for grant in
-                M.AwardGrant.query.find(dict(
-                    granted_by_neighborhood_id=c.project.neighborhood_id,
-                    award_id=aw._id))]
-            if '_id' in q:
-                ids = list(set(q['_id']['$in']).intersection(ids))
-            q['_id'] = {'$in': ids}
+            q['awards'] = aw._id
 
     if trove is not None:
-        q['trove_' + trove.type] = trove._id
+        q['troves'] = trove._id
     sort_key, sort_dir = 'last_updated', pymongo.DESCENDING
     if sort == 'alpha':
         sort_key, sort_dir = 'name', pymongo.ASCENDING
-    elif sort == 'random':
-        sort_key, sort_dir = None, None
     elif sort == 'last_registered':
         sort_key, sort_dir = '_id', pymongo.DESCENDING
     elif sort == '_id':
         sort_key, sort_dir = '_id', pymongo.DESCENDING
 
-    projects = []
     if private:
         # Only return private projects.
-        # Can't filter these with a mongo query directly - have to iterate
-        # through and check the ACL of each project.
-        for chunk in utils.chunked_find(M.Project, q, sort_key=sort_key,
-                sort_dir=sort_dir):
-            projects.extend([p for p in chunk if p.private])
-        total = len(projects)
-        if sort == 'random':
-            projects = random.sample(projects, min(limit, total))
-        else:
-            projects = projects[:limit]
+        q['private'] = True
+    if sort == 'random':
+        ids = M.ProjectDirectory.sample(q, limit)
+        projects = M.ProjectDirectory.projects(ids)
+        random.shuffle(projects)
     else:
-        total = None
-        if sort == 'random':
-            # MongoDB doesn't have a random sort built in, so...
-            # 1. Do a direct pymongo query (faster than ORM) to fetch just the
-            #    _ids of objects that match our criteria
-            # 2. Choose a random sample of those _ids
-            # 3. Do an ORM query to fetch the objects with those _ids
-            # 4. Shuffle the results
-            from ming.orm import mapper
-            m = mapper(M.Project)
-            collection = M.main_doc_session.db[m.collection.m.collection_name]
-            docs = list(collection.find(q, {'_id': 1}))
-            if docs:
-                ids = [doc['_id'] for doc in
-                        random.sample(docs, min(limit, len(docs)))]
-                if '_id' in q:
-                    ids = list(set(q['_id']['$in']).intersection(ids))
-                q['_id'] = {'$in': ids}
-                projects = M.Project.query.find(q).all()
-                random.shuffle(projects)
-        else:
-            projects = M.Project.query.find(q).limit(limit).sort(sort_key,
-                sort_dir).all()
+        ids = M.ProjectDirectory.find(q, sort_key, sort_dir, limit)
+        projects = M.ProjectDirectory.projects(ids)
 
     pl = ProjectList()
     g.resource_manager.register(pl)
@@ -224,11 +192,10 @@ def get_projects_for_macro(category=None, display_mode='grid', sort='last_update
                           show_awards_banner=show_awards_banner,
                           grid_view_tools=grid_view_tools)
     if show_total:
-        if total is None:
-            total = 0
-            for p in M.Project.query.find(q):
-                if h.has_access(p, 'read')():
-                    total = total + 1
+        if private:
+            total = M.ProjectDirectory.count(q)
+        else:
+            total = M.ProjectDirectory.count_readable(q)
         response = '<p class="macro_projects_total">%s Projects</p>%s' % \
                 (total, response)
     return response
@@ -1,6 +1,9 @@
 import re
 import logging
+import mailbox
 import smtplib
+import threading
+import Queue
 import email.feedparser
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
@@ -161,9 +164,17 @@ def isvalid(addr):
         return False
 
 class SMTPClient(object):
+    '''Sends mail over a small pool of persistent SMTP connections, up to
+    smtp_pool_size of them, each opened on first use and reopened when it
+    fails.  Each message goes out in as few transactions as possible, of up
+    to smtp_max_recipients envelope recipients each.  With smtp_sink set to a
+    directory, messages are added to a maildir there instead, to try out or
+    benchmark sending without a mail server.'''
 
     def __init__(self):
-        self._client = None
+        # created on first use, once the config is loaded
+        self._pool = None
+        self._lock = threading.Lock()
 
     def sendmail(self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to, message):
         if not addrs: return
@@ -185,19 +196,43 @@ def sendmail(self, addrs, fromaddr, reply_to, subject, message_id, in_reply_to,
             log.warning('No valid addrs in %s, so not sending mail',
                         map(unicode, addrs))
             return
+        max_recipients = asint(tg.config.get('smtp_max_recipients', 100))
+        pool = self._connections()
+        # None is a connection not opened yet
+        client = pool.get()
         try:
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
-        except:
-            self._connect()
-            self._client.sendmail(
-                config.return_path,
-                smtp_addrs,
-                content)
-
-    def _connect(self):
+            for i in range(0, len(smtp_addrs), max_recipients):
+                rcpts = smtp_addrs[i:i + max_recipients]
+                if client is None:
+                    client = self._connect()
+                try:
+                    client.sendmail(config.return_path, rcpts, content)
+                except:
+                    client = self._connect(client)
+                    client.sendmail(config.return_path, rcpts, content)
+        finally:
+            pool.put(client)
+
+    def _connections(self):
+        '''The pool of connections not in use, each sender takes one and
+        puts it back, waiting for one if they all are'''
+        with self._lock:
+            if self._pool is None:
+                size = asint(tg.config.get('smtp_pool_size', 4))
+                self._pool = Queue.LifoQueue()
+                for i in range(size):
+                    self._pool.put(None)
+            return self._pool
+
+    def _connect(self, client=None):
+        '''Open a new connection, closing client'''
+        if client is not None:
+            try:
+                client.quit()
+            except:
+                pass
+        if tg.config.get('smtp_sink'):
+            return MaildirSink(tg.config['smtp_sink'])
         if asbool(tg.config.get('smtp_ssl', False)):
             smtp_client = smtplib.SMTP_SSL(
                 tg.config.get('smtp_server', 'localhost'),
@@ -210,4 +245,18 @@ def _connect(self):
             smtp_client.login(tg.config['smtp_user'], tg.config['smtp_password'])
         if asbool(tg.config.get('smtp_tls', False)):
             smtp_client.starttls()
-        self._client = smtp_client
+        return smtp_client
+
+class MaildirSink(object):
+    '''Stands in for an SMTP connection, adding each message to a maildir
+    with its envelope in X-Envelope-From and X-Envelope-To headers'''
+
+    def __init__(self, path):
+        self.maildir = mailbox.Maildir(path, factory=None, create=True)
+
+    def sendmail(self, fromaddr, toaddrs, content):
+        self.maildir.add('X-Envelope-From: %s\nX-Envelope-To: %s\n%s' % (
+                fromaddr, ', '.join(toaddrs), content))
+
+    def quit(self):
+        pass
@@ -141,13 +141,25 @@ def compile(self):
         from allura import model as M
         if self.stash['artifact'] or self.stash['link']:
             try:
+                if M.MarkdownCache.enabled():
+                    # Read before the shortlinks, so that a change in between
+                    # leaves the cached output stale
+                    self.link_versions = M.MarkdownCache.link_versions(
+                        M.Shortlink.project_ids(
+                            *(self.stash['artifact'] + self.stash['link'])))
                 self.alinks = M.Shortlink.from_links(*self.stash['artifact'])
                 self.alinks.update(M.Shortlink.from_links(*self.stash['link']))
             except:
                 self.alinks = {}
+                self.link_versions = None
+        # Output that depends on shortlinks or macros may change without the
+        # markdown changing, which limits how it can be cached
+        self.uses_links = bool(self.stash['artifact'] or self.stash['link'])
         self.stash['artifact'] = map(self._expand_alink, self.stash['artifact'])
         self.stash['link'] = map(self._expand_link, self.stash['link'])
-        self.stash['macro'] = map(macro.parse(self._macro_context), self.stash['macro'])
+        parser = macro.parse(self._macro_context)
+        self.stash['macro'] = map(parser, self.stash['macro'])
+        self.cacheable = parser.cacheable
 
     def reset(self):
         self.stash = dict(
@@ -156,6 +168,9 @@ def reset(self):
             link=[])
         self.alinks = {}
         self.compiled = False
+        self.uses_links = False
+        self.link_versions = None
+        self.cacheable = True
 
     def _expand_alink(self, link):
         new_link = self.alinks.get(link, None)
@@ -0,0 +1,235 @@
+'''Per-request profiling of Mongo and Solr operations, to find pages that
+repeat the same query for each row they show (N+1 queries).
+
+While a QueryProfile is active on a thread (see profiling()), every call to
+an instrumented method records an operation: what kind it is, the collection,
+the shape of its query (the query with its values replaced by '?'), where it
+was called from and how long it took.  Operations of the same shape repeated
+at least threshold times are reported as N+1 suspects.
+
+QueryProfilerMiddleware (see allura.lib.custom_middleware) profiles each
+request when query_profiler.enabled is set.
+'''
+import re
+import time
+import logging
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# frames from these are skipped to find where an operation was called from
+SKIP_FRAMES = ('/ming/', '/pymongo/', '/bson/', '/pysolr', '/mim.py',
+               'lib/query_profiler.py', 'lib/custom_middleware.py')
+RE_SOLR_VALUE = re.compile(r'"[^"]*"|\b\d+(\.\d+)?\b')
+
+def current():
+    '''The QueryProfile active on this thread, or None'''
+    return getattr(_local, 'profile', None)
+
+@contextmanager
+def profiling(threshold=5):
+    '''Record operations on this thread into a new QueryProfile'''
+    profile = QueryProfile(threshold)
+    previous, _local.profile = current(), profile
+    try:
+        yield profile
+    finally:
+        _local.profile = previous
+
+def query_shape(query):
+    '''The Mongo query with its values replaced by '?', keeping field names
+    and operators'''
+    if isinstance(query, dict):
+        return dict((k, query_shape(v)) for k, v in query.iteritems())
+    if isinstance(query, (list, tuple)):
+        if query and isinstance(query[0], dict):
+            # e.g. the clauses of an $or, or documents to insert
+            shapes = []
+            for q in query:
+                shape = query_shape(q)
+                if shape not in shapes:
+                    shapes.append(shape)
+            return shapes
+        return '[?]'
+    return '?' if query is not None else None
+
+def solr_query_shape(q):
+    '''The Solr query string with its values replaced by '?', keeping field
+    names and operators'''
+    if not isinstance(q, basestring):
+        return query_shape(q)
+    return RE_SOLR_VALUE.sub('?', q)
+
+def shape_key(shape):
+    if isinstance(shape, dict):
+        return '{%s}' % ', '.join(
+            '%s: %s' % (k, shape_key(v)) for k, v in sorted(shape.iteritems()))
+    if isinstance(shape, list):
+        return '[%s]' % ', '.join(shape_key(v) for v in shape)
+    return str(shape)
+
+def call_site():
+    '''Where the operation being recorded was called from'''
+    for filename, lineno, name, line in reversed(traceback.extract_stack()):
+        if not any(s in filename for s in SKIP_FRAMES):
+            return '%s:%d %s' % (filename, lineno, name)
+    return None
+
+class QueryProfile(object):
+    '''The operations recorded during one request'''
+
+    def __init__(self, threshold=5):
+        self.threshold = threshold
+        self.ops = []
+
+    def record(self, kind, collection, op, query):
+        '''Record an operation, and return it so that the caller can add
+        its duration'''
+        if kind == 'solr':
+            shape = solr_query_shape(query)
+        else:
+            shape = query_shape(query)
+        op = dict(kind=kind, collection=collection, op=op,
+                  shape=shape_key(shape),
+                  site=call_site(), time=0.0)
+        self.ops.append(op)
+        return op
+
+    def shapes(self):
+        '''Return the operations grouped by shape, most repeated first'''
+        groups = {}
+        for op in self.ops:
+            key = (op['kind'], op['collection'], op['op'], op['shape'])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = dict(
+                    kind=op['kind'], collection=op['collection'], op=op['op'],
+                    shape=op['shape'], count=0, time=0.0, sites=[])
+            group['count'] += 1
+            group['time'] += op['time']
+            if op['site'] not in group['sites'] and len(group['sites']) < 3:
+                group['sites'].append(op['site'])
+        return sorted(groups.values(), key=lambda g: (-g['count'], -g['time']))
+
+    def report(self):
+        shapes = self.shapes()
+        return dict(
+            ops=len(self.ops),
+            time=sum(op['time'] for op in self.ops),
+            shapes=shapes,
+            suspects=[ s for s in shapes if s['count'] >= self.threshold ])
+
+def instrument(cls, kind, *names):
+    '''Record calls of the methods names of cls, a class of Mongo collections
+    or Solr connections, in the current QueryProfile.  Cursors returned keep
+    the operation so that the time to fetch their results is added to it
+    (see instrument_cursor).'''
+    for name in names:
+        method = getattr(cls, name, None)
+        if method is None or getattr(method, 'query_profiled', False):
+            continue
+        setattr(cls, name, _profiled(kind, name, method))
+
+def instrument_cursor(cls, *names):
+    '''Add the time of the methods names of cls, a class of cursors, to the
+    operation that returned the cursor'''
+    for name in names:
+        method = getattr(cls, name, None)
+        if method is None or getattr(method, 'query_profiled', False):
+            continue
+        setattr(cls, name, _timed(method))
+
+def _profiled(kind, name, method):
+    def wrapper(self, *args, **kwargs):
+        profile = current()
+        if profile is None:
+            return method(self, *args, **kwargs)
+        if args:
+            query = args[0]
+        else:
+            query = kwargs.get('spec', kwargs.get('query', kwargs.get('q')))
+        op = profile.record(
+            kind, getattr(self, 'name', None) or getattr(self, 'url', None),
+            name, query)
+        begin = time.time()
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            op['time'] += time.time() - begin
+        if name == 'find':
+            result._query_profile_op = op
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    wrapper.query_profiled = True
+    return wrapper
+
+def _timed(method):
+    def wrapper(self, *args, **kwargs):
+        op = getattr(self, '_query_profile_op', None)
+        if op is None or current() is None:
+            return method(self, *args, **kwargs)
+        begin = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            op['time'] += time.time() - begin
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    wrapper.query_profiled = True
+    return wrapper
+
+class QueryProfiler(object):
+    '''Reports of the most recently profiled requests, and totals per
+    endpoint, kept per process'''
+
+    recent = deque(maxlen=100)
+    endpoints = {}
+    max_endpoints = 1000
+    _lock = threading.Lock()
+    _last_id = 0
+
+    @classmethod
+    def add(cls, endpoint, url, report, log_every=100):
+        '''Keep the report of a request, and return its id'''
+        with cls._lock:
+            cls._last_id += 1
+            report = dict(report, id=cls._last_id, endpoint=endpoint, url=url)
+            cls.recent.append(report)
+            if endpoint not in cls.endpoints and len(cls.endpoints) >= cls.max_endpoints:
+                endpoint = endpoint.split(' ', 1)[0] + ' *'
+            totals = cls.endpoints.get(endpoint)
+            if totals is None:
+                totals = cls.endpoints[endpoint] = dict(
+                    requests=0, ops=0, time=0.0, suspects={})
+            totals['requests'] += 1
+            totals['ops'] += report['ops']
+            totals['time'] += report['time']
+            for s in report['suspects']:
+                key = '%s %s.%s %s' % (s['kind'], s['collection'], s['op'], s['shape'])
+                totals['suspects'][key] = totals['suspects'].get(key, 0) + 1
+            if totals['requests'] % log_every == 0:
+                cls.log_endpoint(endpoint, totals)
+            return report['id']
+
+    @classmethod
+    def get(cls, report_id):
+        for report in cls.recent:
+            if report['id'] == report_id:
+                return report
+        return None
+
+    @classmethod
+    def log_endpoint(cls, endpoint, totals):
+        suspects = sorted(totals['suspects'].iteritems(), key=lambda s: -s[1])
+        log.info('%s: %d requests, %.1f queries and %.1fms of queries per request%s',
+                 endpoint, totals['requests'],
+                 float(totals['ops']) / totals['requests'],
+                 totals['time'] * 1000 / totals['requests'],
+                 ''.join('\n    N+1 suspect in %d requests: %s' % (n, key)
+                         for key, n in suspects[:5]))
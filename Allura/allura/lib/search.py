@@ -4,12 +4,10 @@
 from pprint import pformat
 from itertools import islice, chain
 
-import markdown
 from pylons import c,g
 import pysolr
 
 from . import helpers as h
-from .markdown_extensions import ForgeExtension
 
 log = getLogger(__name__)
 
@@ -61,9 +59,8 @@ def search_artifact(atype, q, history=False, rows=10, **kw):
         raise ValueError('Error running search query: %s' % e.message)
 
 def find_shortlinks(text):
-    md = markdown.Markdown(
-        extensions=['codehilite', ForgeExtension(), 'tables'],
-        output_format='html4')
-    md.convert(text)
+    md = g.markdown
+    # the links are collected during conversion, so it can't come from cache
+    md.convert(text, use_cache=False)
     link_index = md.postprocessors['forge'].parent.alinks
     return [ link for link in link_index.itervalues() if link is not None]
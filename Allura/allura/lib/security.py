@@ -241,52 +241,180 @@ def has_access(obj, permission, user=None, project=None):
     matches to DENY access to the resource.
     '''
     from allura import model as M
-    def predicate(obj=obj, user=user, project=project, roles=None):
+    def predicate(obj=obj, user=user, project=project, roles=None, stamps=None):
         if obj is None:
             return False
+        if user is None: user = c.user
         if roles is None:
-            if user is None: user = c.user
             assert user, 'c.user should always be at least M.User.anonymous()'
             cred = Credentials.get()
             if project is None:
-                if isinstance(obj, M.Neighborhood):
-                    project = obj.neighborhood_project
-                    if project is None:
-                        log.error('Neighborhood project missing for %s', obj)
-                        return False
-                elif isinstance(obj, M.Project):
-                    project = obj.root_project
-                else:
-                    project = c.project.root_project
+                project = _security_project(obj)
+                if project is None:
+                    return False
             roles = cred.user_roles(user_id=user._id, project_id=project._id).reaching_ids
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
-        parent = obj.parent_security_context()
-        if parent and chainable_roles:
-            result = has_access(parent, permission, user=user, project=project)(
-                roles=tuple(chainable_roles))
-        elif not isinstance(obj, M.Neighborhood):
-            result = has_access(project.neighborhood, 'admin', user=user)()
-            if not (result or isinstance(obj, M.Project)):
-                result = has_access(project, 'admin', user=user)()
+        roles = tuple(roles)
+        # Results are memoized for the rest of the request, keyed by (among
+        # other things) every ACL they depend on, so ACL changes are seen
+        # immediately.
+        cache = getattr(c, 'memoize_cache', None)
+        key = None
+        if isinstance(cache, dict):
+            if stamps is None:
+                stamps = _access_stamps(obj, project)
+            key = _access_key(obj, permission, user, project, roles, stamps)
+            if key is not None and key in cache:
+                return cache[key]
+        allowed, chainable_roles = compile_acl(obj.acl, permission).check(roles)
+        if allowed:
+            result = True
         else:
-            result = False
+            parent = obj.parent_security_context()
+            if parent and chainable_roles:
+                if stamps is not None:
+                    # the parent's chain is the rest of ours
+                    stamps = (stamps[0][1:],) + stamps[1:]
+                result = has_access(parent, permission, user=user, project=project)(
+                    roles=chainable_roles, stamps=stamps)
+            elif not isinstance(obj, M.Neighborhood):
+                result = has_access(project.neighborhood, 'admin', user=user)()
+                if not (result or isinstance(obj, M.Project)):
+                    result = has_access(project, 'admin', user=user)()
+            else:
+                result = False
         # log.info('%s: %s', txt, result)
+        if key is not None:
+            cache[key] = result
         return result
     return TruthyCallable(predicate)
 
+def has_access_many(objs, permission, user=None, project=None):
+    '''Return a list of whether the user has the permission on each of objs,
+    like [ has_access(obj, permission, user, project)() for obj in objs ] but
+    for list views: the user's roles in all the projects involved are loaded
+    at once, and artifacts in the same tool with the same ACL share one
+    decision.'''
+    if user is None: user = c.user
+    if project is None:
+        projects = [ _security_project(obj) for obj in objs ]
+    else:
+        projects = [ project ] * len(objs)
+    Credentials.get().load_user_roles(
+        user._id, *set(p._id for p in projects if p is not None))
+    decisions = {}
+    results = []
+    for obj, p in zip(objs, projects):
+        if p is None:
+            results.append(False)
+            continue
+        key = shared_access_key(obj)
+        if key is None:
+            results.append(bool(has_access(obj, permission, user, p)()))
+            continue
+        key = (p._id, key)
+        if key not in decisions:
+            decisions[key] = bool(has_access(obj, permission, user, p)())
+        results.append(decisions[key])
+    return results
+
+def shared_access_key(obj):
+    '''Key that obj shares with every object that has_access is sure to
+    answer the same for, or None.  That is the case for artifacts with the
+    same ACL in the same tool, unless their class changes where ACL
+    processing continues.'''
+    from allura import model as M
+    if not isinstance(obj, M.Artifact):
+        return None
+    if obj.__class__.parent_security_context.im_func is not \
+            M.Artifact.parent_security_context.im_func:
+        return None
+    return obj.app_config_id, acl_stamp(obj.acl)
+
+class CompiledACL(object):
+    '''The decisions of an ACL for one permission: the first matching ACE of
+    each role named in the ACL, and of EVERYONE for all other roles.'''
+
+    def __init__(self, stamp, permission):
+        from allura.model.types import EVERYONE, ALL_PERMISSIONS
+        self.decisions = {}
+        self.default = None
+        for access, role_id, ace_permission in stamp:
+            if ace_permission not in (permission, ALL_PERMISSIONS):
+                continue
+            if role_id == EVERYONE:
+                # decides every role that no earlier ACE decided
+                self.default = access
+                break
+            self.decisions.setdefault(role_id, access)
+
+    def check(self, roles):
+        '''Return (allowed, roles for which the ACL decided nothing)'''
+        from allura.model.types import ACE
+        chainable_roles = []
+        for rid in roles:
+            access = self.decisions.get(rid, self.default)
+            if access == ACE.ALLOW:
+                return True, ()
+            elif access is None:
+                chainable_roles.append(rid)
+        return False, tuple(chainable_roles)
+
+# CompiledACLs, keyed by the ACL's contents and permission, so they can be
+# shared between objects and requests; an ACL that changes gets a new key.
+_compiled_acls = {}
+COMPILED_ACLS_SIZE = 10000
+
+def acl_stamp(acl):
+    return tuple((ace.access, ace.role_id, ace.permission) for ace in acl)
+
+def compile_acl(acl, permission):
+    key = (acl_stamp(acl), permission)
+    compiled = _compiled_acls.get(key)
+    if compiled is None:
+        if len(_compiled_acls) >= COMPILED_ACLS_SIZE:
+            _compiled_acls.clear()
+        compiled = _compiled_acls[key] = CompiledACL(key[0], permission)
+    return compiled
+
+def _security_project(obj):
+    '''The project whose roles count when checking access to obj'''
+    from allura import model as M
+    if isinstance(obj, M.Neighborhood):
+        project = obj.neighborhood_project
+        if project is None:
+            log.error('Neighborhood project missing for %s', obj)
+        return project
+    elif isinstance(obj, M.Project):
+        return obj.root_project
+    else:
+        return c.project.root_project
+
+def _access_key(obj, permission, user, project, roles, stamps):
+    from allura.app import Application
+    if isinstance(obj, Application):
+        # an Application's ACL and parent are those of its AppConfig
+        obj = obj.config
+    _id = getattr(obj, '_id', None)
+    if _id is None:
+        return None
+    return ('has_access', obj.__class__.__name__, _id) + stamps + (
+        permission, user._id, project._id, roles)
+
+def _access_stamps(obj, project):
+    '''The ACLs that has_access(obj) depends on: those up the parent security
+    contexts of obj and, through the admin checks at the end of the chain,
+    those of the project and its neighborhood.  Only the top-level check
+    computes them; the checks up the chain are passed the rest.'''
+    return (_chain_stamp(obj), _chain_stamp(project),
+            acl_stamp(project.neighborhood.acl))
+
+def _chain_stamp(obj):
+    stamps = []
+    while obj is not None:
+        stamps.append(acl_stamp(obj.acl))
+        obj = obj.parent_security_context()
+    return tuple(stamps)
+
 def require(predicate, message=None):
     '''
     Example: require(has_access(c.app, 'read'))
@@ -2,6 +2,7 @@
 import string
 import hashlib
 import binascii
+import base64
 import logging.handlers
 import codecs
 import os.path
@@ -13,6 +14,7 @@
 from itertools import groupby
 
 import tg
+import bson
 import pylons
 import webob.multidict
 from formencode import Invalid
@@ -170,6 +172,75 @@ def chunked_find(cls, query=None, pagesize=1024, sort_key=None, sort_dir=1):
         yield results
         page += 1
 
+def keyset_sort(sort):
+    '''Complete a sort spec (a list of (field, direction) pairs) with _id,
+    so that it orders documents totally, for keyset_query'''
+    sort = list(sort)
+    if not sort or sort[-1][0] != '_id':
+        direction = sort and sort[-1][1] or 1
+        sort.append(('_id', direction))
+    return sort
+
+def keyset_token(obj, sort):
+    '''Opaque token for the position of obj (an object or dict) in the
+    order sort, to fetch the documents after it with keyset_query'''
+    values = []
+    for field, direction in keyset_sort(sort):
+        value = obj
+        for name in field.split('.'):
+            if isinstance(value, dict):
+                value = value.get(name)
+            else:
+                value = getattr(value, name, None)
+        values.append(value)
+    return base64.urlsafe_b64encode(bson.BSON.encode(dict(v=values)))
+
+def keyset_query(query, sort, after):
+    '''Restrict query to the documents that come after the keyset_token
+    after in the order sort.  Unlike skip(), the cost doesn't grow with the
+    number of documents before them, given an index for sort.'''
+    sort = keyset_sort(sort)
+    try:
+        values = bson.BSON(base64.urlsafe_b64decode(str(after))).decode()['v']
+    except Exception:
+        raise ValueError('Invalid page token: %r' % after)
+    if len(values) != len(sort):
+        raise ValueError('Invalid page token: %r' % after)
+    branches = []
+    prefix = {}
+    for (field, direction), value in zip(sort, values):
+        # null sorts before everything else
+        if direction > 0:
+            if value is None:
+                branches.append(_merged(prefix, {field: {'$ne': None}}))
+            else:
+                branches.append(_merged(prefix, {field: {'$gt': value}}))
+        elif value is not None:
+            branches.append(_merged(prefix, {field: {'$lt': value}}))
+            branches.append(_merged(prefix, {field: None}))
+        prefix[field] = value
+    return and_query(query, {'$or': branches})
+
+def and_query(query, condition):
+    '''Combine a mongo query with one more condition, avoiding $and (not in
+    MongoDB before 2.0, nor in mim) where possible'''
+    overlap = set(query) & set(condition)
+    if not overlap:
+        return _merged(query, condition)
+    if overlap == set(['$or']):
+        branches = [
+            (a, b) for a in query['$or'] for b in condition['$or'] ]
+        if not any(set(a) & set(b) for a, b in branches):
+            result = _merged(query, condition)
+            result['$or'] = [ _merged(a, b) for a, b in branches ]
+            return result
+    return {'$and': [ query, condition ]}
+
+def _merged(a, b):
+    result = dict(a)
+    result.update(b)
+    return result
+
 def lsub_utf8(s, n):
     '''Useful for returning n bytes of a UTF-8 string, rather than characters'''
     while len(s) > n:
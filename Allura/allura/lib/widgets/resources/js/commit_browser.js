@@ -46,11 +46,12 @@ if($('#commit_graph')){
     var point_size = 10;
     var page_size = 15;
 
-    var data;
+    var data_page_size = 500;
+
     var offset = 1;
     var selected_commit = -1;
     var y_offset = offset * y_space;
-    var tree, next_column, max_x_pos, max_row;
+    var next_column, max_row;
 
     var $graph_holder = $('#graph_holder');
     var $scroll_placeholder = $('#graph_scroll_placeholder');
@@ -61,9 +62,9 @@ if($('#commit_graph')){
     var highlighter_ctx = highlighter.getContext('2d');
     var canvas_ctx = canvas.getContext('2d');
 
-    // graph set up
+    // graph set up: commits by row, loaded data_page_size rows at a time
     var commit_rows = [];
-    var taken_coords = {};
+    var loaded_pages = {};
 
     canvas.height = 300;
     highlighter.height = canvas.height;
@@ -81,37 +82,50 @@ if($('#commit_graph')){
       $scroll_placeholder.height(graph_height);
     }
 
-    $.getJSON(document.location.href+'_data', function(data) {
-        data = data;
-        tree = data['built_tree'];
-        next_column = data['next_column'];
-        max_x_pos = x_space*next_column;
-        max_row = data['max_row']
-        setHeight(max_row);
-
-        // Calculate the (x,y) positions of all the commits
-        for(var c in tree){
-            var commit = tree[c];
-            var x_pos = x_space+(commit.column*x_space);
-            var y_pos = y_space+((commit.row)*y_space);
-            if (!taken_coords[x_pos]){
-                taken_coords[x_pos] = [y_pos]
+    function loadRows(first, last, callback) {
+      /* Fetch the pages of rows first to last that are not loaded yet */
+      var page = Math.floor(first / data_page_size);
+      for (; page * data_page_size <= last; page++) {
+        if (loaded_pages[page]) continue;
+        if (max_row !== undefined && page * data_page_size > max_row) break;
+        loaded_pages[page] = true;
+        $.getJSON(document.location.href+'_data',
+                  {start: page * data_page_size, limit: data_page_size},
+                  function(data) {
+            var tree = data['built_tree'];
+            next_column = data['next_column'];
+            if (max_row === undefined) {
+              max_row = data['max_row'];
+              setHeight(max_row);
             }
-            else if(taken_coords[x_pos].indexOf(y_pos) == -1){
-                taken_coords[x_pos].push(y_pos);
+            // the whole graph, when the repo has not been laid out yet
+            if (data['commits'].length > data_page_size) {
+              for (var p = 0; p * data_page_size <= max_row; p++)
+                loaded_pages[p] = true;
             }
-            commit_rows[commit.row] = {
+            // Calculate the (x,y) positions of the commits
+            for (var c in tree) {
+              var commit = tree[c];
+              commit_rows[commit.row] = {
                 url: commit.url,
-                x_pos: x_pos,
-                y_pos: y_pos }
-        }
-        drawGraph(offset);
-        selectCommit(0);
-    });
+                column: commit.column,
+                message: commit.message,
+                edges: commit.edges,
+                x_pos: x_space+(commit.column*x_space),
+                y_pos: y_space+(commit.row*y_space) };
+            }
+            if (callback) callback();
+            drawGraph(offset);
+        });
+      }
+    }
+
+    loadRows(0, 0, function() { selectCommit(0); });
 
     function selectCommit(index) {
       if (index < 0 || index > max_row) return;
       var commit = commit_rows[index];
+      if (!commit) return;
       highlighter_ctx.clearRect(0, 0, canvas.width, canvas.height);
       highlighter_ctx.fillRect(
           0, (commit.y_pos - y_offset) - y_space/4,
@@ -153,37 +167,61 @@ if($('#commit_graph')){
         canvas_ctx.textBaseline = "top";
         canvas_ctx.font = "12px sans-serif";
 
-        for(var c in tree){
-            var commit = tree[c];
-            var x_pos = x_space+(commit.column*x_space);
-            var y_pos = y_space+((commit.row-offset)*y_space);
-
-            for(var i=0,len=commit.parents.length;i<len;i++){
-                var parent = tree[commit.parents[i]];
-                var parent_x = x_space+parent.column*x_space
-                var parent_y = y_space+(parent.row-offset)*y_space;
-
-                canvas_ctx.strokeStyle = color(parent.column % 6);
-
-                // Vertical
-                canvas_ctx.beginPath();
-                canvas_ctx.moveTo(parent_x+point_offset, y_pos+y_space);
-                canvas_ctx.lineTo(parent_x+point_offset, parent_y+point_offset);
-                canvas_ctx.stroke();
-
-                // Diagonal
-                canvas_ctx.beginPath()
-                canvas_ctx.moveTo(x_pos + point_offset, y_pos+point_offset);
-                canvas_ctx.lineTo(parent_x+point_offset, y_pos+y_space);
-                canvas_ctx.stroke();
+        var first = Math.max(offset - 1, 0);
+        var last = offset + page_size + 1;
+        loadRows(first, last);
+
+        // edges of the commits above the bottom of the view, as long as
+        // they reach into it
+        for(var row=0; row<=last && row<commit_rows.length; row++){
+            var commit = commit_rows[row];
+            if (!commit) continue;
+            var x_pos = commit.x_pos;
+            var y_pos = commit.y_pos - y_offset;
+
+            for(var i=0,len=commit.edges.length;i<len;i++){
+                var edge = commit.edges[i];
+                if (edge[0] < first) continue;
+                var parent_x = x_space+edge[1]*x_space
+                var parent_y = y_space+(edge[0]-offset)*y_space;
+                var edge_x = x_space+edge[2]*x_space
+
+                if (edge_x == parent_x) {
+                    // along the lane of the parent, up to the row below
+                    // the commit
+                    canvas_ctx.strokeStyle = color(edge[1] % 6);
+                    canvas_ctx.beginPath();
+                    canvas_ctx.moveTo(parent_x+point_offset, y_pos+y_space);
+                    canvas_ctx.lineTo(parent_x+point_offset, parent_y+point_offset);
+                    canvas_ctx.stroke();
+
+                    canvas_ctx.beginPath()
+                    canvas_ctx.moveTo(x_pos + point_offset, y_pos+point_offset);
+                    canvas_ctx.lineTo(parent_x+point_offset, y_pos+y_space);
+                    canvas_ctx.stroke();
+                } else {
+                    // along the lane of the commit, down to the row above
+                    // the parent
+                    canvas_ctx.strokeStyle = color(commit.column % 6);
+                    canvas_ctx.beginPath();
+                    canvas_ctx.moveTo(x_pos+point_offset, y_pos+point_offset);
+                    canvas_ctx.lineTo(x_pos+point_offset, parent_y-y_space);
+                    canvas_ctx.stroke();
+
+                    canvas_ctx.beginPath()
+                    canvas_ctx.moveTo(x_pos+point_offset, parent_y-y_space);
+                    canvas_ctx.lineTo(parent_x+point_offset, parent_y+point_offset);
+                    canvas_ctx.stroke();
+                }
             }
         }
         // draw commit points and message text
         canvas_ctx.fillStyle = "rgb(0,0,0)";
-        for(var c in tree){
-            var commit = tree[c];
-            var x_pos = x_space+(commit.column*x_space);
-            var y_pos = y_space+((commit.row-offset)*y_space);
+        for(var row=first; row<=last && row<commit_rows.length; row++){
+            var commit = commit_rows[row];
+            if (!commit) continue;
+            var x_pos = commit.x_pos;
+            var y_pos = commit.y_pos - y_offset;
 
             canvas_ctx.strokeStyle = canvas_ctx.fillStyle = color(commit.column % 6);
             canvas_ctx.beginPath();
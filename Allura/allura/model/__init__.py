@@ -15,8 +15,11 @@
 from .repository import Repository, RepositoryImplementation
 from .repository import MergeRequest, GitLikeTree
 from .stats import Stats
+from .markdown_cache import MarkdownCache
+from .nav_cache import NavCache
+from .project_directory import ProjectDirectory
 from .oauth import OAuthToken, OAuthConsumerToken, OAuthRequestToken, OAuthAccessToken
-from .monq_model import MonQTask
+from .monq_model import MonQTask, MonQWakeup
 
 from .types import ACE, ACL, EVERYONE, ALL_PERMISSIONS, DENY_ALL
 from .session import main_doc_session, main_orm_session
@@ -1,4 +1,5 @@
 import logging
+import difflib
 import cPickle as pickle
 from collections import defaultdict
 from datetime import datetime
@@ -6,8 +7,11 @@
 import bson
 import pymongo
 from pylons import c, request
+from tg import config
+from paste.deploy.converters import asint
 from ming import schema as S
-from ming.orm import state, session
+from ming.base import Object
+from ming.orm import state, session, MapperExtension
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 from ming.utils import LazyProperty
@@ -287,8 +291,81 @@ def delete(self):
         ArtifactReference.query.remove(dict(_id=self.index_id()))
         super(Artifact, self).delete()
 
+def history_delta(base, data):
+    """The changes from the snapshot data base to data, for a snapshot stored
+    as a delta of a keyframe with data base, or None if they would take more
+    space than data itself.  Long strings are diffed by lines."""
+    delta = dict(set={}, unset=[ k for k in base if k not in data ], diff={})
+    for k, v in data.iteritems():
+        old = base.get(k)
+        if k in base and old == v: continue
+        if isinstance(v, basestring) and isinstance(old, basestring) \
+                and len(v) > 1024:
+            delta['diff'][k] = text_delta(old, v)
+        else:
+            delta['set'][k] = v
+    if len(bson.BSON.encode(delta)) >= len(bson.BSON.encode(dict(data))):
+        return None
+    return delta
+
+def apply_history_delta(base, delta):
+    """The snapshot data that delta (from history_delta) was made from"""
+    data = dict(base)
+    for k in delta['unset']:
+        data.pop(k, None)
+    for k, ops in delta['diff'].iteritems():
+        data[k] = apply_text_delta(base[k], ops)
+    data.update(delta['set'])
+    return data
+
+def text_delta(a, b):
+    """Line ranges of a to keep and text to insert, that make up b"""
+    la = a.splitlines(True)
+    lb = b.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, la, lb, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([ i1, i2 ])
+        elif j2 > j1:
+            ops.append(u''.join(lb[j1:j2]))
+    return ops
+
+def apply_text_delta(a, ops):
+    la = a.splitlines(True)
+    result = []
+    for op in ops:
+        if isinstance(op, basestring):
+            result.append(op)
+        else:
+            result.extend(la[op[0]:op[1]])
+    return u''.join(result)
+
+class SnapshotDataProperty(FieldProperty):
+    """The data of a snapshot, reconstructed from its keyframe if it is
+    stored as a delta"""
+
+    def __get__(self, instance, cls=None):
+        data = super(SnapshotDataProperty, self).__get__(instance, cls)
+        if instance is None or instance.keyframe is None:
+            return data
+        cached = instance.__dict__.get('_snapshot_data')
+        if cached is not None and cached[0] is data:
+            return cached[1]
+        keyframe = instance.__class__.query.get(
+            artifact_id=instance.artifact_id,
+            artifact_class=instance.artifact_class,
+            version=instance.keyframe)
+        full = Object.from_bson(apply_history_delta(keyframe.data, data))
+        instance.__dict__['_snapshot_data'] = (data, full)
+        return full
+
 class Snapshot(Artifact):
-    """A snapshot of an :class:`Artifact <allura.model.artifact.Artifact>`, used in :class:`VersionedArtifact <allura.model.artifact.VersionedArtifact>`"""
+    """A snapshot of an :class:`Artifact <allura.model.artifact.Artifact>`, used in :class:`VersionedArtifact <allura.model.artifact.VersionedArtifact>`
+
+    With history.keyframe_interval = N in the config, only every Nth
+    snapshot of an artifact (a keyframe) stores all its data, the ones in
+    between store a delta of the latest keyframe."""
     class __mongometa__:
         session = artifact_orm_session
         name='artifact_snapshot'
@@ -305,7 +382,9 @@ class __mongometa__:
             display_name=str,
             logged_ip=str))
     timestamp = FieldProperty(datetime)
-    data = FieldProperty(None)
+    data = SnapshotDataProperty(None)
+    # version of the snapshot that data is a delta of, None if it is complete
+    keyframe = FieldProperty(S.Int, if_missing=None)
 
     def index(self):
         result = Artifact.index(self)
@@ -344,6 +423,24 @@ class __mongometa__:
         history_class = Snapshot
 
     version = FieldProperty(S.Int, if_missing=0)
+    # author and timestamp of the latest snapshot, so that listings don't have
+    # to look up the history of each artifact
+    last_edit = FieldProperty(dict(
+            author=dict(
+                id=S.ObjectId(if_missing=None),
+                username=str,
+                display_name=str),
+            timestamp=datetime))
+
+    @staticmethod
+    def last_edit_of(snapshot):
+        '''The last_edit of an artifact whose latest snapshot is snapshot'''
+        return dict(
+            author=dict(
+                id=snapshot.author.id,
+                username=snapshot.author.username,
+                display_name=snapshot.author.display_name),
+            timestamp=snapshot.timestamp)
 
     def commit(self):
         '''Save off a snapshot of the artifact and increment the version #'''
@@ -364,14 +461,32 @@ def commit(self):
                 username=c.user.username,
                 display_name=c.user.get_pref('display_name'),
                 logged_ip=ip_address),
-            timestamp=datetime.utcnow(),
-            data=state(self).clone())
+            timestamp=datetime.utcnow())
+        data['keyframe'], data['data'] = self.history_data(state(self).clone())
         ss = self.__mongometa__.history_class(**data)
         session(ss).insert_now(ss, state(ss))
+        self.last_edit = self.last_edit_of(ss)
         log.info('Snapshot version %s of %s',
                  self.version, self.__class__)
         return ss
 
+    def history_data(self, data):
+        '''Return (None, data) to snapshot data in full, or (version of the
+        latest keyframe, delta of it) if that takes less space, and the
+        keyframe is recent enough according to history.keyframe_interval'''
+        interval = asint(config.get('history.keyframe_interval', 0))
+        if interval <= 1:
+            return None, data
+        HC = self.__mongometa__.history_class
+        keyframe = HC.query.find(dict(artifact_id=self._id, keyframe=None)) \
+            .sort('version', pymongo.DESCENDING).first()
+        if keyframe is None or self.version - keyframe.version >= interval:
+            return None, data
+        delta = history_delta(keyframe.data, data)
+        if delta is None:
+            return None, data
+        return keyframe.version, delta
+
     def get_version(self, n):
         if n < 0:
             n = self.version + n + 1
@@ -388,9 +503,11 @@ def get_version(self, n):
     def revert(self, version):
         ss = self.get_version(version)
         old_version = self.version
+        old_last_edit = self.last_edit
         for k,v in ss.data.iteritems():
             setattr(self, k, v)
         self.version = old_version
+        self.last_edit = old_last_edit
 
     def history(self):
         HC = self.__mongometa__.history_class
@@ -399,6 +516,8 @@ def history(self):
 
     @property
     def last_updated(self):
+        if self.last_edit.timestamp:
+            return self.last_edit.timestamp
         history = self.history()
         if len(history):
             return self.history().first().timestamp
@@ -529,12 +648,22 @@ def longurl(self):
     def shorthand_id(self):
         return self.short
 
+class AwardGrantMapperExtension(MapperExtension):
+    def after_insert(self, obj, st, sess):
+        from .project_directory import ProjectDirectory
+        ProjectDirectory.update_awards(obj.granted_to_project_id)
+
+    def after_delete(self, obj, st, sess):
+        from .project_directory import ProjectDirectory
+        ProjectDirectory.update_awards(obj.granted_to_project_id)
+
 class AwardGrant(Artifact):
     "An :class:`Award <allura.model.artifact.Award>` can be bestowed upon a project by a neighborhood"
     class __mongometa__:
         session = main_orm_session
         name='grant'
         indexes = [ 'short' ]
+        extensions = [ AwardGrantMapperExtension ]
     type_s = 'Generic Award Grant'
 
     _id=FieldProperty(S.ObjectId)
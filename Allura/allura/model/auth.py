@@ -461,6 +461,9 @@ def set_password(self, new_password):
     def anonymous(cls):
         return User.query.get(_id=None)
 
+    def is_anonymous(self):
+        return self._id is None
+
     def email_address_header(self):
         h = header.Header()
         h.append(u'"%s" ' % self.get_pref('display_name'))
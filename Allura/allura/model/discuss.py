@@ -5,23 +5,46 @@
 from pymongo.errors import DuplicateKeyError
 from pylons import c, g
 
-from ming import schema
-from ming.orm.base import session
+from ming import schema, collection, Field
+from ming.orm.base import session, mapper
 from ming.orm.property import (FieldProperty, RelationProperty,
                                ForeignIdProperty)
 from ming.utils import LazyProperty
 
 from allura.lib import helpers as h
 from allura.lib import security
+from allura.lib import utils
 from allura.lib.security import require_access, has_access
 from allura.model.notification import Notification, Mailbox
 from .artifact import Artifact, VersionedArtifact, Snapshot, Message, Feed
 from .attachments import BaseAttachment
 from .auth import User
+from .session import project_doc_session
 from .timeline import ActivityObject
 
 log = logging.getLogger(__name__)
 
+# orders of the posts of a thread, see Thread.posts_sort
+POST_ORDERS = ('threaded', 'timestamp')
+
+# The positions of listed posts and the number of approved posts of threads
+# are changed with atomic updates by concurrent requests, so they are kept
+# out of the Post and Thread documents, which the ORM saves whole.
+
+# PostPositionDoc._id is a Post._id, listed in the thread thread_id
+PostPositionDoc = collection(
+    'post_position', project_doc_session,
+    Field('_id', str),
+    Field('thread_id', str, index=True),
+    Field('threaded', int, if_missing=None),
+    Field('timestamp', int, if_missing=None))
+
+# ThreadCountDoc._id is a Thread._id
+ThreadCountDoc = collection(
+    'thread_count', project_doc_session,
+    Field('_id', str),
+    Field('num_posts', int))
+
 
 class Discussion(Artifact, ActivityObject):
     class __mongometa__:
@@ -100,6 +123,11 @@ def subscription(self):
 
     def delete(self):
         # Delete all the threads, posts, and artifacts
+        threads = mapper(self.thread_class()).collection.m.find(
+            dict(discussion_id=self._id), {'_id': 1}, validate=False)
+        thread_ids = [ doc['_id'] for doc in threads ]
+        ThreadCountDoc.m.remove({'_id': {'$in': thread_ids}})
+        PostPositionDoc.m.remove({'thread_id': {'$in': thread_ids}})
         self.thread_class().query.remove(dict(discussion_id=self._id))
         self.post_class().query.remove(dict(discussion_id=self._id))
         self.attachment_class().remove(dict(discussion_id=self._id))
@@ -233,6 +261,7 @@ def post(self, text, message_id=None, parent_id=None,
         if message_id is not None:
             kwargs['_id'] = message_id
         post = self.post_class()(**kwargs)
+        self.list_post(post)
         if ignore_security or has_access(self, 'unmoderated_post')():
             log.info('Auto-approving message from %s', c.user.username)
             file_info = kw.get('file_info', None)
@@ -272,8 +301,37 @@ def notify_moderators(self, post):
                     n.send_direct(str(u._id))
 
     def update_stats(self):
-        self.num_replies = self.post_class().query.find(
-            dict(thread_id=self._id, status='ok')).count() - 1
+        num_posts = self.post_class().query.find(
+            dict(thread_id=self._id, status='ok')).count()
+        ThreadCountDoc.m.update_partial(
+            {'_id': self._id}, {'$set': {'num_posts': num_posts}}, upsert=True)
+        self.num_replies = num_posts - 1
+
+    @property
+    def num_posts(self):
+        '''Number of approved posts, kept by count_post'''
+        doc = ThreadCountDoc.m.get(_id=self._id)
+        if doc is None:
+            return self.post_class().query.find(
+                dict(thread_id=self._id, status='ok')).count()
+        return max(0, doc.num_posts)
+
+    def count_post(self, post, n):
+        '''Count the approval of post (n=1) or the removal of an approved
+        post (n=-1).  Posts of a thread are moderated concurrently, so the
+        count is updated atomically.'''
+        if ThreadCountDoc.m.get(_id=self._id) is None:
+            others = self.post_class().query.find(dict(
+                    thread_id=self._id, status='ok',
+                    _id={'$ne': post._id})).count()
+            try:
+                ThreadCountDoc(dict(
+                        _id=self._id,
+                        num_posts=others + (n < 0 and 1 or 0))).m.insert()
+            except DuplicateKeyError:
+                pass # counted by someone else meanwhile
+        ThreadCountDoc.m.update_partial(
+            {'_id': self._id}, {'$inc': {'num_posts': n}})
 
     @property
     def last_post(self):
@@ -294,29 +352,108 @@ def create_post_threads(self, posts):
         return result
 
     def query_posts(self, page=None, limit=None,
-                    timestamp=None, style='threaded'):
+                    timestamp=None, style='threaded', after=None):
+        """Query the posts of the thread, a page at a time given a limit:
+        page by number, or after the posts_token of the last post of the
+        previous page, which is as fast for any page"""
+        terms = self.listed_terms()
         if timestamp:
-            terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
-                    status={'$in': ['ok', 'pending']}, timestamp=timestamp)
-        else:
-            terms = dict(discussion_id=self.discussion_id, thread_id=self._id,
-                    status={'$in': ['ok', 'pending']})
+            terms['timestamp'] = timestamp
+        sort = self.posts_sort(style)
+        if after:
+            terms = utils.keyset_query(terms, sort, after)
         q = self.post_class().query.find(terms)
-        if style == 'threaded':
-            q = q.sort('full_slug')
-        else:
-            q = q.sort('timestamp')
+        q = q.sort(utils.keyset_sort(sort))
         if limit is not None:
             limit = int(limit)
-            if page is not None:
+            if page is not None and not after:
                 q = q.skip(page * limit)
             q = q.limit(limit)
         return q
 
     def find_posts(self, page=None, limit=None, timestamp=None,
-                   style='threaded'):
+                   style='threaded', after=None):
         return self.query_posts(page=page, limit=limit,
-                                timestamp=timestamp, style=style).all()
+                                timestamp=timestamp, style=style,
+                                after=after).all()
+
+    def posts_sort(self, style='threaded'):
+        if style == 'threaded':
+            return [ ('full_slug', pymongo.ASCENDING) ]
+        else:
+            return [ ('timestamp', pymongo.ASCENDING) ]
+
+    def posts_token(self, post, style='threaded'):
+        '''Token to query the posts after post with query_posts'''
+        return utils.keyset_token(post, self.posts_sort(style))
+
+    def listed_terms(self):
+        '''Query for the posts shown in the thread'''
+        return dict(discussion_id=self.discussion_id, thread_id=self._id,
+                    status={'$in': ['ok', 'pending']})
+
+    def post_position(self, post, style='threaded'):
+        '''Count the listed posts before post in the order style'''
+        Post = self.post_class()
+        others = Post.query.find(dict(
+                self.listed_terms(), _id={'$ne': post._id})).count()
+        after = Post.query.find(utils.keyset_query(
+                self.listed_terms(), self.posts_sort(style),
+                self.posts_token(post, style))).count()
+        return others - after
+
+    def list_post(self, post):
+        '''Give post its position in each order, moving the posts after it
+        down one'''
+        position = dict(thread_id=self._id)
+        for style in POST_ORDERS:
+            position[style] = self.post_position(post, style)
+            self._shift_positions(post, style, 1)
+        PostPositionDoc.m.update_partial(
+            {'_id': post._id}, {'$set': position}, upsert=True)
+
+    def unlist_post(self, post):
+        '''Move the posts after post up one in each order, when it is no
+        longer shown'''
+        for style in POST_ORDERS:
+            self._shift_positions(post, style, -1)
+        PostPositionDoc.m.remove({'_id': post._id})
+
+    def _shift_positions(self, post, style, n):
+        after = utils.keyset_query(
+            self.listed_terms(), self.posts_sort(style),
+            self.posts_token(post, style))
+        after = mapper(self.post_class()).collection.m.find(
+            after, {'_id': 1}, validate=False)
+        PostPositionDoc.m.update_partial(
+            {'_id': {'$in': [ doc['_id'] for doc in after ]},
+             style: {'$ne': None}},
+            {'$inc': {style: n}}, multi=True)
+
+    def update_positions(self):
+        '''Number the listed posts of the thread in each order afresh.  The
+        shifts of list_post and unlist_post are not isolated from each other,
+        so concurrent ones can leave duplicate or missing positions; this
+        repairs them, writing only the positions that are wrong.'''
+        collection = mapper(self.post_class()).collection
+        current = dict(
+            (doc._id, doc)
+            for doc in PostPositionDoc.m.find({'thread_id': self._id}))
+        listed = set()
+        for style in POST_ORDERS:
+            docs = collection.m.find(
+                self.listed_terms(), {'_id': 1}, validate=False)
+            docs = docs.sort(utils.keyset_sort(self.posts_sort(style)))
+            for i, doc in enumerate(docs):
+                listed.add(doc['_id'])
+                position = current.get(doc['_id'])
+                if position is None or position[style] != i:
+                    PostPositionDoc.m.update_partial(
+                        {'_id': doc['_id']},
+                        {'$set': {'thread_id': self._id, style: i}},
+                        upsert=True)
+        PostPositionDoc.m.remove(
+            {'thread_id': self._id, '_id': {'$nin': list(listed)}})
 
     def top_level_posts(self):
         return self.post_class().query.find(dict(
@@ -355,6 +492,7 @@ def delete(self):
         for p in self.post_class().query.find(dict(thread_id=self._id)):
             p.delete()
         self.attachment_class().remove(dict(thread_id=self._id))
+        ThreadCountDoc.m.remove({'_id': self._id})
         super(Thread, self).delete()
 
     def spam(self):
@@ -401,7 +539,12 @@ class Post(Message, VersionedArtifact, ActivityObject):
     class __mongometa__:
         name = 'post'
         history_class = PostHistory
-        indexes = ['discussion_id', 'thread_id']
+        indexes = [
+            'discussion_id',
+            'thread_id',
+            ('thread_id', 'full_slug'),
+            ('thread_id', 'timestamp'),
+            ]
     type_s = 'Post'
 
     thread_id = ForeignIdProperty(Thread)
@@ -418,6 +561,17 @@ class __mongometa__:
     thread = RelationProperty(Thread)
     discussion = RelationProperty(Discussion)
 
+    @property
+    def position(self):
+        '''Number of posts before this one in each of POST_ORDERS, kept by
+        the thread while the post is listed (None otherwise)'''
+        doc = PostPositionDoc.m.get(_id=self._id)
+        if doc is None:
+            doc = PostPositionDoc(dict(
+                    _id=self._id, thread_id=self.thread_id,
+                    threaded=None, timestamp=None))
+        return doc
+
     def __json__(self):
         author = self.author()
         return dict(
@@ -517,27 +671,10 @@ def url_paginated(self):
         if not self.thread:  # pragma no cover
             return None
         limit, p, s = g.handle_paging(None, 0)  # get paging limit
-        if self.query.find(dict(thread_id=self.thread._id)).count() <= limit:
-            # all posts in a single page
-            page = 0
-        else:
-            posts = self.thread.find_posts()
-            posts = self.thread.create_post_threads(posts)
-
-            def find_i(posts):
-                '''Find the index number of this post in the display order'''
-                q = []
-                def traverse(posts):
-                    for p in posts:
-                        if p['post']._id == self._id:
-                            return True  # found
-                        q.append(p)
-                        if traverse(p['children']):
-                            return True
-                traverse(posts)
-                return len(q)
-
-            page = find_i(posts) / limit
+        position = self.position.threaded
+        if position is None:
+            position = self.thread.post_position(self)
+        page = position / limit
 
         slug = h.urlquote(self.slug)
         url = self.thread.url()
@@ -563,6 +700,7 @@ def reply_subject(self):
 
     def delete(self):
         self.attachment_class().remove(dict(post_id=self._id))
+        self._unlist()
         super(Post, self).delete()
         self.thread.num_replies = max(0, self.thread.num_replies - 1)
 
@@ -584,7 +722,8 @@ def approve(self, file_info=None):
         self.thread.last_post_date = max(
             self.thread.last_post_date,
             self.mod_date)
-        self.thread.update_stats()
+        self.thread.count_post(self, 1)
+        self.thread.num_replies = self.thread.num_posts - 1
         if hasattr(artifact, 'update_stats'):
             artifact.update_stats()
         if self.text:
@@ -610,9 +749,17 @@ def notify(self, file_info=None, check_dup=False):
                 n.send_simple(artifact.monitoring_email)
 
     def spam(self):
+        self._unlist()
         self.status = 'spam'
         self.thread.num_replies = max(0, self.thread.num_replies - 1)
 
+    def _unlist(self):
+        if not self.thread: return
+        if self.status == 'ok':
+            self.thread.count_post(self, -1)
+        if self.status in ('ok', 'pending'):
+            self.thread.unlist_post(self)
+
 
 class DiscussionAttachment(BaseAttachment):
     DiscussionClass = Discussion
@@ -19,6 +19,7 @@
 
 from .session import main_doc_session, main_orm_session
 from .project import Project
+from .markdown_cache import MarkdownCache
 
 log = logging.getLogger(__name__)
 
@@ -46,6 +47,19 @@
     Index('project_id', 'link'), # used by from_links()  More helpful to have project_id first, for other queries
 )
 
+# Progress of an in-flight ReindexCommand, so that an interrupted reindex can
+# resume where it stopped instead of starting over
+# ReindexCheckpointDoc._id is derived from the command's options
+ReindexCheckpointDoc = collection(
+    'reindex_checkpoint', main_doc_session,
+    Field('_id', str),
+    Field('project_id', S.ObjectId(if_missing=None)),
+    Field('refs_done', bool, if_missing=False),
+    Field('done_classes', [str]),
+    Field('cls', str, if_missing=None),
+    Field('last_id', S.Anything(if_missing=None)),
+)
+
 # Class definitions
 class ArtifactReference(object):
 
@@ -123,13 +137,31 @@ def from_artifact(cls, a):
             except pymongo.errors.DuplicateKeyError: # pragma no cover
                 session(result).expunge(result)
                 result = cls.query.get(ref_id=a.index_id())
-        result.link = a.shorthand_id()
-        result.url = a.url()
-        if result.link is None:
-            result.delete()
+        link, url = a.shorthand_id(), a.url()
+        if (result.link, result.url) != (link, url):
+            # Flush before bumping the link version, so that markdown
+            # rendered after the bump sees the change
+            result.link = link
+            result.url = url
+            if link is None:
+                result.delete()
+            session(result).flush(result)
+            MarkdownCache.invalidate_links(result.project_id)
+        if link is None:
             return None
         return result
 
+    @classmethod
+    def project_ids(cls, *links):
+        '''The IDs of the projects whose shortlinks the links are looked up
+        in'''
+        result = set()
+        for link in links:
+            d = cls._parse_link(link)
+            if d and d['project_id'] is not None:
+                result.add(d['project_id'])
+        return result
+
     @classmethod
     def from_links(cls, *links):
         '''Convert a sequence of shortlinks to the matching Shortlink objects'''
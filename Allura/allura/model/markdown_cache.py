@@ -0,0 +1,197 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pymongo
+from pylons import request
+from tg import config
+from paste.deploy.converters import asbool, asint
+
+from ming import collection, Field
+from ming import schema as S
+
+from .session import main_doc_session
+
+log = logging.getLogger(__name__)
+
+# MarkdownCacheDoc._id = sha1 of the source and rendering context, see
+# ForgeMarkdown.cache_key
+MarkdownCacheDoc = collection(
+    'markdown_cache', main_doc_session,
+    Field('_id', str),
+    Field('html', S.String(if_missing=None)), # None if not cacheable
+    Field('expires', S.DateTime(if_missing=None)),
+    # link versions of the projects its shortlinks resolved against
+    Field('link_versions', [dict(project_id=S.ObjectId(), version=int)]),
+    Field('last_used', datetime, index=True))
+
+# MarkdownLinkVersionDoc.version is bumped whenever a shortlink of the
+# project MarkdownLinkVersionDoc._id is created, changed or removed, see
+# MarkdownCache.invalidate_links
+MarkdownLinkVersionDoc = collection(
+    'markdown_link_version', main_doc_session,
+    Field('_id', S.ObjectId),
+    Field('version', int, if_missing=0))
+
+class MarkdownCache(object):
+    '''Rendered HTML of markdown, shared through MongoDB, with a small LRU
+    cache of recently used entries in front of it in each process.  Enabled
+    by markdown_cache.enabled = true in the config.
+
+    ForgeMarkdown.convert decides what can be cached.  For markdown whose
+    output can't be cached, an UNCACHEABLE entry saves looking it up again.
+    Output with shortlinks is stored with the link versions of the projects
+    they point into, and is stale once one of those changes (see
+    invalidate_links).  The least recently used entries are evicted once the
+    collection holds more than markdown_cache.max_entries.
+
+    Hit/miss counters are kept per process in MarkdownCache.stats.
+    '''
+    UNCACHEABLE = object()
+
+    # refresh last_used of an entry at most this often
+    touch_interval = timedelta(minutes=10)
+    # check for entries to evict every this many puts
+    evict_interval = 1000
+
+    stats = dict(local_hits=0, hits=0, misses=0, uncacheable=0)
+    _local = OrderedDict()
+    _lock = threading.Lock()
+    _puts = 0
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('markdown_cache.enabled', False))
+
+    @classmethod
+    def get(cls, key):
+        '''Return the cached HTML for key, UNCACHEABLE, or None if there is
+        no fresh entry.  Callers count their misses.'''
+        now = datetime.utcnow()
+        with cls._lock:
+            entry = cls._local.pop(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                cls._local[key] = entry
+            else:
+                entry = None
+        if entry is not None:
+            html, expires, link_versions = entry
+            stat = 'local_hits'
+        else:
+            doc = MarkdownCacheDoc.m.get(_id=key)
+            if doc is None or (doc.expires is not None and doc.expires <= now):
+                return None
+            if doc.last_used < now - cls.touch_interval:
+                MarkdownCacheDoc.m.update_partial(
+                    dict(_id=key), {'$set': dict(last_used=now)}, safe=False)
+            html = doc.html
+            link_versions = dict(
+                (lv.project_id, lv.version) for lv in doc.link_versions)
+            cls._put_local(key, html, doc.expires, link_versions)
+            stat = 'hits'
+        if link_versions and cls.link_versions(link_versions) != link_versions:
+            return None
+        if html is None:
+            cls.count('uncacheable')
+            return cls.UNCACHEABLE
+        cls.count(stat)
+        return html
+
+    @classmethod
+    def put(cls, key, html, ttl=None, link_versions=None):
+        '''Cache html (or None if it can't be cached) under key, for ttl
+        seconds if given, and while the link versions of the projects in
+        link_versions (as returned by link_versions()) stay the same'''
+        now = datetime.utcnow()
+        if ttl is None:
+            expires = None
+        else:
+            expires = now + timedelta(seconds=ttl)
+        if html is not None:
+            html = unicode(html)
+        link_versions = dict(link_versions or {})
+        cls._put_local(key, html, expires, link_versions)
+        MarkdownCacheDoc(dict(
+                _id=key, html=html, expires=expires, last_used=now,
+                link_versions=[
+                    dict(project_id=pid, version=version)
+                    for pid, version in link_versions.iteritems() ])).m.save(safe=False)
+        with cls._lock:
+            cls._puts += 1
+            evict = cls._puts % cls.evict_interval == 0
+        if evict:
+            cls.evict()
+
+    @classmethod
+    def link_versions(cls, project_ids):
+        '''Return a dict[project_id] = link version.  Versions are looked up
+        once per request, so a page rendering many cached entries costs a
+        single query.'''
+        known = cls._request_link_versions()
+        missing = [ pid for pid in project_ids if pid not in known ]
+        if missing:
+            known.update((pid, 0) for pid in missing)
+            for doc in MarkdownLinkVersionDoc.m.find({'_id': {'$in': missing}}):
+                known[doc._id] = doc.version
+        return dict((pid, known[pid]) for pid in project_ids)
+
+    @classmethod
+    def invalidate_links(cls, *project_ids):
+        '''Bump the link versions of the projects, after their shortlinks
+        have changed, so that cached output linking into them is stale'''
+        known = cls._request_link_versions()
+        for pid in project_ids:
+            if pid is None: continue
+            MarkdownLinkVersionDoc.m.update_partial(
+                {'_id': pid}, {'$inc': {'version': 1}}, upsert=True)
+            known.pop(pid, None)
+
+    @classmethod
+    def _request_link_versions(cls):
+        try:
+            return request.environ.setdefault('allura.markdown_link_versions', {})
+        except TypeError: # outside of a request
+            return {}
+
+    @classmethod
+    def count(cls, name):
+        with cls._lock:
+            cls.stats[name] += 1
+
+    @classmethod
+    def hit_rate(cls):
+        hits = cls.stats['local_hits'] + cls.stats['hits']
+        total = hits + cls.stats['misses'] + cls.stats['uncacheable']
+        if not total:
+            return None
+        return float(hits) / total
+
+    @classmethod
+    def evict(cls):
+        '''Remove expired entries, and the least recently used ones beyond
+        markdown_cache.max_entries'''
+        MarkdownCacheDoc.m.remove({'expires': {'$lt': datetime.utcnow()}})
+        max_entries = asint(config.get('markdown_cache.max_entries', 100000))
+        excess = MarkdownCacheDoc.m.find().count() - max_entries
+        if excess <= 0:
+            return
+        oldest = MarkdownCacheDoc.m.find({}, {'last_used': 1}, validate=False) \
+            .sort('last_used', pymongo.ASCENDING).skip(excess).limit(1).first()
+        if oldest is not None:
+            log.info('Evicting %d markdown cache entries', excess)
+            MarkdownCacheDoc.m.remove({'last_used': {'$lt': oldest['last_used']}})
+
+    @classmethod
+    def clear_local(cls):
+        with cls._lock:
+            cls._local.clear()
+
+    @classmethod
+    def _put_local(cls, key, html, expires, link_versions):
+        size = asint(config.get('markdown_cache.local_size', 1000))
+        with cls._lock:
+            cls._local.pop(key, None)
+            cls._local[key] = (html, expires, link_versions)
+            while len(cls._local) > size:
+                cls._local.popitem(last=False)
@@ -6,14 +6,16 @@
 
 import pymongo
 from pylons import c, g
+from tg import config
+from paste.deploy.converters import asint
 
 import ming
 from ming.utils import LazyProperty
 from ming import schema as S
-from ming.orm import session, FieldProperty
+from ming.orm import session, mapper, FieldProperty
 from ming.orm.declarative import MappedClass
 
-from .session import main_orm_session
+from .session import main_doc_session, main_orm_session
 
 log = logging.getLogger(__name__)
 
@@ -36,6 +38,8 @@ class MonQTask(MappedClass):
         - args - *args to be sent to the task function
         - kwargs - **kwargs to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - coalesce_key - if set, tasks posted later with the same key merge
+          their first argument into this one while it is still ready
     '''
     states = ('ready', 'busy', 'error', 'complete')
     result_types = ('keep', 'forget')
@@ -55,6 +59,10 @@ class __mongometa__:
                 # have an index on task_name
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used by MonQTask.post() to find a task to coalesce into
+                'coalesce_key', 'state', 'task_name'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -74,6 +82,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None:None})
     result = FieldProperty(None, if_missing=None)
+    coalesce_key = FieldProperty(str, if_missing=None)
 
     def __repr__(self):
         from allura import model as M
@@ -111,8 +120,18 @@ def post(cls,
              args=None,
              kwargs=None,
              result_type='forget',
-             priority=10):
-        '''Create a new task object based on the current context.'''
+             priority=10,
+             coalesce_key=None):
+        '''Create a new task object based on the current context.
+
+        If coalesce_key is given, the first positional argument must be a list
+        (e.g. of artifact reference ids).  If a ready task with the same
+        function, context and coalesce_key already exists and is not over the
+        monq.coalesce_limit size, the list is appended to that task's first
+        argument and the existing task is returned instead of creating a new
+        one.  Callers must ensure that tasks sharing a coalesce_key differ
+        only in that first argument.
+        '''
         if args is None: args = ()
         if kwargs is None: kwargs = {}
         task_name = '%s.%s' % (
@@ -128,6 +147,10 @@ def post(cls,
             context['app_config_id']=c.app.config._id
         if getattr(c, 'user', None):
             context['user_id']=c.user._id
+        if coalesce_key is not None:
+            obj = cls._coalesce(task_name, context, coalesce_key, list(args[0]))
+            if obj is not None:
+                return obj
         obj = cls(
             state='ready',
             priority=priority,
@@ -137,15 +160,49 @@ def post(cls,
             kwargs=kwargs,
             process=None,
             result=None,
-            context=context)
+            context=context,
+            coalesce_key=coalesce_key)
         session(obj).flush(obj)
         try:
             if g.amq_conn:
                 g.amq_conn.queue.put('')
         except:
             log.warning('Error putting to amq_conn', exc_info=True)
+        try:
+            if MonQWakeup.enabled():
+                MonQWakeup.notify(obj)
+        except:
+            log.warning('Error notifying task wakeup collection', exc_info=True)
         return obj
 
+    @classmethod
+    def _coalesce(cls, task_name, context, coalesce_key, items):
+        '''Atomically append items to the first argument of a matching ready
+        task.  Returns the task, or None if there is no task to merge into.'''
+        limit = asint(config.get('monq.coalesce_limit', 1000))
+        if not items or len(items) >= limit:
+            return None
+        query = {
+            'state': 'ready',
+            'task_name': task_name,
+            'coalesce_key': coalesce_key,
+            'context.project_id': context['project_id'],
+            'context.app_config_id': context['app_config_id'],
+            # the task runs as the user who posted it
+            'context.user_id': context['user_id'],
+            # only merge while the result stays within limit items
+            'args.0.%d' % (limit - len(items)): {'$exists': False},
+            }
+        try:
+            return cls.query.find_and_modify(
+                query=query,
+                update={'$pushAll': {'args.0': items}},
+                new=True)
+        except pymongo.errors.OperationFailure, exc:
+            if 'No matching object found' not in exc.args[0]:
+                raise
+        return None
+
     @classmethod
     def get(cls, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
@@ -180,6 +237,43 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None, exclude=
                 return None
             waitfunc()
 
+    @classmethod
+    def get_many(cls, limit, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
+        '''Get up to limit of the highest-priority, oldest, ready tasks and
+        lock them to the current process.  The candidates are claimed with a
+        single multi-update rather than one find_and_modify per task, so the
+        process name must be unique to the caller.  Tasks that another process
+        claimed in the meantime are simply not returned.  If no tasks are
+        available, waitfunc is handled as in get().
+        '''
+        sort = [
+                ('priority', ming.DESCENDING),
+                ('time_queue', ming.ASCENDING)]
+        collection = main_doc_session.db[mapper(cls).collection.m.collection_name]
+        while True:
+            query = dict(state=state)
+            if exclude:
+                query['task_name'] = {'$nin': exclude}
+            if only:
+                query['task_name'] = {'$in': only}
+            # Fetch just the candidate _ids with a direct pymongo query so
+            # that no partial objects end up in the ORM identity map
+            candidates = collection.find(query, {'_id': 1}).sort(sort).limit(limit)
+            ids = [ doc['_id'] for doc in candidates ]
+            if ids:
+                cls.query.update(
+                    {'_id': {'$in': ids}, 'state': state},
+                    {'$set': dict(state='busy', process=process)},
+                    multi=True)
+                claimed = cls.query.find({
+                        '_id': {'$in': ids},
+                        'state': 'busy',
+                        'process': process}).sort(sort).all()
+                if claimed: return claimed
+            if waitfunc is None:
+                return []
+            waitfunc()
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
@@ -256,3 +350,89 @@ def list(cls, state='ready'):
         '''Print all tasks of a certain status to sys.stdout.  Used for debugging.'''
         for t in cls.query.find(dict(state=state)):
             sys.stdout.write('%r\n' % t)
+
+
+class MonQWakeup(object):
+    '''Wake idle taskd workers as soon as a task is posted, using only
+    MongoDB.  Enabled by setting monq.wakeup = tail in the config.
+
+    MonQTask.post() inserts a small document into a capped collection, and
+    waiting workers tail that collection with an awaitData cursor, so they
+    return from wait() within milliseconds of a post instead of sleeping for
+    the whole monq.poll_interval.  Cursors are not thread safe, so each
+    worker thread needs its own MonQWakeup.
+    '''
+    collection_name = 'monq_task_posted'
+    _collection = None
+
+    def __init__(self):
+        self.cursor = None
+        self.last_id = None
+        self.skip_to = None
+
+    @classmethod
+    def enabled(cls):
+        return config.get('monq.wakeup') == 'tail'
+
+    @classmethod
+    def collection(cls):
+        if cls._collection is None:
+            db = main_doc_session.db
+            if cls.collection_name not in db.collection_names():
+                try:
+                    db.create_collection(
+                        cls.collection_name, capped=True,
+                        size=asint(config.get('monq.wakeup.size', 1024 * 1024)))
+                    # a tailable cursor on an empty capped collection is
+                    # closed immediately, so keep one document in it
+                    db[cls.collection_name].insert(dict(task_id=None, task_name=None))
+                except pymongo.errors.CollectionInvalid:
+                    pass # another process created it first
+            cls._collection = db[cls.collection_name]
+        return cls._collection
+
+    @classmethod
+    def notify(cls, task):
+        cls.collection().insert(dict(task_id=task._id, task_name=task.task_name))
+
+    def wait(self, timeout):
+        '''Block until a task is posted or timeout seconds have passed.
+        Return True if a post woke us up, False on timeout.'''
+        collection = self.collection()
+        deadline = time.time() + timeout
+        if self.last_id is None:
+            for doc in collection.find().sort('$natural', pymongo.DESCENDING).limit(1):
+                self.last_id = doc['_id']
+        while time.time() < deadline:
+            if self.cursor is None or not self.cursor.alive:
+                # ObjectIds from different processes need not increase, so
+                # tail in natural (insertion) order from the start and skip
+                # up to the last document seen, unless it has been capped away
+                self.cursor = collection.find(tailable=True, await_data=True)
+                self.skip_to = self.last_id
+                if collection.find_one({'_id': self.last_id}) is None:
+                    self.skip_to = None
+            try:
+                doc = self.cursor.next()
+            except StopIteration:
+                # the server already blocked for a while awaiting data;
+                # only back off if the cursor was closed on us
+                if not self.cursor.alive:
+                    time.sleep(0.1)
+                continue
+            except pymongo.errors.OperationFailure:
+                # not a capped collection (e.g. it was dropped, and notify()
+                # recreated it): sleep like without wakeups, and look for
+                # the collection again next time
+                log.warning('Cannot tail %s', self.collection_name, exc_info=True)
+                self.cursor = None
+                MonQWakeup._collection = None
+                time.sleep(max(0, deadline - time.time()))
+                return False
+            if self.skip_to is not None:
+                if doc['_id'] == self.skip_to:
+                    self.skip_to = None
+                continue
+            self.last_id = doc['_id']
+            return True
+        return False
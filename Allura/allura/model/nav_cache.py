@@ -0,0 +1,131 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from tg import config
+from paste.deploy.converters import asbool, asint
+
+from ming import collection, Field
+from ming import schema as S
+
+from .session import main_doc_session
+
+log = logging.getLogger(__name__)
+
+# NavVersionDoc.version is bumped whenever the tools or subprojects of the
+# project NavVersionDoc._id change, see NavCache.invalidate.  parent_id and
+# parent_stamp are what the navigation of its parent last showed of the
+# project, see NavCache.project_changed
+NavVersionDoc = collection(
+    'project_nav_version', main_doc_session,
+    Field('_id', S.ObjectId),
+    Field('version', int, if_missing=0),
+    Field('parent_id', S.ObjectId, if_missing=None),
+    Field('parent_stamp', str, if_missing=None))
+
+class NavCache(object):
+    '''Project navigation (Project.sitemap and Project.menus), kept in a
+    small LRU cache in each process.  Enabled by nav_cache.enabled = true in
+    the config.
+
+    Entries are keyed by Project.nav_key: the project's nav version, which
+    changes when a tool is installed, removed, reordered or has its
+    permissions changed, or a subproject changes (see invalidate), plus the
+    project's own ACLs and the roles of the viewer.  Versions live in
+    MongoDB, so a change made in one process is seen by all of them.
+
+    Hit/miss counters are kept per process in NavCache.stats; each miss is a
+    rebuild of a project's navigation.
+    '''
+
+    stats = dict(hits=0, misses=0)
+    _local = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('nav_cache.enabled', False))
+
+    @classmethod
+    def versions(cls, project_ids):
+        '''Return a dict[project_id] = nav version, efficiently'''
+        result = dict((pid, 0) for pid in project_ids)
+        for doc in NavVersionDoc.m.find({'_id': {'$in': list(project_ids)}}):
+            result[doc._id] = doc.version
+        return result
+
+    @classmethod
+    def invalidate(cls, *project_ids):
+        '''Bump the nav versions of the projects, so that their cached
+        navigation is rebuilt'''
+        for pid in project_ids:
+            if pid is None: continue
+            NavVersionDoc.m.update_partial(
+                {'_id': pid}, {'$inc': {'version': 1}}, upsert=True)
+
+    @classmethod
+    def project_changed(cls, project_id, parent_id, stamp):
+        '''Bump the nav version of the parent of a saved project, and of its
+        previous parent, unless the project still shows the same (stamp) in
+        the same parent's navigation'''
+        doc = NavVersionDoc.m.get(_id=project_id)
+        if doc is not None and doc.parent_id == parent_id \
+                and doc.parent_stamp == stamp:
+            return
+        NavVersionDoc.m.update_partial(
+            {'_id': project_id},
+            {'$set': dict(parent_id=parent_id, parent_stamp=stamp)},
+            upsert=True)
+        cls.invalidate(parent_id)
+        if doc is not None and doc.parent_id != parent_id:
+            cls.invalidate(doc.parent_id)
+
+    @classmethod
+    def get(cls, key):
+        '''Return a fresh list of the SitemapEntries cached under key, or
+        None if there are none'''
+        with cls._lock:
+            entries = cls._local.pop(key, None)
+            if entries is None:
+                cls.stats['misses'] += 1
+                return None
+            cls._local[key] = entries
+            cls.stats['hits'] += 1
+        return [ cls._thaw(e) for e in entries ]
+
+    @classmethod
+    def put(cls, key, entries):
+        entries = tuple(cls._freeze(e) for e in entries)
+        size = asint(config.get('nav_cache.local_size', 10000))
+        with cls._lock:
+            cls._local.pop(key, None)
+            cls._local[key] = entries
+            while len(cls._local) > size:
+                cls._local.popitem(last=False)
+
+    @classmethod
+    def rebuild_rate(cls):
+        total = cls.stats['hits'] + cls.stats['misses']
+        if not total:
+            return None
+        return float(cls.stats['misses']) / total
+
+    @classmethod
+    def clear_local(cls):
+        with cls._lock:
+            cls._local.clear()
+
+    @classmethod
+    def _freeze(cls, entry):
+        return (entry.label, entry.url, entry.className, entry.ui_icon,
+                entry.small, tuple(cls._freeze(ch) for ch in entry.children))
+
+    @classmethod
+    def _thaw(cls, frozen):
+        from allura.app import SitemapEntry
+        label, url, className, ui_icon, small, children = frozen
+        entry = SitemapEntry(
+            label, None, [ cls._thaw(ch) for ch in children ],
+            className=className, ui_icon=ui_icon, small=small)
+        entry.url = url # already encoded
+        return entry
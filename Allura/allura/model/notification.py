@@ -16,6 +16,7 @@
 '''
 
 import logging
+import time
 from bson import ObjectId
 from datetime import datetime, timedelta
 from collections import defaultdict
@@ -41,6 +42,11 @@
 log = logging.getLogger(__name__)
 
 MAILBOX_QUIESCENT=None # Re-enable with [#1384]: timedelta(minutes=10)
+# users to send one email to at most in a mail task, which the SMTP client
+# splits further into transactions of smtp_max_recipients
+MAX_DESTINATIONS=1000
+# direct mailboxes to claim before sending their notifications together
+FIRE_BATCH_SIZE=1000
 
 class Notification(MappedClass):
     '''
@@ -206,54 +212,86 @@ def send_simple(self, toaddr):
             text=(self.text or '') + self.footer())
 
     def send_direct(self, user_id):
-        user = User.query.get(_id=ObjectId(user_id))
-        artifact = self.ref.artifact
-        # Don't send if user doesn't have read perms to the artifact
-        if user and artifact and \
-                not security.has_access(artifact, 'read', user)():
-            log.debug("Skipping notification - User %s doesn't have read "
-                      "access to artifact %s" % (user_id, str(self.ref_id)))
-            return
-        allura.tasks.mail_tasks.sendmail.post(
-            destinations=[str(user_id)],
-            fromaddr=self.from_address,
-            reply_to=self.reply_to_address,
-            subject=self.subject,
-            message_id=self._id,
-            in_reply_to=self.in_reply_to,
-            text=(self.text or '') + self.footer())
+        self.send_direct_many([ user_id ])
+
+    def send_direct_many(self, user_ids):
+        '''Email the notification to those of user_ids who may read its
+        artifact, rendering it once for all of them'''
+        for ns, readers in self.group_readers([ self ], user_ids).iteritems():
+            if not ns: continue
+            self.sendmail(
+                readers,
+                fromaddr=self.from_address,
+                reply_to=self.reply_to_address,
+                subject=self.subject,
+                message_id=self._id,
+                in_reply_to=self.in_reply_to,
+                text=(self.text or '') + self.footer())
 
     @classmethod
-    def send_digest(self, user_id, from_address, subject, notifications,
+    def send_digest(cls, user_id, from_address, subject, notifications,
                     reply_to_address=None):
-        if not notifications: return
-        # Filter out notifications for which the user doesn't have read
-        # permissions to the artifact.
-        user = User.query.get(_id=ObjectId(user_id))
-        artifact = self.ref.artifact
-        def perm_check(notification):
-            return not (user and artifact) or \
-                    security.has_access(artifact, 'read', user)()
-        notifications = filter(perm_check, notifications)
+        cls.send_digest_many(
+            [ user_id ], from_address, subject, notifications,
+            reply_to_address)
 
+    @classmethod
+    def send_digest_many(cls, user_ids, from_address, subject, notifications,
+                         reply_to_address=None):
+        '''Email a digest of notifications to user_ids, each digest made of
+        the notifications its users may read'''
+        if not notifications: return
         if reply_to_address is None:
             reply_to_address = from_address
-        text = [ 'Digest of %s' % subject ]
+        groups = cls.group_readers(notifications, user_ids)
+        for ns, readers in groups.iteritems():
+            if not ns: continue
+            text = [ 'Digest of %s' % subject ]
+            for n in ns:
+                text.append('From: %s' % n.from_address)
+                text.append('Subject: %s' % (n.subject or '(no subject)'))
+                text.append('Message-ID: %s' % n._id)
+                text.append('')
+                text.append(n.text or '-no text-')
+            text.append(n.footer())
+            text = '\n'.join(text)
+            cls.sendmail(
+                readers,
+                fromaddr=from_address,
+                reply_to=reply_to_address,
+                subject=subject,
+                message_id=h.gen_message_id(),
+                text=text)
+
+    @classmethod
+    def group_readers(cls, notifications, user_ids):
+        '''Group user_ids by the notifications whose artifacts they may
+        read: { tuple of notifications: [ user_id ] }'''
+        users = User.query.find(dict(
+                _id={'$in': [ ObjectId(str(uid)) for uid in user_ids ]}))
+        users = dict((str(u._id), u) for u in users)
+        readers = []
         for n in notifications:
-            text.append('From: %s' % n.from_address)
-            text.append('Subject: %s' % (n.subject or '(no subject)'))
-            text.append('Message-ID: %s' % n._id)
-            text.append('')
-            text.append(n.text or '-no text-')
-        text.append(n.footer())
-        text = '\n'.join(text)
-        allura.tasks.mail_tasks.sendmail.post(
-            destinations=[str(user_id)],
-            fromaddr=from_address,
-            reply_to=reply_to_address,
-            subject=subject,
-            message_id=h.gen_message_id(),
-            text=text)
+            artifact = n.ref and n.ref.artifact
+            readers.append(set(
+                    uid for uid in users
+                    if artifact is None or
+                    security.has_access(artifact, 'read', users[uid])()))
+        groups = defaultdict(list)
+        for uid in user_ids:
+            uid = str(uid)
+            key = tuple(
+                n for n, r in zip(notifications, readers)
+                if uid not in users or uid in r)
+            groups[key].append(uid)
+        return groups
+
+    @classmethod
+    def sendmail(cls, destinations, **kw):
+        '''Post the mail tasks to send an email to destinations'''
+        for i in range(0, len(destinations), MAX_DESTINATIONS):
+            allura.tasks.mail_tasks.sendmail.post(
+                destinations=destinations[i:i + MAX_DESTINATIONS], **kw)
 
     @classmethod
     def send_summary(self, user_id, from_address, subject, notifications):
@@ -323,6 +361,10 @@ class __mongometa__:
     project = RelationProperty('Project')
     app_config = RelationProperty('AppConfig')
 
+    # Counters of this process: notifications delivered to mailboxes, and
+    # mailboxes fired, with the seconds spent doing so
+    stats = dict(delivered=0, deliver_time=0.0, fired=0, fire_time=0.0)
+
     @classmethod
     def subscribe(
         cls,
@@ -419,20 +461,23 @@ def deliver(cls, nid, artifact_index_id, topic):
         to the appropriate mailboxes.  Atomically appends the nids
         to the appropriate mailboxes.
         '''
+        begin = time.time()
         d = {
             'project_id':c.project._id,
             'app_config_id':c.app.config._id,
             'artifact_index_id':{'$in':[None, artifact_index_id]},
             'topic':{'$in':[None, topic]}
             }
-        for mbox in cls.query.find(d):
-            mbox.query.update(
-                {'$push':dict(queue=nid),
-                 '$set':dict(last_modified=datetime.utcnow(),
-                             queue_empty=False),
-                })
-            # Make sure the mbox doesn't stick around to be flush()ed
-            session(mbox).expunge(mbox)
+        n = cls.query.find(d).count()
+        if n:
+            cls.query.update(d, {
+                    '$push':dict(queue=nid),
+                    '$set':dict(last_modified=datetime.utcnow(),
+                                queue_empty=False),
+                    }, multi=True)
+        cls.stats['delivered'] += n
+        cls.stats['deliver_time'] += time.time() - begin
+        log.debug('Delivered %s to %d mailboxes', nid, n)
 
     @classmethod
     def fire_ready(cls):
@@ -461,8 +506,17 @@ def find_and_modify_direct_mbox():
                         )},
                 new=False)
 
-        for mbox in take_while_true(find_and_modify_direct_mbox):
-            mbox.fire(now)
+        # Mailboxes with the same queue get the same emails, so send those
+        # once for all of them
+        direct = defaultdict(list)
+        for i, mbox in enumerate(take_while_true(find_and_modify_direct_mbox)):
+            direct[tuple(mbox.queue)].append(mbox)
+            if (i + 1) % FIRE_BATCH_SIZE == 0:
+                for mboxes in direct.itervalues():
+                    cls.fire_direct(mboxes)
+                direct.clear()
+        for mboxes in direct.itervalues():
+            cls.fire_direct(mboxes)
 
         for mbox in cls.query.find(q_digest):
             next_scheduled = now
@@ -486,26 +540,13 @@ def fire(self, now):
         '''
         Send all notifications that this mailbox has enqueued.
         '''
+        if self.type == 'direct':
+            self.fire_direct([ self ])
+            return
+        begin = time.time()
         notifications = Notification.query.find(dict(_id={'$in':self.queue}))
         notifications = notifications.all()
-        if self.type == 'direct':
-            ngroups = defaultdict(list)
-            for n in notifications:
-                if n.topic == 'message':
-                    n.send_direct(self.user_id)
-                    # Messages must be sent individually so they can be replied
-                    # to individually
-                else:
-                    key = (n.subject, n.from_address, n.reply_to_address, n.author_id)
-                    ngroups[key].append(n)
-            # Accumulate messages from same address with same subject
-            for (subject, from_address, reply_to_address, author_id), ns in ngroups.iteritems():
-                if len(ns) == 1:
-                    n.send_direct(self.user_id)
-                else:
-                    Notification.send_digest(
-                        self.user_id, from_address, subject, ns, reply_to_address)
-        elif self.type == 'digest':
+        if self.type == 'digest':
             Notification.send_digest(
                 self.user_id, u'noreply@in.sf.net', 'Digest Email',
                 notifications)
@@ -513,3 +554,48 @@ def fire(self, now):
             Notification.send_summary(
                 self.user_id, u'noreply@in.sf.net', 'Digest Email',
                 notifications)
+        self.count_fired(1, begin)
+
+    @classmethod
+    def fire_direct(cls, mboxes):
+        '''
+        Send the notifications enqueued in direct mailboxes mboxes, which
+        all have the same queue, rendering each email once for all of them.
+        '''
+        begin = time.time()
+        user_ids = [ mbox.user_id for mbox in mboxes ]
+        notifications = Notification.query.find(
+            dict(_id={'$in':mboxes[0].queue})).all()
+        ngroups = defaultdict(list)
+        for n in notifications:
+            if n.topic == 'message':
+                n.send_direct_many(user_ids)
+                # Messages must be sent individually so they can be replied
+                # to individually
+            else:
+                key = (n.subject, n.from_address, n.reply_to_address, n.author_id)
+                ngroups[key].append(n)
+        # Accumulate messages from same address with same subject
+        for (subject, from_address, reply_to_address, author_id), ns in ngroups.iteritems():
+            if len(ns) == 1:
+                ns[0].send_direct_many(user_ids)
+            else:
+                Notification.send_digest_many(
+                    user_ids, from_address, subject, ns, reply_to_address)
+        cls.count_fired(len(mboxes), begin)
+
+    @classmethod
+    def count_fired(cls, n, begin):
+        cls.stats['fired'] += n
+        cls.stats['fire_time'] += time.time() - begin
+
+    @classmethod
+    def rates(cls):
+        '''Notifications delivered to mailboxes, and mailboxes fired, per
+        second spent doing so in this process'''
+        def rate(n, seconds):
+            if not seconds: return None
+            return n / seconds
+        return dict(
+            delivered=rate(cls.stats['delivered'], cls.stats['deliver_time']),
+            fired=rate(cls.stats['fired'], cls.stats['fire_time']))
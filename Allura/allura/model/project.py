@@ -1,4 +1,5 @@
 import logging
+import hashlib
 from datetime import datetime
 
 from tg import config
@@ -21,6 +22,8 @@
 from .session import project_orm_session, project_doc_session
 from .neighborhood import Neighborhood
 from .auth import ProjectRole
+from .nav_cache import NavCache
+from .markdown_cache import MarkdownCache
 from .timeline import ActivityNode, ActivityObject
 from .types import ACL, ACE
 
@@ -96,8 +99,23 @@ def type(self):
         return trove.shortname
 
 class ProjectMapperExtension(MapperExtension):
+    # Most project saves (last_updated is set by every artifact change) leave
+    # the navigation of the parent alone, see NavCache.project_changed
     def after_insert(self, obj, st, sess):
+        from .project_directory import ProjectDirectory
         g.zarkov_event('project_create', project=obj)
+        NavCache.project_changed(obj._id, obj.parent_id, obj.parent_nav_stamp())
+        ProjectDirectory.update(obj)
+
+    def after_update(self, obj, st, sess):
+        from .project_directory import ProjectDirectory
+        NavCache.project_changed(obj._id, obj.parent_id, obj.parent_nav_stamp())
+        ProjectDirectory.update(obj)
+
+    def after_delete(self, obj, st, sess):
+        from .project_directory import ProjectDirectory
+        NavCache.invalidate(obj.parent_id)
+        ProjectDirectory.remove(obj)
 
 class Project(MappedClass, ActivityNode, ActivityObject):
     _perms_base = [ 'read', 'update', 'admin', 'create']
@@ -327,7 +345,19 @@ def roleids_with_permission(self, name):
     def menus(cls, projects):
         '''Return a dict[project_id] = sitemap of sitemaps, efficiently'''
         from allura.app import SitemapEntry
+        cached = {}
+        keys = {}
+        if NavCache.enabled():
+            versions = NavCache.versions([ p._id for p in projects ])
+            for p in projects:
+                keys[p._id] = p.nav_key('menus', versions[p._id])
+                entries = NavCache.get(keys[p._id])
+                if entries is not None:
+                    cached[p._id] = entries
+            projects = [ p for p in projects if p._id not in cached ]
         pids = [ p._id for p in projects ]
+        if not pids:
+            return cached
         project_index = dict((p._id, p) for p in projects)
         entry_index = dict((pid, []) for pid in pids)
         q_subprojects = cls.query.find(dict(
@@ -355,6 +385,9 @@ def menus(cls, projects):
             sitemap = sitemaps[pid]
             for e in entries:
                 sitemap.append(e['entry'])
+            if pid in keys:
+                NavCache.put(keys[pid], sitemap)
+        sitemaps.update(cached)
         return sitemaps
 
     @classmethod
@@ -378,12 +411,52 @@ def accolades_index(cls, projects):
             result[award.granted_to_project_id].append(award)
         return result
 
+    def parent_nav_stamp(self):
+        '''Digest of the fields that the navigation of the parent project
+        shows this project by'''
+        return hashlib.sha1(repr((
+                    self.name, self.shortname, self.deleted, self.ordinal,
+                    security.acl_stamp(self.acl)))).hexdigest()
+
+    def nav_key(self, kind, version, *extra):
+        """Return the key of this project's navigation for c.user in the
+        NavCache, given its nav version.
+
+        Besides the version, the navigation depends on the ACLs that apps'
+        visibility chains to, and on the user's roles in the project and in
+        its neighborhood.
+        """
+        cred = security.Credentials.get()
+        roles = cred.user_roles(
+            user_id=c.user._id, project_id=self.root_project._id).reaching_ids
+        nbhd_project = self.neighborhood.neighborhood_project
+        if nbhd_project is None:
+            nbhd_roles = []
+        else:
+            nbhd_roles = cred.user_roles(
+                user_id=c.user._id, project_id=nbhd_project._id).reaching_ids
+        return (kind, self._id, version, self.url(),
+                security.acl_stamp(self.neighborhood.acl),
+                tuple(security.acl_stamp(p.acl) for p in self.parent_iter()),
+                tuple(sorted(roles)), tuple(sorted(nbhd_roles))) + extra
+
     def sitemap(self, excluded_tools=None):
         """Return the project sitemap.
 
         :param list excluded_tools: tool names (AppConfig.tool_name) to
                                     exclude from sitemap
         """
+        if not NavCache.enabled():
+            return self._build_sitemap(excluded_tools)
+        version = NavCache.versions([self._id])[self._id]
+        key = self.nav_key('sitemap', version, tuple(sorted(excluded_tools or ())))
+        entries = NavCache.get(key)
+        if entries is None:
+            entries = self._build_sitemap(excluded_tools)
+            NavCache.put(key, entries)
+        return entries
+
+    def _build_sitemap(self, excluded_tools=None):
         from allura.app import SitemapEntry
         entries = []
 
@@ -665,6 +738,20 @@ def add_user(self, user, role_names):
             r = ProjectRole.by_name(role_name, self)
             pr.roles.append(r._id)
 
+class AppConfigMapperExtension(MapperExtension):
+    # Shortlinks only resolve into installed tools, by mount point
+    def after_insert(self, obj, st, sess):
+        NavCache.invalidate(obj.project_id)
+        MarkdownCache.invalidate_links(obj.project_id)
+
+    def after_update(self, obj, st, sess):
+        NavCache.invalidate(obj.project_id)
+        MarkdownCache.invalidate_links(obj.project_id)
+
+    def after_delete(self, obj, st, sess):
+        NavCache.invalidate(obj.project_id)
+        MarkdownCache.invalidate_links(obj.project_id)
+
 class AppConfig(MappedClass):
     """
     Configuration information for an instantiated :class:`Application <allura.app.Application>`
@@ -681,6 +768,7 @@ class __mongometa__:
             'project_id',
             'options.import_id',
             ('options.mount_point', 'project_id')]
+        extensions = [ AppConfigMapperExtension ]
 
     # AppConfig schema
     _id=FieldProperty(S.ObjectId)
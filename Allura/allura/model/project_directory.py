@@ -0,0 +1,225 @@
+import logging
+import random
+from hashlib import md5
+
+import pymongo
+from bson import ObjectId
+from pylons import c
+
+from ming import collection, Field, Index
+from ming import schema as S
+from ming.orm import mapper
+
+from allura.lib import utils
+from allura.lib.security import has_access
+
+from .session import main_doc_session
+from .project import Project
+from .auth import ProjectRole
+from .types import ACE
+
+log = logging.getLogger(__name__)
+
+# One entry per listed project (not deleted, and not a neighborhood project),
+# with what the projects macro filters and sorts on.  ProjectDirectoryDoc._id
+# is the project's _id.
+ProjectDirectoryDoc = collection(
+    'project_directory', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('neighborhood_id', S.ObjectId()),
+    Field('name', str),
+    Field('last_updated', S.DateTime(if_missing=None)),
+    Field('labels', [str]),
+    Field('troves', [S.ObjectId()]), # of every trove type
+    Field('awards', [S.ObjectId()]),
+    Field('private', bool),
+    Field('rand', float), # fixed random sort key, for sampling
+    Field('rebuild_id', S.ObjectId(if_missing=None)), # of the last rebuild
+    Index('neighborhood_id', 'last_updated'),
+    Index('neighborhood_id', 'name'),
+    Index('neighborhood_id', 'rand'),
+    Index('neighborhood_id', 'private'),
+    Index('labels'),
+    Index('troves'),
+    Index('awards'),
+)
+
+TROVE_TYPES = ('root_database', 'developmentstatus', 'audience', 'license',
+               'os', 'language', 'topic', 'natlanguage', 'environment')
+
+class ProjectDirectory(object):
+    '''The index of projects that the projects macro queries, so that it
+    can filter, sort, sample and count them without loading them all.
+
+    Entries are kept up to date by the mapper extensions of Project (see
+    update) and AwardGrant (see update_awards), and can be rebuilt from
+    scratch with the rebuild-project-directory command.  Queries use the
+    field names of Project (neighborhood_id, labels, _id), plus troves for
+    the trove_* fields and awards for the ids of the awards granted.
+    '''
+
+    # _id of the anonymous role that decides whether a project is private,
+    # by project _id
+    _anonymous_roles = {}
+
+    @classmethod
+    def entry(cls, project):
+        '''Return the fields of the entry of project, or None if it is not
+        listed'''
+        if project.deleted or project.is_nbhd_project:
+            return None
+        troves = []
+        for trove_type in TROVE_TYPES:
+            troves += getattr(project, 'trove_' + trove_type) or []
+        return dict(
+            neighborhood_id=project.neighborhood_id,
+            name=project.name,
+            last_updated=project.last_updated,
+            labels=list(project.labels or []),
+            troves=troves,
+            private=cls._private(project),
+            rand=cls.rand(project._id))
+
+    @classmethod
+    def update(cls, project):
+        '''Add, update or remove the entry of project, except for its
+        awards'''
+        fields = cls.entry(project)
+        if fields is None:
+            ProjectDirectoryDoc.m.remove({'_id': project._id})
+        else:
+            ProjectDirectoryDoc.m.update_partial(
+                {'_id': project._id}, {'$set': fields}, upsert=True)
+
+    @classmethod
+    def remove(cls, project):
+        ProjectDirectoryDoc.m.remove({'_id': project._id})
+
+    @classmethod
+    def update_awards(cls, project_id):
+        '''Set the awards of the entry of project_id from its grants'''
+        ProjectDirectoryDoc.m.update_partial(
+            {'_id': project_id},
+            {'$set': {'awards': cls._awards([project_id])[project_id]}})
+
+    @classmethod
+    def rebuild(cls, neighborhood_id=None):
+        '''Rebuild the entries of all projects, or of those in one
+        neighborhood, and return how many are listed.  Entries are
+        overwritten in place, and the ones the rebuild didn't write are
+        removed at the end, so that the directory stays complete meanwhile.'''
+        q = {}
+        if neighborhood_id is not None:
+            q['neighborhood_id'] = neighborhood_id
+        # also tells the projects created since the rebuild started
+        rebuild_id = ObjectId()
+        count = 0
+        for projects in utils.chunked_find(Project, q):
+            awards = cls._awards([ p._id for p in projects ])
+            for p in projects:
+                fields = cls.entry(p)
+                if fields is None:
+                    ProjectDirectoryDoc.m.remove({'_id': p._id})
+                    continue
+                ProjectDirectoryDoc.m.update_partial(
+                    {'_id': p._id},
+                    {'$set': dict(fields, awards=awards[p._id],
+                                  rebuild_id=rebuild_id)},
+                    upsert=True)
+                count += 1
+        ProjectDirectoryDoc.m.remove(dict(
+                q, rebuild_id={'$ne': rebuild_id}, _id={'$lt': rebuild_id}))
+        return count
+
+    @classmethod
+    def find(cls, q, sort_key='last_updated', sort_dir=pymongo.DESCENDING,
+             limit=100):
+        '''Return the ids of the first limit projects matching q'''
+        cursor = ProjectDirectoryDoc.m.find(q, {'_id': 1}, validate=False)
+        return [ doc['_id'] for doc in
+                 cursor.sort(sort_key, sort_dir).limit(limit) ]
+
+    @classmethod
+    def sample(cls, q, limit=100):
+        '''Return the ids of up to limit projects matching q, picked at
+        random: the run of them that follows a random point in the order of
+        their random sort keys'''
+        rand = random.random()
+        docs = list(ProjectDirectoryDoc.m.find(
+                dict(q, rand={'$gte': rand}), {'_id': 1}, validate=False)
+                    .sort('rand', pymongo.ASCENDING).limit(limit))
+        if len(docs) < limit:
+            docs += ProjectDirectoryDoc.m.find(
+                dict(q, rand={'$lt': rand}), {'_id': 1}, validate=False) \
+                .sort('rand', pymongo.ASCENDING).limit(limit - len(docs))
+        return [ doc['_id'] for doc in docs ]
+
+    @classmethod
+    def count(cls, q):
+        return ProjectDirectoryDoc.m.find(q).count()
+
+    @classmethod
+    def count_readable(cls, q, user=None):
+        '''Return how many projects matching q the user can read: all the
+        public ones, and the private ones that they have access to'''
+        if user is None: user = c.user
+        total = cls.count(dict(q, private=False))
+        private_ids = [ doc['_id'] for doc in ProjectDirectoryDoc.m.find(
+                dict(q, private=True), {'_id': 1}, validate=False) ]
+        if private_ids:
+            for p in Project.query.find({'_id': {'$in': private_ids}}):
+                if has_access(p, 'read', user=user)():
+                    total += 1
+        return total
+
+    @classmethod
+    def projects(cls, ids):
+        '''Return the projects with the ids, in the same order'''
+        index = dict((p._id, p) for p in Project.query.find({'_id': {'$in': ids}}))
+        return [ index[pid] for pid in ids if pid in index ]
+
+    @staticmethod
+    def rand(project_id):
+        '''A random sort key for project_id that stays the same'''
+        return int(md5(str(project_id)).hexdigest()[:12], 16) / float(16 ** 12)
+
+    @classmethod
+    def _private(cls, project):
+        '''Like project.private, with the anonymous role of the project
+        looked up once per process'''
+        role_id = cls._anonymous_roles.get(project._id)
+        if role_id is None:
+            role_id = cls._anonymous_role_id(project)
+            if role_id is None:
+                # not set up yet
+                return True
+            cls._anonymous_roles[project._id] = role_id
+        return ACE.allow(role_id, 'read') not in project.acl
+
+    @classmethod
+    def _anonymous_role_id(cls, project):
+        # Documents rather than objects, as this runs while the ORM session
+        # is flushing
+        projects = mapper(Project).collection.m
+        root_id, parent_id = project._id, project.parent_id
+        while not project.is_root and parent_id:
+            doc = projects.get(_id=parent_id)
+            if doc is None: return None
+            root_id, parent_id = doc['_id'], doc.get('parent_id')
+            if doc.get('is_root'): break
+        role = mapper(ProjectRole).collection.m.get(
+            project_id=root_id, name='*anonymous')
+        return role and role._id
+
+    @classmethod
+    def _awards(cls, project_ids):
+        '''Return a dict[project_id] = ids of the awards granted to it'''
+        from .artifact import AwardGrant
+        result = dict((pid, []) for pid in project_ids)
+        for grant in mapper(AwardGrant).collection.m.find(
+                {'granted_to_project_id': {'$in': project_ids}},
+                {'granted_to_project_id': 1, 'award_id': 1}, validate=False):
+            awards = result[grant['granted_to_project_id']]
+            if grant.get('award_id') and grant['award_id'] not in awards:
+                awards.append(grant['award_id'])
+        return result
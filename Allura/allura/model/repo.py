@@ -1,14 +1,19 @@
 import os
 import re
 import sys
+import heapq
 import logging
+import threading
+from array import array
 from hashlib import sha1
 from itertools import izip, chain
+from bisect import bisect_left, bisect_right
 from datetime import datetime
 from collections import defaultdict
 from difflib import SequenceMatcher, unified_diff
 
 from pylons import c
+import bson
 import pymongo.errors
 
 from ming import Field, collection
@@ -32,6 +37,10 @@
 
 # Used for when we're going to batch queries using $in
 QSIZE = 100
+# Commits per CommitGraphDoc
+GRAPH_CHUNKSIZE = 1000
+# Commit ids per RefreshCheckpointChunkDoc
+CHECKPOINT_CHUNKSIZE = 10000
 README_RE = re.compile('^README(\.[^.]*)?$', re.IGNORECASE)
 VIEWABLE_EXTENSIONS = ['.php','.py','.js','.java','.html','.htm','.yaml','.sh',
     '.rb','.phtml','.txt','.bat','.ps1','.xhtml','.css','.cfm','.jsp','.jspx',
@@ -63,19 +72,29 @@
 
 # Information about the last commit to touch a tree/blob
 # LastCommitDoc.object_id = TreeDoc._id
+SCommitInfo = dict(
+    id=str,
+    date=datetime,
+    author=str,
+    author_email=str,
+    author_url=str,
+    shortlink=str,
+    summary=str)
 LastCommitDoc = collection(
     'repo_last_commit', project_doc_session,
     Field('_id', str),
     Field('object_id', str, index=True),
     Field('name', str),
-    Field('commit_info', dict(
-        id=str,
-        date=datetime,
-        author=str,
-        author_email=str,
-        author_url=str,
-        shortlink=str,
-        summary=str)))
+    Field('commit_info', SCommitInfo))
+
+# Last commit info for every entry of a directory, so that Tree.ls() needs a
+# single read.  A directory with the same contents at the same path has the
+# same entries, so this is shared by all the commits that did not change it.
+# DirLastCommitDoc._id = dir_last_commit_id(repo_id, path, TreeDoc._id)
+DirLastCommitDoc = collection(
+    'repo_dir_last_commit', project_doc_session,
+    Field('_id', str),
+    Field('entries', [ dict(name=str, commit_info=SCommitInfo) ]))
 
 # List of all trees contained within a commit
 # TreesDoc._id = CommitDoc._id
@@ -103,6 +122,74 @@
     Field('commit_ids', [str], index=True),
     Field('commit_times', [datetime]))
 
+# Compact commit graph of a repository, used to answer log, count and
+# ancestry queries without walking CommitRunDocs.  Commits are numbered in
+# topological order (parents before children); position p lives at index
+# p % GRAPH_CHUNKSIZE of chunk p // GRAPH_CHUNKSIZE.  Parents are stored as
+# packed arrays of positions: parent_counts has one entry per commit and
+# parent_positions holds all the parents, in order.  times holds the commit
+# time of each commit in seconds since the epoch, lowered to that of its
+# earliest descendant if the clocks were off, and counts the number of
+# revisions in its history.  version changes when the graph is rebuilt, or
+# when chunks before the last one are rewritten.
+# CommitGraphDoc._id = '<repo_id>:<chunk>'
+CommitGraphDoc = collection(
+    'repo_commit_graph', main_doc_session,
+    Field('_id', str),
+    Field('repo_id', S.ObjectId(), index=True),
+    Field('chunk', int),
+    Field('version', S.ObjectId()),
+    Field('size', int),
+    Field('commit_ids', [str]),
+    Field('generations', S.Binary()),
+    Field('times', S.Binary()),
+    Field('counts', S.Binary()),
+    Field('parent_counts', S.Binary()),
+    Field('parent_positions', S.Binary()))
+
+# Layout of a repository's commit graph in the commit browser, chunked like
+# its CommitGraphDocs: the column of each commit, and for each of its parents
+# (in the order of CommitGraphDoc.parent_positions) the column its edge runs
+# in, as packed arrays.  width, lanes and free_since are the state of the
+# layout after the chunk (see CommitLayout), head the last commit laid out,
+# and version the CommitGraphDoc.version it was laid out from.
+# CommitLayoutDoc._id = '<repo_id>:<chunk>'
+CommitLayoutDoc = collection(
+    'repo_commit_layout', main_doc_session,
+    Field('_id', str),
+    Field('repo_id', S.ObjectId(), index=True),
+    Field('chunk', int),
+    Field('version', S.ObjectId()),
+    Field('size', int),
+    Field('head', str),
+    Field('width', int),
+    Field('columns', S.Binary()),
+    Field('edge_columns', S.Binary()),
+    Field('lanes', S.Binary()),
+    Field('free_since', S.Binary()))
+
+# Progress of an in-flight refresh_repo, so that an interrupted refresh can
+# resume where it stopped instead of starting over.  The commits it works on
+# are kept in RefreshCheckpointChunkDocs, as a large import can have too many
+# for one document; size is how many, or None while they are being written.
+# RefreshCheckpointDoc._id = Repository._id
+RefreshCheckpointDoc = collection(
+    'repo_refresh_checkpoint', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('all_commits', bool),
+    Field('size', int, if_missing=None),
+    Field('stage', str),
+    Field('position', int))
+
+# Commit ids of a RefreshCheckpointDoc, CHECKPOINT_CHUNKSIZE per chunk
+# RefreshCheckpointChunkDoc._id = '<repo_id>:<chunk>'
+RefreshCheckpointChunkDoc = collection(
+    'repo_refresh_checkpoint_chunk', main_doc_session,
+    Field('_id', str),
+    Field('repo_id', S.ObjectId(), index=True),
+    Field('chunk', int),
+    Field('commit_ids', [str]))
+
 class RepoObject(object):
 
     def __repr__(self): # pragma no cover
@@ -206,8 +293,21 @@ def link_text(self):
         '''
         return self.shorthand_id()
 
+    def commit_graph(self):
+        '''The CommitGraph for this commit's repo, if it includes this commit'''
+        if self.repo is None: return None
+        graph = CommitGraph.get(self.repo._id)
+        if self._id in graph: return graph
+        return None
+
     def log_iter(self, skip, count):
-        for oids in utils.chunked_iter(commitlog([self._id]), QSIZE):
+        graph = self.commit_graph()
+        if graph is not None:
+            oid_iter = graph.log(self._id, skip, count)
+            skip = 0
+        else:
+            oid_iter = commitlog([self._id])
+        for oids in utils.chunked_iter(oid_iter, QSIZE):
             oids = list(oids)
             commits = dict(
                 (ci._id, ci) for ci in self.query.find(dict(
@@ -229,6 +329,9 @@ def log(self, skip, count):
 
     def count_revisions(self):
         from .repo_refresh import CommitRunBuilder
+        graph = self.commit_graph()
+        if graph is not None:
+            return graph.count(self._id)
         result = 0
         # If there's no CommitRunDoc for this commit, the call to
         # commitlog() below will raise a KeyError. Repair the CommitRuns for
@@ -413,21 +516,13 @@ def readme(self):
         return None, None
 
     def ls(self):
-        # Load last commit info
-        id_re = re.compile("^{0}:{1}:".format(
-            self.repo._id,
-            re.escape(h.really_unicode(self.path()).encode('utf-8'))))
-        lc_index = dict(
-            (lc.name, lc.commit_info)
-            for lc in LastCommitDoc.m.find(dict(_id=id_re)))
-
-        # FIXME: Temporarily fall back to old, semi-broken lookup behavior until refresh is done
-        oids = [ x.id for x in chain(self.tree_ids, self.blob_ids, self.other_ids) ]
-        id_re = re.compile("^{0}:".format(self.repo._id))
-        lc_index.update(dict(
-            (lc.object_id, lc.commit_info)
-            for lc in LastCommitDoc.m.find(dict(_id=id_re, object_id={'$in': oids}))))
-        # /FIXME
+        # Load last commit info, materialized for the whole directory
+        lc_id = dir_last_commit_id(self.repo._id, self.path(), self._id)
+        doc = DirLastCommitDoc.m.get(_id=lc_id)
+        if doc is not None:
+            lc_index = dict((e.name, e.commit_info) for e in doc.entries)
+        else:
+            lc_index = self._last_commit_index(lc_id)
 
         results = []
         def _get_last_commit(name, oid):
@@ -465,6 +560,38 @@ def _get_last_commit(name, oid):
                     last_commit=_get_last_commit(x.name, x.id)))
         return results
 
+    def _last_commit_index(self, lc_id):
+        '''Look up last commit info per entry, for directories that have no
+        DirLastCommitDoc yet (e.g. SVN, where trees are computed on demand)'''
+        id_re = re.compile("^{0}:{1}:".format(
+            self.repo._id,
+            re.escape(h.really_unicode(self.path()).encode('utf-8'))))
+        lcs = LastCommitDoc.m.find(dict(_id=id_re)).all()
+        lc_index = dict((lc.name, lc.commit_info) for lc in lcs)
+        entries = list(chain(self.tree_ids, self.blob_ids, self.other_ids))
+        if all(x.name in lc_index for x in entries):
+            # Save it, so the next listing is a single read.  The
+            # LastCommitDocs of a path describe the newest commits, so only
+            # the tree at a head, with the same entries, may use them.
+            object_ids = dict((lc.name, lc.object_id) for lc in lcs)
+            head_ids = set(hd.object_id for hd in self.repo.heads)
+            at_head = self.commit is not None and self.commit._id in head_ids
+            if at_head and all(object_ids[x.name] == x.id for x in entries):
+                DirLastCommitDoc(dict(
+                        _id=lc_id,
+                        entries=[ dict(name=x.name, commit_info=lc_index[x.name])
+                                  for x in entries ])).m.save(safe=False)
+            return lc_index
+
+        # FIXME: Temporarily fall back to old, semi-broken lookup behavior until refresh is done
+        oids = [ x.id for x in entries ]
+        id_re = re.compile("^{0}:".format(self.repo._id))
+        lc_index.update(dict(
+            (lc.object_id, lc.commit_info)
+            for lc in LastCommitDoc.m.find(dict(_id=id_re, object_id={'$in': oids}))))
+        # /FIXME
+        return lc_index
+
     def path(self):
         if self.parent:
             assert self.parent is not self
@@ -596,6 +723,9 @@ def diff(cls, v0, v1):
         differ = SequenceMatcher(v0, v1)
         return differ.get_opcodes()
 
+def dir_last_commit_id(repo_id, path, tree_id):
+    return u'%s:%s:%s' % (repo_id, h.really_unicode(path), tree_id)
+
 mapper(Commit, CommitDoc, repository_orm_session)
 mapper(Tree, TreeDoc, repository_orm_session)
 
@@ -657,3 +787,547 @@ def _gen_ids(commit_ids, skip, limit):
             ci_children[ci_parent].add(oid)
 
     return _gen_ids(commit_ids, skip, limit)
+
+class CommitGraph(object):
+    '''In-memory view of a repository's CommitGraphDocs.
+
+    Instances are cached per process and replaced by a reloaded copy when
+    refresh_repo has appended commits, or by a fully loaded one when it has
+    stored a new version of the graph, so threads reading a graph never see
+    it change.  Answering "number of revisions" costs one small query for the
+    stored version and size, and "page N of the log" or "is A an ancestor of
+    B" only in-memory work proportional to the page or the commits between A
+    and B, with no per-commit queries.
+    '''
+    _cache = {}
+    _lock = threading.Lock()
+    cache_size = 50
+    # commits whose non-history is kept per graph, see _others()
+    others_cache_size = 100
+
+    def __init__(self, repo_id):
+        self.repo_id = repo_id
+        self.version = None
+        self.commit_ids = []
+        self.positions = {}
+        self.parents = []
+        self.generations = array('i')
+        # commit time (seconds since the epoch, see CommitGraphDoc) and
+        # number of revisions in the history of each commit
+        self.times = array('d')
+        self.counts = array('i')
+        # positions by commit time, oldest first (the date order), the rank
+        # of each position in it, and the positions without children
+        self.order = array('i')
+        self.ranks = array('i')
+        self.tips = set()
+        self._others_cache = {}
+
+    def __len__(self):
+        return len(self.commit_ids)
+
+    def __contains__(self, commit_id):
+        return commit_id in self.positions
+
+    @classmethod
+    def get(cls, repo_id):
+        '''Return the up-to-date graph for the given repo'''
+        with cls._lock:
+            graph = cls._cache.get(repo_id)
+        version, size = cls.stored_state(repo_id)
+        if graph is None or graph.version != version:
+            graph = cls(repo_id)
+            graph._load(0)
+        elif len(graph) != size:
+            graph = graph.copy()
+            graph._load(len(graph) // GRAPH_CHUNKSIZE)
+        else:
+            return graph
+        cls._put(graph)
+        return graph
+
+    @classmethod
+    def _put(cls, graph):
+        with cls._lock:
+            if graph.repo_id not in cls._cache \
+                    and len(cls._cache) >= cls.cache_size:
+                cls._cache.pop(next(iter(cls._cache)))
+            cls._cache[graph.repo_id] = graph
+
+    @classmethod
+    def stored_state(cls, repo_id):
+        '''The version and number of commits of the stored graph'''
+        last = CommitGraphDoc.m.find(
+            dict(repo_id=repo_id), {'chunk': 1, 'size': 1, 'version': 1},
+            validate=False).sort('chunk', pymongo.DESCENDING).limit(1).first()
+        if last is None: return None, 0
+        return last['version'], last['chunk'] * GRAPH_CHUNKSIZE + last['size']
+
+    def copy(self):
+        graph = CommitGraph(self.repo_id)
+        graph.version = self.version
+        graph.commit_ids = list(self.commit_ids)
+        graph.positions = dict(self.positions)
+        graph.parents = list(self.parents)
+        graph.generations = array('i', self.generations)
+        graph.times = array('d', self.times)
+        graph.counts = array('i', self.counts)
+        graph.order = array('i', self.order)
+        graph.ranks = array('i', self.ranks)
+        graph.tips = set(self.tips)
+        return graph
+
+    def _load(self, first_chunk):
+        '''(Re)load all chunks starting with first_chunk'''
+        start = first_chunk * GRAPH_CHUNKSIZE
+        lo = self._truncate(start)
+        spec = dict(repo_id=self.repo_id, chunk={'$gte': first_chunk})
+        if first_chunk:
+            # chunks of another version belong to a rebuilt graph, which the
+            # next get() loads in full
+            spec['version'] = self.version
+        q = CommitGraphDoc.m.find(spec, validate=False)
+        for doc in q.sort('chunk', pymongo.ASCENDING):
+            self.version = doc['version']
+            parent_counts = array('H', str(doc['parent_counts']))
+            parent_positions = array('i', str(doc['parent_positions']))
+            i = 0
+            for oid, n in izip(doc['commit_ids'], parent_counts):
+                parents = tuple(parent_positions[i:i+n])
+                self.tips.difference_update(parents)
+                self.tips.add(len(self.commit_ids))
+                self.positions[oid] = len(self.commit_ids)
+                self.commit_ids.append(oid)
+                self.parents.append(parents)
+                i += n
+            self.generations.fromstring(str(doc['generations']))
+            self.times.fromstring(str(doc['times']))
+            self.counts.fromstring(str(doc['counts']))
+        self._reorder(xrange(start, len(self)), lo)
+
+    def _truncate(self, start):
+        '''Drop the commits from position start on, and return the lowest
+        rank they had'''
+        if start >= len(self): return len(self.order)
+        lo = min(self.ranks[start:])
+        self.order = self.order[:lo] + array(
+            'i', (pos for pos in self.order[lo:] if pos < start))
+        for oid in self.commit_ids[start:]:
+            del self.positions[oid]
+        del self.commit_ids[start:]
+        del self.parents[start:]
+        del self.generations[start:]
+        del self.times[start:]
+        del self.counts[start:]
+        del self.ranks[start:]
+        self.tips = set(xrange(start))
+        for parents in self.parents:
+            self.tips.difference_update(parents)
+        return lo
+
+    def _reorder(self, moved, lo):
+        '''Put the positions in moved, which are new or whose times were
+        lowered, in their place in the date order, and re-rank the order
+        from rank lo (which may already be out of date) on'''
+        moved = set(moved)
+        if not moved: return
+        key = lambda pos: (self.times[pos], pos)
+        # order[:hi] holds no moved positions, so it is still sorted
+        hi = min([ self.ranks[pos] for pos in moved if pos < len(self.ranks) ]
+                 + [ lo ])
+        for pos in moved:
+            lo = min(lo, self._bisect(key(pos), hi))
+        tail = [ pos for pos in self.order[lo:] if pos not in moved ]
+        tail.extend(moved)
+        tail.sort(key=key)
+        del self.order[lo:]
+        self.order.extend(tail)
+        self.ranks.extend([0] * (len(self.order) - len(self.ranks)))
+        for rank in xrange(lo, len(self.order)):
+            self.ranks[self.order[rank]] = rank
+
+    def _bisect(self, key, hi):
+        lo = 0
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.order[mid]
+            if (self.times[pos], pos) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _save(self, chunk):
+        start = chunk * GRAPH_CHUNKSIZE
+        end = start + GRAPH_CHUNKSIZE
+        parents = self.parents[start:end]
+        CommitGraphDoc(dict(
+                _id='%s:%d' % (self.repo_id, chunk),
+                repo_id=self.repo_id,
+                chunk=chunk,
+                version=self.version,
+                size=len(parents),
+                commit_ids=self.commit_ids[start:end],
+                generations=bson.Binary(self.generations[start:end].tostring()),
+                times=bson.Binary(self.times[start:end].tostring()),
+                counts=bson.Binary(self.counts[start:end].tostring()),
+                parent_counts=bson.Binary(array('H', map(len, parents)).tostring()),
+                parent_positions=bson.Binary(
+                    array('i', chain(*parents)).tostring()))).m.save()
+
+    def add(self, commits):
+        '''Append (commit_id, parent_ids, time) triples, which must come
+        parents first, and save the chunks that changed.  Commits already in
+        the graph are skipped, as are parents that are not in it.  Adding to
+        an empty graph replaces the stored one.
+
+        Call this on a copy() of a cached graph, which then replaces it.'''
+        first = len(self)
+        lowered = set()
+        for oid, parent_ids, time in commits:
+            if oid in self.positions: continue
+            parents = tuple(
+                self.positions[p] for p in parent_ids if p in self.positions)
+            pos = len(self.commit_ids)
+            self.positions[oid] = pos
+            self.commit_ids.append(oid)
+            self.parents.append(parents)
+            self.generations.append(
+                1 + max([ self.generations[p] for p in parents ] or [0]))
+            self.times.append(time)
+            self._lower(parents, time, lowered)
+            self.counts.append(self._count(parents))
+            self.tips.difference_update(parents)
+            self.tips.add(pos)
+        if len(self) == first: return
+        self._reorder(chain(lowered, xrange(first, len(self))), len(self.order))
+        start = min(list(lowered) + [first]) // GRAPH_CHUNKSIZE
+        if not first:
+            CommitGraphDoc.m.remove(dict(repo_id=self.repo_id))
+            self.version = bson.ObjectId()
+        elif start < first // GRAPH_CHUNKSIZE:
+            # readers only reload from the chunk they last loaded, so make
+            # them reload the whole graph
+            self.version = bson.ObjectId()
+        # the last chunk is saved last, so readers that see the new version
+        # or size find the chunks before it saved
+        for chunk in xrange(start, (len(self) - 1) // GRAPH_CHUNKSIZE + 1):
+            self._save(chunk)
+        CommitGraph._put(self)
+
+    def _lower(self, parents, time, lowered):
+        '''Lower the times of parents and their ancestors to at most time,
+        adding the positions changed to lowered'''
+        to_visit = [ p for p in parents if self.times[p] > time ]
+        while to_visit:
+            pos = to_visit.pop()
+            if self.times[pos] <= time: continue
+            self.times[pos] = time
+            lowered.add(pos)
+            to_visit.extend(p for p in self.parents[pos] if self.times[p] > time)
+
+    def _count(self, parents):
+        '''Number of revisions in the history of a new commit with the given
+        parents: one more than in its first parent's, plus the ancestors of
+        the other parents that are not its first parent's.'''
+        if not parents: return 1
+        result = 1 + self.counts[parents[0]]
+        if len(parents) == 1: return result
+        return result + len(self._paint(parents[0], parents[1:]))
+
+    def _paint(self, first, others):
+        '''Positions of others and their ancestors that are not first or one
+        of its ancestors.  They are found by painting the ancestors of both
+        sides in reverse topological order down to where only first's
+        remain, as git does to find merge bases, so the cost is that of the
+        commits between them.'''
+        FIRST, OTHER = 1, 2
+        paint = { first: FIRST }
+        for p in others:
+            paint[p] = paint.get(p, 0) | OTHER
+        queue = [ -p for p in paint ]
+        heapq.heapify(queue)
+        result = set()
+        pending = sum(1 for p in paint if paint[p] == OTHER)
+        while pending:
+            pos = -heapq.heappop(queue)
+            flags = paint[pos]
+            if flags == OTHER:
+                pending -= 1
+                result.add(pos)
+            for p in self.parents[pos]:
+                old = paint.get(p)
+                new = (old or 0) | flags
+                if old == new: continue
+                if old is None:
+                    heapq.heappush(queue, -p)
+                elif old == OTHER:
+                    pending -= 1
+                if new == OTHER:
+                    pending += 1
+                paint[p] = new
+        return result
+
+    def _others(self, pos):
+        '''Sorted ranks, below that of pos, of the commits that are not in
+        the history of pos.  There are none for a commit whose history is all
+        of the older part of the date order, e.g. the head of a repo whose
+        branches are all merged.  Otherwise they are painted down from the
+        tips of the graph, once per commit.'''
+        top = self.ranks[pos]
+        if self.counts[pos] == top + 1: return []
+        result = self._others_cache.get(pos)
+        if result is None:
+            result = sorted(
+                self.ranks[p] for p in self._paint(pos, self.tips)
+                if self.ranks[p] < top)
+            if len(self._others_cache) >= self.others_cache_size:
+                self._others_cache.clear()
+            self._others_cache[pos] = result
+        return result
+
+    def log(self, commit_id, skip=0, count=None):
+        '''Return count (default all) commit IDs of the log of commit_id,
+        newest first by commit time, after skipping the first skip.  The page
+        is found by binary search on the date order, so its cost does not
+        grow with skip.'''
+        pos = self.positions[commit_id]
+        total = self.counts[pos]
+        stop = total if count is None else min(total, skip + count)
+        if skip >= stop: return []
+        top = self.ranks[pos]
+        others = self._others(pos)
+        def history(rank):
+            '''Number of commits of the log from rank up to top'''
+            return top - rank + 1 - (len(others) - bisect_left(others, rank))
+        # the highest rank with more than skip commits of the log from it
+        lo, hi = 0, top
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if history(mid) > skip:
+                lo = mid
+            else:
+                hi = mid - 1
+        result = []
+        rank = lo
+        i = bisect_right(others, rank)
+        while len(result) < stop - skip:
+            if i and others[i - 1] == rank:
+                i -= 1
+            else:
+                result.append(self.commit_ids[self.order[rank]])
+            rank -= 1
+        return result
+
+    def count(self, commit_id):
+        '''Number of revisions in the history of commit_id'''
+        return self.counts[self.positions[commit_id]]
+
+    def is_ancestor(self, ancestor_id, commit_id):
+        '''True if ancestor_id is commit_id or one of its ancestors'''
+        a = self.positions[ancestor_id]
+        b = self.positions[commit_id]
+        if a == b: return True
+        if a > b or self.generations[a] >= self.generations[b]: return False
+        # Every ancestor of a has a lower position and generation, so skip
+        # those while searching back from b
+        generation = self.generations[a]
+        seen = set([b])
+        to_visit = [b]
+        while to_visit:
+            pos = to_visit.pop()
+            for p in self.parents[pos]:
+                if p == a: return True
+                if p in seen or p < a or self.generations[p] <= generation:
+                    continue
+                seen.add(p)
+                to_visit.append(p)
+        return False
+
+class CommitLayout(object):
+    '''Rows and columns of a repository's commits in the commit browser,
+    stored in CommitLayoutDocs alongside its CommitGraph.
+
+    Commits are laid out in the order of their graph positions, oldest
+    first, so that a refresh only has to place the commits it appended to
+    the graph.  A commit continues the lane (column) of its first parent if
+    no other commit has, and otherwise starts a lane in a column that has
+    been free since that parent, so that the edge between them crosses no
+    other lane.  The lanes of its other parents end at it.  Its row is its
+    distance from the newest commit laid out, so rows are counted from the
+    top of the browser and no stored chunk changes when commits are added.
+
+    When the graph is rebuilt or reordered (its version changes), for
+    instance because heads no longer reach some of its commits, the whole
+    layout is redone, so that commits that are gone leave the browser.
+    '''
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.columns = array('H')
+        self.edge_columns = []
+        # position of the commit whose lane is open in each column, or -1
+        self.lanes = array('i')
+        # position from which each free column has been free
+        self.free_since = array('i')
+        self._states = {}
+
+    def __len__(self):
+        return len(self.columns)
+
+    @classmethod
+    def update(cls, graph):
+        '''Lay out the commits of graph that are not laid out yet, and save
+        the chunks that changed'''
+        last = cls._last_doc(graph.repo_id)
+        if last is not None:
+            if not cls._current(graph, last):
+                # the graph was rebuilt or reordered
+                CommitLayoutDoc.m.remove(dict(repo_id=graph.repo_id))
+            elif last['chunk'] * GRAPH_CHUNKSIZE + last['size'] == len(graph):
+                return
+        layout = cls(graph)
+        layout._load()
+        first = len(layout)
+        for pos in xrange(first, len(graph)):
+            layout._place(pos)
+            if (pos + 1) % GRAPH_CHUNKSIZE == 0 or pos + 1 == len(graph):
+                layout._states[pos // GRAPH_CHUNKSIZE] = (
+                    array('i', layout.lanes), array('i', layout.free_since))
+        for chunk in xrange(first // GRAPH_CHUNKSIZE,
+                            (len(graph) - 1) // GRAPH_CHUNKSIZE + 1):
+            layout._save(chunk)
+        log.info('Laid out %d commits of %s', len(graph) - first, graph.repo_id)
+
+    @classmethod
+    def window(cls, graph, start, limit):
+        '''Return the number of rows and columns of the layout, and a list
+        of (commit_id, row, column, edges) for limit rows from row start,
+        newest first, where edges are (parent_row, parent_column,
+        edge_column).  Return None if the repo has not been laid out.'''
+        last = cls._last_doc(graph.repo_id)
+        if last is None or not cls._current(graph, last): return None
+        size = last['chunk'] * GRAPH_CHUNKSIZE + last['size']
+        top = size - 1 - start
+        bottom = max(size - start - limit, 0)
+        if top < bottom:
+            return size, last['width'], []
+        columns = {}
+        edge_columns = {}
+        def load(chunks, fields):
+            chunks = [ ch for ch in chunks if ch not in columns ]
+            if not chunks: return
+            for doc in CommitLayoutDoc.m.find(dict(
+                    repo_id=graph.repo_id, chunk={'$in': chunks}),
+                    fields, validate=False):
+                columns[doc['chunk']] = array('H', str(doc['columns']))
+                if 'edge_columns' in doc:
+                    edge_columns[doc['chunk']] = array('H', str(doc['edge_columns']))
+        load(range(bottom // GRAPH_CHUNKSIZE, top // GRAPH_CHUNKSIZE + 1),
+             ['chunk', 'columns', 'edge_columns'])
+        load(set(p // GRAPH_CHUNKSIZE for pos in xrange(bottom, top + 1)
+                 for p in graph.parents[pos]),
+             ['chunk', 'columns'])
+        def column(pos):
+            return columns[pos // GRAPH_CHUNKSIZE][pos % GRAPH_CHUNKSIZE]
+        # offset of each commit's edges in its chunk's edge_columns
+        offsets = {}
+        for chunk in edge_columns:
+            first = chunk * GRAPH_CHUNKSIZE
+            i = 0
+            for pos in xrange(first, min(first + GRAPH_CHUNKSIZE, size)):
+                offsets[pos] = i
+                i += len(graph.parents[pos])
+        rows = []
+        for pos in xrange(top, bottom - 1, -1):
+            i = offsets[pos]
+            chunk_edges = edge_columns[pos // GRAPH_CHUNKSIZE]
+            edges = [ (size - 1 - p, column(p), chunk_edges[i + n])
+                      for n, p in enumerate(graph.parents[pos]) ]
+            rows.append((graph.commit_ids[pos], size - 1 - pos, column(pos), edges))
+        return size, last['width'], rows
+
+    @classmethod
+    def _last_doc(cls, repo_id):
+        return CommitLayoutDoc.m.find(
+            dict(repo_id=repo_id),
+            {'chunk': 1, 'size': 1, 'head': 1, 'width': 1, 'version': 1},
+            validate=False).sort('chunk', pymongo.DESCENDING).limit(1).first()
+
+    @classmethod
+    def _current(cls, graph, last):
+        '''True if the layout whose last doc is last lays out the first
+        commits of graph as it is'''
+        size = last['chunk'] * GRAPH_CHUNKSIZE + last['size']
+        return (last.get('version') == graph.version
+                and size <= len(graph)
+                and graph.commit_ids[size - 1] == last['head'])
+
+    def _load(self):
+        q = CommitLayoutDoc.m.find(dict(repo_id=self.graph.repo_id), validate=False)
+        doc = None
+        for doc in q.sort('chunk', pymongo.ASCENDING):
+            first = len(self)
+            self.columns.fromstring(str(doc['columns']))
+            edge_columns = array('H', str(doc['edge_columns']))
+            i = 0
+            for pos in xrange(first, len(self)):
+                n = len(self.graph.parents[pos])
+                self.edge_columns.append(tuple(edge_columns[i:i+n]))
+                i += n
+        if doc is not None:
+            self.lanes = array('i', str(doc['lanes']))
+            self.free_since = array('i', str(doc['free_since']))
+
+    def _save(self, chunk):
+        start = chunk * GRAPH_CHUNKSIZE
+        end = start + GRAPH_CHUNKSIZE
+        columns = self.columns[start:end]
+        lanes, free_since = self._states[chunk]
+        CommitLayoutDoc(dict(
+                _id='%s:%d' % (self.graph.repo_id, chunk),
+                repo_id=self.graph.repo_id,
+                chunk=chunk,
+                version=self.graph.version,
+                size=len(columns),
+                head=self.graph.commit_ids[start + len(columns) - 1],
+                width=len(lanes),
+                columns=bson.Binary(columns.tostring()),
+                edge_columns=bson.Binary(
+                    array('H', chain(*self.edge_columns[start:end])).tostring()),
+                lanes=bson.Binary(lanes.tostring()),
+                free_since=bson.Binary(free_since.tostring()))).m.save()
+
+    def _open(self, pos):
+        '''True if the lane of the commit at pos has not been continued or
+        ended yet'''
+        return self.lanes[self.columns[pos]] == pos
+
+    def _free_column(self, since):
+        for col, owner in enumerate(self.lanes):
+            if owner == -1 and self.free_since[col] <= since:
+                return col
+        self.lanes.append(-1)
+        self.free_since.append(-1)
+        return len(self.lanes) - 1
+
+    def _place(self, pos):
+        parents = self.graph.parents[pos]
+        if parents and self._open(parents[0]):
+            column = self.columns[parents[0]]
+        else:
+            # the edges to parents whose lanes are closed run in this
+            # commit's column, down to the oldest of them
+            column = self._free_column(
+                min([ p for p in parents if not self._open(p) ] or [pos]))
+        edges = []
+        for p in parents:
+            if self._open(p):
+                edges.append(self.columns[p])
+                self.lanes[self.columns[p]] = -1
+                self.free_since[self.columns[p]] = pos
+            else:
+                edges.append(column)
+        self.lanes[column] = pos
+        self.columns.append(column)
+        self.edge_columns.append(tuple(edges))
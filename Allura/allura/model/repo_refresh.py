@@ -1,11 +1,17 @@
+import time
 import logging
+import calendar
 from itertools import chain
 from cPickle import dumps
+from contextlib import contextmanager
+from multiprocessing import Pool
 import re
 
 import bson
+import pymongo
 
 import tg
+from paste.deploy.converters import asint
 
 from ming.base import Object
 from ming.orm import mapper, session
@@ -13,19 +19,28 @@
 from allura.lib import utils
 from allura.lib import helpers as h
 from allura.model.repo import CommitDoc, TreeDoc, TreesDoc, DiffInfoDoc
-from allura.model.repo import LastCommitDoc, CommitRunDoc
-from allura.model.repo import Commit
+from allura.model.repo import LastCommitDoc, CommitRunDoc, RefreshCheckpointDoc
+from allura.model.repo import RefreshCheckpointChunkDoc, CHECKPOINT_CHUNKSIZE
+from allura.model.repo import DirLastCommitDoc, dir_last_commit_id
+from allura.model.repo import Commit, CommitGraph, CommitLayout
 from allura.model.index import ArtifactReferenceDoc, ShortlinkDoc
+from allura.model.markdown_cache import MarkdownCache
+from allura.model.session import main_doc_session
 
 log = logging.getLogger(__name__)
 
 QSIZE=100
+# Commits per refresh_repo batch (and per checkpoint)
+CHUNKSIZE=1000
+# Max number of tree chunks queued on the worker pool at once
+MAX_PENDING=4
 
 def refresh_repo(repo, all_commits=False, notify=True):
+    '''Refresh the commits of repo, and return how many it has'''
     all_commit_ids = commit_ids = list(repo.all_commit_ids())
     if not commit_ids:
         # the repo is empty, no need to continue
-        return
+        return 0
     new_commit_ids = unknown_commit_ids(commit_ids)
     stats_log = h.log_action(log, 'commit')
     for ci in new_commit_ids:
@@ -37,70 +52,240 @@ def refresh_repo(repo, all_commits=False, notify=True):
     if not all_commits:
         # Skip commits that are already in the DB
         commit_ids = new_commit_ids
+    checkpoint = RefreshCheckpoint.start(repo, all_commits, commit_ids)
+    commit_ids = checkpoint.commit_ids
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
-    # Refresh commits
-    seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i+1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i+1), oid)
-
-    refresh_commit_repos(all_commit_ids, repo)
-
-    # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i+1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s', (i+1), ci._id)
+    # Refresh commit info and (except for SVN, see below) commit trees in a
+    # single pass over the commits.  Trees may be computed in a pool of
+    # worker processes while the next chunk is being read.
+    if checkpoint.stage == 'commits':
+        refresh_trees = repo.tool.lower() != 'svn'
+        with _refresh_pool() as pool:
+            seen = set()
+            cache = {}
+            pending = []
+            position = checkpoint.position
+            for oids in utils.chunked_list(commit_ids[position:], CHUNKSIZE):
+                for oid in oids:
+                    repo.refresh_commit_info(oid, seen, not all_commits)
+                # Like diffs below, pre-computing trees for SVN repos is too
+                # expensive, so we skip it here, then do it on-demand later.
+                if not refresh_trees:
+                    result = _ReadyResult()
+                elif pool is None:
+                    for ci in load_commits(oids):
+                        cache = refresh_commit_trees(ci, cache)
+                    result = _ReadyResult()
+                else:
+                    result = pool.apply_async(_refresh_commit_trees_chunk, (oids,))
+                position += len(oids)
+                pending.append((position, result))
+                log.info('Refresh commit info %d: %s', position, oids[-1])
+                # Only checkpoint chunks whose trees are known to be done
+                while pending and (pending[0][1].ready() or len(pending) > MAX_PENDING):
+                    done_position, result = pending.pop(0)
+                    result.get()
+                    checkpoint.save('commits', done_position)
+            for done_position, result in pending:
+                result.get()
+                checkpoint.save('commits', done_position)
+        checkpoint.save('children')
+
+    # Refresh child references once all the commit info is written: the
+    # parents of a chunk's commits are mostly in the next (older) chunk, and
+    # refreshing their info would reset their child_ids.
+    if checkpoint.stage == 'children':
+        position = checkpoint.position
+        for oids in utils.chunked_list(commit_ids[position:], CHUNKSIZE):
+            for ci in load_commits(oids):
+                refresh_children(ci)
+            position += len(oids)
+            checkpoint.save('children', position)
+            log.info('Refresh child info %d: %s', position, oids[-1])
+        checkpoint.save('repos')
+
+    if checkpoint.stage == 'repos':
+        refresh_commit_repos(all_commit_ids, repo)
+        checkpoint.save('runs')
 
     # Refresh commit runs
-    commit_run_ids = commit_ids
-    # Check if the CommitRuns for the repo are in a good state by checking for
-    # a CommitRunDoc that contains the last known commit. If there isn't one,
-    # the CommitRuns for this repo are in a bad state - rebuild them entirely.
-    if commit_run_ids != all_commit_ids:
-        last_commit = last_known_commit_id(all_commit_ids, new_commit_ids)
-        log.info('Last known commit id: %s', last_commit)
-        if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
-            log.info('CommitRun incomplete, rebuilding with all commits')
-            commit_run_ids = all_commit_ids
-    log.info('Starting CommitRunBuilder for %s', repo.full_fs_path)
-    rb = CommitRunBuilder(commit_run_ids)
-    rb.run()
-    rb.cleanup()
-    log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
-
-    # Refresh trees
-    # Like diffs below, pre-computing trees for SVN repos is too expensive,
-    # so we skip it here, then do it on-demand later.
-    if repo.tool.lower() != 'svn':
-        cache = {}
-        for i, oid in enumerate(commit_ids):
-            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-            cache = refresh_commit_trees(ci, cache)
-            if (i+1) % 100 == 0:
-                log.info('Refresh commit trees %d: %s', (i+1), ci._id)
+    if checkpoint.stage == 'runs':
+        commit_run_ids = commit_ids
+        # Check if the CommitRuns for the repo are in a good state by checking for
+        # a CommitRunDoc that contains the last known commit. If there isn't one,
+        # the CommitRuns for this repo are in a bad state - rebuild them entirely.
+        if commit_run_ids != all_commit_ids:
+            last_commit = last_known_commit_id(all_commit_ids, commit_ids)
+            log.info('Last known commit id: %s', last_commit)
+            if not CommitRunDoc.m.find(dict(commit_ids=last_commit)).count():
+                log.info('CommitRun incomplete, rebuilding with all commits')
+                commit_run_ids = all_commit_ids
+        log.info('Starting CommitRunBuilder for %s', repo.full_fs_path)
+        rb = CommitRunBuilder(commit_run_ids)
+        rb.run()
+        rb.cleanup()
+        log.info('Finished CommitRunBuilder for %s', repo.full_fs_path)
+        refresh_commit_graph(repo, all_commit_ids)
+        checkpoint.save('diffs')
 
     # Compute diffs
-    cache = {}
     # Have to compute_diffs() for all commits to ensure that LastCommitDocs
     # are set properly for forked repos. For SVN, compute_diffs() we don't
     # want to pre-compute the diffs because that would be too expensive, so
-    # we skip them here and do them on-demand with caching.
-    if repo.tool.lower() != 'svn':
-        for i, oid in enumerate(reversed(all_commit_ids)):
-            ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-            compute_diffs(repo._id, cache, ci)
-            if (i+1) % 100 == 0:
-                log.info('Compute diffs %d: %s', (i+1), ci._id)
+    # we skip them here and do them on-demand with caching.  Diffs are
+    # computed serially, oldest first, so that the newest commit to touch a
+    # path ends up in its LastCommitDoc.
+    if checkpoint.stage == 'diffs' and repo.tool.lower() != 'svn':
+        cache = {}
+        position = checkpoint.position
+        oids = list(reversed(all_commit_ids))
+        for chunk in utils.chunked_list(oids[position:], CHUNKSIZE):
+            for ci in load_commits(chunk):
+                compute_diffs(repo._id, cache, ci)
+            position += len(chunk)
+            checkpoint.save('diffs', position)
+            log.info('Compute diffs %d: %s', position, chunk[-1])
+    checkpoint.finish()
 
     log.info('Refresh complete for %s', repo.full_fs_path)
 
     # Send notifications
     if notify:
         send_notifications(repo, commit_ids)
+    return len(all_commit_ids)
+
+class RefreshCheckpoint(object):
+    '''Records how far refresh_repo got, so that a refresh that died part
+    way through (e.g. on a large import) resumes at the same stage rather than
+    starting over.  Stages run in the order commits, children, repos, runs,
+    diffs; position is the number of commits of the current stage already
+    done.'''
+
+    def __init__(self, doc, commit_ids):
+        self.doc = doc
+        self.commit_ids = commit_ids
+
+    @classmethod
+    def start(cls, repo, all_commits, commit_ids):
+        doc = RefreshCheckpointDoc.m.get(_id=repo._id)
+        stored = None
+        if doc is not None and doc.size is not None:
+            stored = cls._load_commit_ids(repo._id)
+            if len(stored) != doc.size:
+                stored = None
+        # A checkpoint of a full refresh also covers an incremental one
+        if stored is None or (all_commits and not doc.all_commits):
+            doc = RefreshCheckpointDoc(dict(
+                    _id=repo._id,
+                    all_commits=all_commits,
+                    stage='commits',
+                    position=0))
+        else:
+            # Commits already stored by the interrupted refresh are no longer
+            # "new", so keep working on the checkpointed list, plus anything
+            # pushed since.
+            known = set(stored)
+            added = [ oid for oid in commit_ids if oid not in known ]
+            log.info('Resuming refresh of %s at %s:%d (%d commits added since)',
+                     repo.full_fs_path, doc.stage, doc.position, len(added))
+            if not added:
+                return cls(doc, stored)
+            commit_ids = added + stored
+            doc.stage = 'commits'
+            doc.position = 0
+        # Mark the list incomplete while it is written, so that a refresh
+        # that dies meanwhile starts over rather than trusting it
+        doc.size = None
+        doc.m.save()
+        cls._save_commit_ids(repo._id, commit_ids)
+        doc.size = len(commit_ids)
+        doc.m.save()
+        return cls(doc, commit_ids)
+
+    @classmethod
+    def _load_commit_ids(cls, repo_id):
+        result = []
+        q = RefreshCheckpointChunkDoc.m.find(dict(repo_id=repo_id), validate=False)
+        for chunk in q.sort('chunk', pymongo.ASCENDING):
+            result += chunk['commit_ids']
+        return result
+
+    @classmethod
+    def _save_commit_ids(cls, repo_id, commit_ids):
+        RefreshCheckpointChunkDoc.m.remove(dict(repo_id=repo_id))
+        for i, oids in enumerate(utils.chunked_list(commit_ids, CHECKPOINT_CHUNKSIZE)):
+            RefreshCheckpointChunkDoc(dict(
+                    _id='%s:%d' % (repo_id, i),
+                    repo_id=repo_id,
+                    chunk=i,
+                    commit_ids=oids)).m.save()
+
+    @property
+    def stage(self):
+        return self.doc.stage
+
+    @property
+    def position(self):
+        return self.doc.position
+
+    def save(self, stage, position=0):
+        self.doc.stage = stage
+        self.doc.position = position
+        RefreshCheckpointDoc.m.update_partial(
+            dict(_id=self.doc._id),
+            {'$set': dict(stage=stage, position=position)})
+
+    def finish(self):
+        RefreshCheckpointDoc.m.remove(dict(_id=self.doc._id))
+        RefreshCheckpointChunkDoc.m.remove(dict(repo_id=self.doc._id))
+
+def load_commits(oids):
+    '''Bulk-load the CommitDocs for a list of commit IDs, in the same order'''
+    for chunk in utils.chunked_list(oids, QSIZE):
+        index = dict(
+            (ci._id, ci)
+            for ci in CommitDoc.m.find(dict(_id={'$in': chunk}), validate=False))
+        for oid in chunk:
+            ci = index.get(oid)
+            if ci is not None:
+                yield ci
+
+class _ReadyResult(object):
+    '''Stand-in for an AsyncResult of work that was done in-process'''
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return None
+
+@contextmanager
+def _refresh_pool():
+    '''Pool of scm.refresh.processes worker processes for computing commit
+    trees, or None if refresh should happen in-process (the default).'''
+    processes = asint(tg.config.get('scm.refresh.processes', 1))
+    if processes <= 1:
+        yield None
+        return
+    pool = Pool(processes, initializer=_init_refresh_worker)
+    try:
+        yield pool
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _init_refresh_worker():
+    # Don't share the parent's sockets; pymongo reconnects on demand
+    main_doc_session.db.connection.disconnect()
+
+def _refresh_commit_trees_chunk(oids):
+    cache = {}
+    for ci in load_commits(oids):
+        cache = refresh_commit_trees(ci, cache)
 
 def refresh_commit_trees(ci, cache):
     '''Refresh the list of trees included withn a commit'''
@@ -117,40 +302,136 @@ def refresh_commit_trees(ci, cache):
 def refresh_commit_repos(all_commit_ids, repo):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
+    writer = CommitRepoWriter(repo)
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
         for ci in CommitDoc.m.find(dict(
                 _id={'$in':list(oids)},
-                repo_ids={'$ne': repo._id})):
-            oid = ci._id
-            ci.repo_ids.append(repo._id)
-            index_id = 'allura.model.repo.Commit#' + oid
-            ref = ArtifactReferenceDoc(dict(
-                    _id=index_id,
-                    artifact_reference=dict(
-                        cls=bson.Binary(dumps(Commit)),
-                        project_id=repo.app.config.project_id,
-                    app_config_id=repo.app.config._id,
-                        artifact_id=oid),
-                    references=[]))
-            link0 = ShortlinkDoc(dict(
-                    _id=bson.ObjectId(),
-                    ref_id=index_id,
-                    project_id=repo.app.config.project_id,
-                    app_config_id=repo.app.config._id,
-                    link=repo.shorthand_for_commit(oid)[1:-1],
-                    url=repo.url_for_commit(oid)))
-            # Always create a link for the full commit ID
-            link1 = ShortlinkDoc(dict(
-                    _id=bson.ObjectId(),
-                    ref_id=index_id,
-                    project_id=repo.app.config.project_id,
-                    app_config_id=repo.app.config._id,
-                    link=oid,
-                    url=repo.url_for_commit(oid)))
-            ci.m.save(safe=False, validate=False)
-            ref.m.save(safe=False, validate=False)
-            link0.m.save(safe=False, validate=False)
-            link1.m.save(safe=False, validate=False)
+                repo_ids={'$ne': repo._id}), {'_id': 1}, validate=False):
+            writer.add(ci._id)
+        writer.flush()
+
+class CommitRepoWriter(object):
+    '''Accumulates the documents that refresh_commit_repos writes for a chunk
+    of commits (the commit's repo_ids, its ArtifactReferenceDoc and two
+    ShortlinkDocs) and saves them with one bulk operation per collection.'''
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.project_id = repo.app.config.project_id
+        self.app_config_id = repo.app.config._id
+        self.commit_cls = bson.Binary(dumps(Commit))
+        self.reset()
+
+    def reset(self):
+        self.commit_ids = []
+        self.refs = []
+        self.links = []
+        self.start = time.time()
+
+    def add(self, oid):
+        index_id = 'allura.model.repo.Commit#' + oid
+        url = self.repo.url_for_commit(oid)
+        self.commit_ids.append(oid)
+        self.refs.append(ArtifactReferenceDoc(dict(
+                _id=index_id,
+                artifact_reference=dict(
+                    cls=self.commit_cls,
+                    project_id=self.project_id,
+                    app_config_id=self.app_config_id,
+                    artifact_id=oid),
+                references=[])))
+        self.links.append(ShortlinkDoc(dict(
+                _id=bson.ObjectId(),
+                ref_id=index_id,
+                project_id=self.project_id,
+                app_config_id=self.app_config_id,
+                link=self.repo.shorthand_for_commit(oid)[1:-1],
+                url=url)))
+        # Always create a link for the full commit ID
+        self.links.append(ShortlinkDoc(dict(
+                _id=bson.ObjectId(),
+                ref_id=index_id,
+                project_id=self.project_id,
+                app_config_id=self.app_config_id,
+                link=oid,
+                url=url)))
+
+    def flush(self):
+        if self.commit_ids:
+            # repo_ids is written last: the commits that have it are skipped
+            # when an interrupted refresh resumes, so their refs and links
+            # must be there already.  Redoing the rest is harmless, as
+            # existing refs and links are replaced.
+            ref_ids = [ ref._id for ref in self.refs ]
+            # Replace any existing references (e.g. from the upstream of a
+            # fork), as saving them one at a time used to
+            ArtifactReferenceDoc.m.remove(dict(_id={'$in': ref_ids}))
+            _raw_collection(ArtifactReferenceDoc).insert(self.refs)
+            ShortlinkDoc.m.remove(dict(
+                    ref_id={'$in': ref_ids}, app_config_id=self.app_config_id))
+            _raw_collection(ShortlinkDoc).insert(self.links)
+            MarkdownCache.invalidate_links(self.project_id)
+            CommitDoc.m.update_partial(
+                dict(_id={'$in': self.commit_ids}),
+                {'$addToSet': dict(repo_ids=self.repo._id)},
+                multi=True)
+            log.info('Refreshed repo references for %d commits in %.2fs',
+                     len(self.commit_ids), time.time() - self.start)
+        self.reset()
+
+def _raw_collection(doc_cls):
+    return main_doc_session.db[doc_cls.m.collection_name]
+
+def refresh_commit_graph(repo, all_commit_ids):
+    '''Append any of the repo's commits that are missing from its CommitGraph,
+    and lay them out for the commit browser.  The first refresh after
+    upgrading builds the whole graph and layout, as does one that finds the
+    graph has commits the repo no longer has.'''
+    graph = CommitGraph.get(repo._id)
+    missing = [ oid for oid in reversed(all_commit_ids) if oid not in graph ]
+    if len(graph) + len(set(missing)) > len(set(all_commit_ids)):
+        # some of the graph's commits are gone (e.g. after a forced push),
+        # so build it again without them
+        log.info('Rebuilding the commit graph of %s', repo.full_fs_path)
+        graph = CommitGraph(repo._id)
+        missing = list(reversed(all_commit_ids))
+    if missing:
+        parents, times = {}, {}
+        for ci in load_commits(missing):
+            parents[ci._id] = ci.parent_ids
+            times[ci._id] = _commit_time(ci)
+        graph = graph.copy()
+        graph.add(
+            (oid, parents.get(oid, []), times.get(oid, 0))
+            for oid in _topological_order(missing, parents))
+        log.info('Added %d commits to the commit graph of %s', len(missing),
+                 repo.full_fs_path)
+    CommitLayout.update(graph)
+
+def _commit_time(ci):
+    '''Commit time of a CommitDoc in seconds since the epoch, or 0'''
+    date = (ci.get('committed') or {}).get('date')
+    if date is None: return 0
+    return calendar.timegm(date.utctimetuple())
+
+def _topological_order(commit_ids, parents):
+    '''Order commit_ids so that every commit comes after its parents'''
+    result = []
+    placed = set()
+    for oid in commit_ids:
+        to_visit = [ (oid, False) ]
+        while to_visit:
+            oid, expanded = to_visit.pop()
+            if oid in placed: continue
+            if expanded:
+                placed.add(oid)
+                result.append(oid)
+                continue
+            to_visit.append((oid, True))
+            for p in parents.get(oid, []):
+                if p in parents and p not in placed:
+                    to_visit.append((p, False))
+    return result
 
 def refresh_children(ci):
     '''Refresh the list of children of the given commit'''
@@ -469,9 +750,12 @@ def refresh_last_commit(repo_id, path, tree, lhs_tree, parent_tree, commit_info)
             lhs_map[lhs_child.name] = lhs_child.id
 
     # update our children
+    changed = set()
     for child in chain(tree.tree_ids, tree.blob_ids, tree.other_ids):
         if child.id != lhs_map.get(child.name, None):  # check if changed in this commit
             lc = set_last_commit(repo_id, path, child.name, child.id, commit_info)
+            changed.add(child.name)
+    set_dir_last_commit(repo_id, path, tree, lhs_tree, changed, commit_info)
 
     # (re)curse at our child trees
     for child_tree in tree.tree_ids:
@@ -491,6 +775,41 @@ def set_last_commit(repo_id, path, name, oid, commit_info):
     lc.m.save(safe=False, upsert=True)
     return lc
 
+def set_dir_last_commit(repo_id, path, tree, lhs_tree, changed, commit_info):
+    '''Materialize the last commit info of every entry of a changed tree.
+    Entries named in changed get commit_info; the rest keep what the LHS tree
+    of the same path had.  Nothing is saved if some entry's info is unknown,
+    and Tree.ls() falls back to the per-entry LastCommitDocs.'''
+    lhs_doc = None
+    if lhs_tree is not None and lhs_tree._id is not None:
+        lhs_doc = DirLastCommitDoc.m.get(
+            _id=dir_last_commit_id(repo_id, path, lhs_tree._id))
+    if lhs_doc is not None:
+        lhs_index = dict((e.name, e.commit_info) for e in lhs_doc.entries)
+    elif len(changed) < len(tree.tree_ids) + len(tree.blob_ids) + len(tree.other_ids):
+        # Commits are refreshed oldest first, so the LastCommitDocs still
+        # describe the LHS
+        id_re = re.compile('^{0}:{1}:'.format(
+            repo_id, re.escape(h.really_unicode(path).encode('utf-8'))))
+        lhs_index = dict(
+            (lc.name, lc.commit_info)
+            for lc in LastCommitDoc.m.find(dict(_id=id_re)))
+    else:
+        lhs_index = {}
+    entries = []
+    for child in chain(tree.tree_ids, tree.blob_ids, tree.other_ids):
+        if child.name in changed:
+            info = commit_info
+        else:
+            info = lhs_index.get(child.name)
+            if info is None: return None
+        entries.append(dict(name=child.name, commit_info=info))
+    doc = DirLastCommitDoc(dict(
+            _id=dir_last_commit_id(repo_id, path, tree._id),
+            entries=entries))
+    doc.m.save(safe=False)
+    return doc
+
 def last_known_commit_id(all_commit_ids, new_commit_ids):
     """
     Return the newest "known" (cached in mongo) commit id.
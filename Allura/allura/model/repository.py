@@ -160,6 +160,8 @@ class __mongometa__:
     branches = FieldProperty([dict(name=str,object_id=str, count=int)])
     repo_tags = FieldProperty([dict(name=str,object_id=str, count=int)])
     upstream_repo = FieldProperty(dict(name=str,url=str))
+    # number of commits in the repo, stored by refresh_counts
+    commit_count = FieldProperty(int, if_missing=None)
 
     def __init__(self, **kw):
         if 'name' in kw and 'tool' in kw:
@@ -225,6 +227,13 @@ def log(self, branch='master', offset=0, limit=10):
         return list(self._log(rev=branch, skip=offset, max_count=limit))
 
     def count(self, branch='master'):
+        '''Number of revisions in the history of branch: a head, branch or
+        tag name, a commit id, or None for the first head.  Read from the
+        counts stored by refresh_counts when branch is one of those.'''
+        for head in self.heads + self.branches + self.repo_tags:
+            if head.count is None: continue
+            if branch is None or branch in (head.name, head.object_id):
+                return head.count
         try:
             ci = self.commit(branch)
             if ci is None: return 0
@@ -318,17 +327,35 @@ def refresh(self, all_commits=False, notify=True):
             self.status = 'analyzing'
             session(self).flush(self)
             self._impl.refresh_heads()
+            commit_count = None
             if asbool(tg.config.get('scm.new_refresh')):
-                refresh_repo(self, all_commits, notify)
-            for head in self.heads + self.branches + self.repo_tags:
-                ci = self.commit(head.object_id)
-                if ci is not None:
-                    head.count = ci.count_revisions()
+                commit_count = refresh_repo(self, all_commits, notify)
+            self.refresh_counts(commit_count)
         finally:
             log.info('... %s ready', self)
             self.status = 'ready'
             session(self).flush(self)
 
+    def refresh_counts(self, commit_count=None):
+        '''Store the number of commits in the repo and in the history of each
+        of its heads, branches and tags, and return True if any of them
+        changed.  The number of commits in the repo is counted unless given
+        (as refresh_repo returns it).'''
+        changed = False
+        if commit_count is None:
+            commit_count = len(list(self.all_commit_ids()))
+        if self.commit_count != commit_count:
+            self.commit_count = commit_count
+            changed = True
+        for head in self.heads + self.branches + self.repo_tags:
+            ci = self.commit(head.object_id)
+            if ci is None: continue
+            count = ci.count_revisions()
+            if head.count != count:
+                head.count = count
+                changed = True
+        return changed
+
     def push_upstream_context(self):
         project, rest=h.find_project(self.upstream_repo.name)
         with h.push_context(project._id):
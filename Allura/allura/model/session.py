@@ -61,10 +61,11 @@ def update_index(self, objects_deleted, arefs):
         # Post delete and add indexing operations
         from allura.tasks import index_tasks
         if objects_deleted:
-            index_tasks.del_artifacts.post(
-                [obj.index_id() for obj in objects_deleted])
+            index_tasks.del_artifacts.post_coalesced(
+                'index', [obj.index_id() for obj in objects_deleted])
         if arefs:
-            index_tasks.add_artifacts.post([aref._id for aref in arefs])
+            index_tasks.add_artifacts.post_coalesced(
+                'index', [aref._id for aref in arefs])
 
 main_doc_session = Session.by_name('main')
 project_doc_session = Session.by_name('project')
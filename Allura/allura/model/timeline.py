@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 import bson
 from ming.odm import Mapper
 from activitystream import base
@@ -41,21 +43,116 @@ def has_activity_access(self, perm, user):
         return security.has_access(self, perm, user, self.project)
 
 
+# Timeline pages are filled up from at most this many times as many activities
+OVERFETCH_PAGES = 10
+
+def get_timeline(node, user, page=0, limit=100, actor_only=False):
+    """Return page `page` of the timeline of `node`, leaving out activities
+    on objects that `user` does not have 'read' access to.
+
+    Unlike passing perm_check(user) to g.director.get_timeline, hidden
+    activities don't make the page come out short: more activities are
+    fetched to fill it, up to OVERFETCH_PAGES times as many as it takes
+    without filtering.
+    """
+    from pylons import g
+    visible = []
+    raw_page = 0
+    while len(visible) < (page + 1) * limit:
+        activities = list(g.director.get_timeline(node, page=raw_page,
+                limit=limit, actor_only=actor_only))
+        visible.extend(filter_timeline(activities, user))
+        if len(activities) < limit:
+            break # timeline exhausted
+        raw_page += 1
+        if raw_page >= (page + 1) * OVERFETCH_PAGES:
+            break
+    return visible[page * limit:(page + 1) * limit]
+
+def filter_timeline(timeline, user, perm='read'):
+    """Return the activities in `timeline` that `user` has `perm` access to,
+    like filter(perm_check(user), timeline) but batched.
+
+    The objects of the activities are loaded with one query per class, the
+    user's roles in all their projects are loaded at once, each object is
+    checked once, and artifacts in the same tool with the same ACL share one
+    access decision.
+    """
+    from allura import model as M
+    keys = [ _activity_object_key(a) for a in timeline ]
+    ids_by_class = defaultdict(set)
+    for key in keys:
+        if key is not None:
+            ids_by_class[key[0]].add(key[1])
+    objects = {}
+    for classname, ids in ids_by_class.iteritems():
+        cls = Mapper.by_classname(classname).mapped_class
+        for obj in cls.query.find(dict(_id={'$in': list(ids)})):
+            objects[classname, obj._id] = obj
+    app_config_ids = set(
+        obj.app_config_id for obj in objects.itervalues()
+        if isinstance(obj, M.Artifact))
+    if app_config_ids:
+        project_ids = set(
+            ac.project_id for ac in M.AppConfig.query.find(
+                dict(_id={'$in': list(app_config_ids)})))
+        security.Credentials.get().load_user_roles(user._id, *project_ids)
+    access = {}
+    decisions = {}
+    result = []
+    for activity, key in zip(timeline, keys):
+        if key is None:
+            result.append(activity)
+            continue
+        if key not in access:
+            obj = objects.get(key)
+            if obj is None:
+                access[key] = False
+            else:
+                decision_key = _shared_access_key(obj)
+                if decision_key is None:
+                    access[key] = bool(obj.has_activity_access(perm, user))
+                else:
+                    if decision_key not in decisions:
+                        decisions[decision_key] = bool(
+                            obj.has_activity_access(perm, user))
+                    access[key] = decisions[decision_key]
+        if access[key]:
+            result.append(activity)
+    return result
+
 def perm_check(user):
     def _perm_check(activity):
         """Return True if c.user has 'read' access to this activity,
         otherwise return False.
         """
-        extras_dict = activity['obj'].get('activity_extras')
-        if not extras_dict: return True
-        allura_id = extras_dict.get('allura_id')
-        if not allura_id: return True
-        classname, _id = allura_id.split(':')
+        key = _activity_object_key(activity)
+        if key is None: return True
+        classname, _id = key
         cls = Mapper.by_classname(classname).mapped_class
-        try:
-            _id = bson.ObjectId(_id)
-        except bson.errors.InvalidId:
-            pass
         obj = cls.query.get(_id=_id)
         return obj and obj.has_activity_access('read', user)
     return _perm_check
+
+def _activity_object_key(activity):
+    """Return (classname, _id) of the object of an activity, or None if it
+    is not an Allura object."""
+    extras_dict = activity['obj'].get('activity_extras')
+    if not extras_dict: return None
+    allura_id = extras_dict.get('allura_id')
+    if not allura_id: return None
+    classname, _id = allura_id.split(':')
+    try:
+        _id = bson.ObjectId(_id)
+    except bson.errors.InvalidId:
+        pass
+    return classname, _id
+
+def _shared_access_key(obj):
+    """Key under which obj shares access decisions with other objects, or
+    None (see security.shared_access_key)."""
+    from allura.lib.security import shared_access_key
+    cls = obj.__class__
+    if cls.has_activity_access.im_func is not ActivityObject.has_activity_access.im_func:
+        return None
+    return shared_access_key(obj)
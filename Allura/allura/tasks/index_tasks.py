@@ -13,28 +13,15 @@
 def add_artifacts(ref_ids, update_solr=True, update_refs=True):
     '''Add the referenced artifacts to SOLR and shortlinks'''
     from allura import model as M
-    from allura.lib.search import find_shortlinks, solarize
-    exceptions = []
-    solr_updates = []
-    with _indexing_disabled(M.session.artifact_orm_session._get()):
-        for ref in M.ArtifactReference.query.find(dict(_id={'$in': ref_ids})):
-            try:
-                artifact = ref.artifact
-                s = solarize(artifact)
-                if s is None:
-                    continue
-                if update_solr:
-                    solr_updates.append(s)
-                if update_refs:
-                    if isinstance(artifact, M.Snapshot):
-                        continue
-                    ref.references = [
-                        link.ref_id for link in find_shortlinks(s['text']) ]
-            except Exception:
-                log.error('Error indexing artifact %s', ref._id)
-                exceptions.append(sys.exc_info())
-        g.solr.add(solr_updates)
+    refs = M.ArtifactReference.query.find(dict(_id={'$in': ref_ids}))
+    docs, errors = solarize_artifacts(
+        (ref.artifact for ref in refs), update_refs=update_refs)
+    for index_id, exc_info in errors:
+        log.error('Error indexing artifact %s', index_id)
+    if update_solr:
+        g.solr.add(docs)
 
+    exceptions = [ exc_info for index_id, exc_info in errors ]
     if len(exceptions) == 1:
         raise exceptions[0][0], exceptions[0][1], exceptions[0][2]
     if exceptions:
@@ -47,12 +34,39 @@ def del_artifacts(ref_ids):
     solr_query = 'id:({0})'.format(' || '.join(ref_ids))
     g.solr.delete(q=solr_query)
     M.ArtifactReference.query.remove(dict(_id={'$in':ref_ids}))
+    project_ids = set(
+        sl.project_id for sl in M.Shortlink.query.find(dict(ref_id={'$in':ref_ids})))
     M.Shortlink.query.remove(dict(ref_id={'$in':ref_ids}))
+    M.MarkdownCache.invalidate_links(*project_ids)
 
 @task
 def commit():
     g.solr.commit()
 
+def solarize_artifacts(artifacts, update_refs=True):
+    '''Build the SOLR documents of artifacts, also storing the references
+    they make to other artifacts if update_refs.  Returns the documents and
+    a list of (index_id, exc_info) for the artifacts that failed.'''
+    from allura import model as M
+    from allura.lib.search import find_shortlinks, solarize
+    docs = []
+    errors = []
+    with _indexing_disabled(M.session.artifact_orm_session._get()):
+        for artifact in artifacts:
+            try:
+                s = solarize(artifact)
+                if s is None:
+                    continue
+                docs.append(s)
+                if update_refs and not isinstance(artifact, M.Snapshot):
+                    M.ArtifactReference.query.update(
+                        dict(_id=artifact.index_id()),
+                        {'$set': dict(references=[
+                            link.ref_id for link in find_shortlinks(s['text']) ])})
+            except Exception:
+                errors.append((artifact.index_id(), sys.exc_info()))
+    return docs, errors
+
 @contextmanager
 def _indexing_disabled(session):
     session.disable_artifact_index = session.skip_mod_date = True
@@ -74,33 +74,38 @@ def sendmail(fromaddr, destinations, text, reply_to, subject,
         else:
             fromaddr = user.email_address_header()
     # Divide addresses based on preferred email formats
+    user_ids = []
     for addr in destinations:
         if mail_util.isvalid(addr):
             addrs_plain.append(addr)
         else:
             try:
-                user = M.User.query.get(_id=ObjectId(addr))
-                if not user:
-                    log.warning('Cannot find user with ID: %s', addr)
-                    continue
+                user_ids.append(ObjectId(addr))
             except:
                 log.exception('Error looking up user with ID: %r' % addr)
-                continue
-            addr = user.email_address_header()
-            if not addr and user.email_addresses:
-                addr = user.email_addresses[0]
-                log.warning('User %s has not set primary email address, using %s',
-                            user._id, addr)
-            if not addr:
-                log.error("User %s (%s) has not set any email address, can't deliver",
-                          user._id, user.username)
-                continue
-            if user.get_pref('email_format') == 'plain':
-                addrs_plain.append(addr)
-            elif user.get_pref('email_format') == 'html':
-                addrs_html.append(addr)
-            else:
-                addrs_multi.append(addr)
+    # Look up all the users at once rather than one query per destination
+    users = dict((u._id, u) for u in M.User.query.find(
+            {'_id': {'$in': user_ids}}))
+    for user_id in user_ids:
+        user = users.get(user_id)
+        if not user:
+            log.warning('Cannot find user with ID: %s', user_id)
+            continue
+        addr = user.email_address_header()
+        if not addr and user.email_addresses:
+            addr = user.email_addresses[0]
+            log.warning('User %s has not set primary email address, using %s',
+                        user._id, addr)
+        if not addr:
+            log.error("User %s (%s) has not set any email address, can't deliver",
+                      user._id, user.username)
+            continue
+        if user.get_pref('email_format') == 'plain':
+            addrs_plain.append(addr)
+        elif user.get_pref('email_format') == 'html':
+            addrs_html.append(addr)
+        else:
+            addrs_multi.append(addr)
     plain_msg = mail_util.encode_email_part(text, 'plain')
     html_text = g.forge_markdown(email=True).convert(text)
     html_msg = mail_util.encode_email_part(html_text, 'html')
@@ -5,8 +5,10 @@
 import re
 from datetime import datetime
 
+import mock
 from pylons import c
-from nose.tools import assert_raises
+from tg import config
+from nose.tools import assert_raises, assert_equal
 from nose import with_setup
 
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -65,11 +67,9 @@ def test_artifact():
     assert not security.has_access(pg, 'delete')(user=u)
     pg.acl.append(M.ACE.allow(pr._id, 'delete'))
     ThreadLocalORMSession.flush_all()
-    c.memoize_cache = {}
     assert security.has_access(pg, 'delete')(user=u)
     pg.acl.pop()
     ThreadLocalORMSession.flush_all()
-    c.memoize_cache = {}
     assert not security.has_access(pg, 'delete')(user=u)
     idx = pg.index()
     assert 'title_s' in idx
@@ -83,6 +83,67 @@ def test_artifact():
     assert 'TestPage' in pg.shorthand_id()
     assert pg.link_text() == pg.shorthand_id()
 
+@with_setup(setUp, tearDown)
+def test_compiled_acl():
+    role = M.ProjectRole.query.get(name='Developer')._id
+    other = M.ProjectRole.query.get(name='Member')._id
+    acl = [ M.ACE.deny(role, 'read'),
+            M.ACE.allow(M.EVERYONE, 'read'),
+            M.ACE.allow(role, 'read') ]
+    compiled = security.compile_acl(acl, 'read')
+    assert security.compile_acl(list(acl), 'read') is compiled
+    assert compiled.check((role,)) == (False, ())
+    assert compiled.check((role, other)) == (True, ())
+    assert security.compile_acl(acl, 'write').check((role, other)) == (
+        False, (role, other))
+
+@with_setup(setUp, tearDown)
+def test_has_access_many():
+    pg1 = WM.Page(title='TestPage1')
+    pg2 = WM.Page(title='TestPage2')
+    u = M.User.query.get(username='test-user')
+    pg2.acl.append(M.ACE.allow(u.project_role()._id, 'delete'))
+    ThreadLocalORMSession.flush_all()
+    REGISTRY.register(allura.credentials, allura.lib.security.Credentials())
+    c.memoize_cache = {}
+    assert security.has_access_many([pg1, pg2], 'delete', user=u) == [False, True]
+    assert security.has_access_many([pg1, pg2], 'read', user=u) == [True, True]
+    # per-request results follow changes to the object's own ACL
+    pg1.acl.append(M.ACE.allow(u.project_role()._id, 'delete'))
+    assert security.has_access(pg1, 'delete')(user=u)
+
+@with_setup(setUp, tearDown)
+def test_has_access_follows_parent_acls():
+    pg = WM.Page(title='TestPage1')
+    u = M.User.query.get(username='test-user')
+    ThreadLocalORMSession.flush_all()
+    REGISTRY.register(allura.credentials, allura.lib.security.Credentials())
+    c.memoize_cache = {}
+    assert not security.has_access(pg, 'delete')(user=u)
+    # the tool's ACL
+    c.app.config.acl.append(M.ACE.allow(u.project_role()._id, 'delete'))
+    assert security.has_access(pg, 'delete')(user=u)
+    c.app.config.acl.pop()
+    assert not security.has_access(pg, 'delete')(user=u)
+    # the project's, through its admin check
+    c.project.acl.append(M.ACE.allow(u.project_role()._id, 'admin'))
+    assert security.has_access(pg, 'delete')(user=u)
+
+@with_setup(setUp, tearDown)
+def test_has_access_stamps_chain_once():
+    pg = WM.Page(title='TestPage1')
+    u = M.User.query.get(username='test-user')
+    ThreadLocalORMSession.flush_all()
+    REGISTRY.register(allura.credentials, allura.lib.security.Credentials())
+    c.memoize_cache = {}
+    with mock.patch.object(security, '_access_stamps',
+                           wraps=security._access_stamps) as stamps:
+        assert not security.has_access(pg, 'delete')(user=u)
+    objs = [ args[0] for args, kw in stamps.call_args_list ]
+    assert_equal(len([ o for o in objs if o is pg ]), 1)
+    # the checks up the chain are passed the rest of it
+    assert not [ o for o in objs if o is c.app.config ]
+
 @with_setup(setUp, tearDown)
 def test_artifactlink():
     pg = WM.Page(title='TestPage2')
@@ -138,6 +199,40 @@ def test_versioning():
     ThreadLocalORMSession.flush_all()
     assert ss.text != pg.text
     assert pg.history().count() == 3
+    assert pg.last_edit.author.username == 'test-admin'
+    assert pg.last_edit.timestamp == pg.history().first().timestamp
+    assert pg.last_updated == pg.last_edit.timestamp
+
+def test_history_delta():
+    base = dict(title='a', text=''.join('line %d\n' % i for i in range(200)),
+                labels=['x'], gone=1)
+    data = dict(title='b', text=base['text'].replace('line 7\n', 'seven\n'),
+                labels=['x'])
+    delta = M.artifact.history_delta(base, data)
+    assert_equal(delta['set'], dict(title='b'))
+    assert_equal(delta['unset'], ['gone'])
+    assert_equal(M.artifact.apply_history_delta(base, delta), data)
+    assert M.artifact.history_delta(dict(text='x'), dict(text='y' * 10)) is None
+
+@with_setup(setUp, tearDown)
+def test_versioning_deltas():
+    texts = [ ''.join('line %d of version %d\n' % (i, i == 3 and v)
+                      for i in range(100)) for v in range(1, 6) ]
+    with mock.patch.dict(config, {'history.keyframe_interval': '3'}):
+        pg = WM.Page(title='TestPage4')
+        for text in texts:
+            pg.text = text
+            pg.commit()
+            ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    pg = WM.Page.query.get(title='TestPage4')
+    assert_equal([ ss.keyframe for ss in pg.history().sort('version', 1) ],
+                 [ None, 1, 1, None, 4 ])
+    for v, text in enumerate(texts):
+        assert_equal(pg.get_version(v + 1).text, text)
+    pg.revert(2)
+    assert_equal(pg.text, texts[1])
+    assert_equal(pg.version, 5)
 
 @with_setup(setUp, tearDown)
 def test_messages():
@@ -275,6 +275,13 @@ def test_post_url_paginated():
         'This is reply #0 to reply #1 to post #2',
         parent_id=p[7]._id, timestamp=ts))
 
+    # positions are kept up to date in the database
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    t = M.Thread.query.get(_id=t._id)
+    p = [ M.Post.query.get(_id=_p._id) for _p in p ]
+    assert_equals([ _p.position.threaded for _p in p ], range(len(p)))
+
     # with default paging limit
     for _p in p:
         url = t.url() + '?limit=50#' + _p.slug
@@ -292,6 +299,87 @@ def test_post_url_paginated():
         assert _p.url_paginated() == url, _p.url_paginated()
 
 
+@with_setup(setUp, tearDown)
+def test_post_positions():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow() - timedelta(days=1)
+    p0 = t.post('Post #0', timestamp=ts)
+    p1 = t.post('Post #1', timestamp=ts + timedelta(minutes=1))
+    r0 = t.post('Reply to post #0', parent_id=p0._id,
+                timestamp=ts + timedelta(minutes=2))
+    ThreadLocalORMSession.flush_all()
+    assert_equals(t.num_posts, 3)
+    def positions():
+        ThreadLocalORMSession.close_all()
+        posts = [ M.Post.query.get(_id=p._id) for p in (p0, p1, r0) ]
+        return [ p and (p.position.threaded, p.position.timestamp)
+                 for p in posts ]
+    assert_equals(positions(), [ (0, 0), (2, 1), (1, 2) ])
+    M.Post.query.get(_id=r0._id).spam()
+    ThreadLocalORMSession.flush_all()
+    assert_equals(positions(), [ (0, 0), (1, 1), (None, None) ])
+    M.Post.query.get(_id=p0._id).delete()
+    ThreadLocalORMSession.flush_all()
+    assert_equals(positions()[1], (0, 0))
+    t = M.Thread.query.get(_id=t._id)
+    assert_equals(t.num_posts, 1)
+    M.discuss.PostPositionDoc.m.update_partial(
+        {'_id': p1._id}, {'$set': {'threaded': 5}})
+    t.update_positions()
+    assert_equals(positions()[1], (0, 0))
+
+@with_setup(setUp, tearDown)
+def test_update_positions_repairs_duplicates():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow() - timedelta(days=1)
+    posts = [ t.post('Post #%d' % i, timestamp=ts + timedelta(minutes=i))
+              for i in range(3) ]
+    ThreadLocalORMSession.flush_all()
+    # as concurrent posts can leave them
+    M.discuss.PostPositionDoc.m.update_partial(
+        {'_id': posts[2]._id}, {'$set': {'threaded': 1, 'timestamp': 1}})
+    t.update_positions()
+    ThreadLocalORMSession.close_all()
+    assert_equals(
+        [ M.Post.query.get(_id=p._id).position.timestamp for p in posts ],
+        [ 0, 1, 2 ])
+
+@with_setup(setUp, tearDown)
+def test_count_post_is_atomic():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    t.post('Post #0')
+    ThreadLocalORMSession.flush_all()
+    assert_equals(t.num_posts, 1)
+    # another request approves a post meanwhile
+    M.discuss.ThreadCountDoc.m.update_partial(
+        {'_id': t._id}, {'$inc': {'num_posts': 1}})
+    t.post('Post #1')
+    ThreadLocalORMSession.flush_all()
+    assert_equals(t.num_posts, 3)
+    ThreadLocalORMSession.close_all()
+    assert_equals(M.Thread.query.get(_id=t._id).num_posts, 3)
+
+@with_setup(setUp, tearDown)
+def test_stale_post_keeps_position():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread(discussion_id=d._id, subject='Test Thread')
+    ts = datetime.utcnow() - timedelta(days=1)
+    p1 = t.post('Post #1', timestamp=ts + timedelta(minutes=1))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    stale = M.Post.query.get(_id=p1._id)
+    # another request posts before it meanwhile
+    t = M.Thread.query.get(_id=t._id)
+    t.post('Post #0', timestamp=ts)
+    ThreadLocalORMSession.flush_all()
+    stale.text = 'Edited'
+    session(stale).flush(stale)
+    assert_equals(M.Post.query.get(_id=p1._id).position.timestamp, 1)
+
+
 @with_setup(setUp, tearDown)
 def test_post_notify():
     d = M.Discussion(shortname='test', name='test')
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+import mock
+from nose.tools import with_setup, assert_equal
+from pylons import g, c
+from tg import config
+
+from ming.orm import ThreadLocalORMSession
+
+from alluratest.controller import setup_basic_test, setup_global_objects
+from allura import model as M
+from allura.lib import helpers as h
+from allura.model.markdown_cache import MarkdownCacheDoc
+from forgewiki import model as WM
+
+def setUp():
+    setup_basic_test()
+    ThreadLocalORMSession.close_all()
+    setup_global_objects()
+    MarkdownCacheDoc.m.remove({})
+    M.MarkdownCache.clear_local()
+    for k in M.MarkdownCache.stats:
+        M.MarkdownCache.stats[k] = 0
+
+@with_setup(setUp)
+def test_get_put():
+    assert M.MarkdownCache.get('k') is None
+    M.MarkdownCache.put('k', u'<p>html</p>')
+    assert_equal(M.MarkdownCache.get('k'), u'<p>html</p>')
+    assert_equal(M.MarkdownCache.stats['local_hits'], 1)
+    M.MarkdownCache.clear_local()
+    assert_equal(M.MarkdownCache.get('k'), u'<p>html</p>')
+    assert_equal(M.MarkdownCache.stats['hits'], 1)
+    M.MarkdownCache.put('n', None)
+    assert M.MarkdownCache.get('n') is M.MarkdownCache.UNCACHEABLE
+
+@with_setup(setUp)
+def test_expiry():
+    M.MarkdownCache.put('k', u'html', ttl=60)
+    assert_equal(M.MarkdownCache.get('k'), u'html')
+    M.MarkdownCache.clear_local()
+    MarkdownCacheDoc.m.update_partial(
+        dict(_id='k'),
+        {'$set': dict(expires=datetime.utcnow() - timedelta(seconds=1))})
+    assert M.MarkdownCache.get('k') is None
+
+@with_setup(setUp)
+def test_evict():
+    now = datetime.utcnow()
+    for i in range(5):
+        MarkdownCacheDoc(dict(
+                _id=str(i), html=u'html',
+                last_used=now - timedelta(minutes=i))).m.save()
+    with mock.patch.dict(config, {'markdown_cache.max_entries': '3'}):
+        M.MarkdownCache.evict()
+    assert_equal(sorted(d._id for d in MarkdownCacheDoc.m.find()),
+                 ['0', '1', '2'])
+
+@with_setup(setUp)
+def test_convert_cached():
+    h.set_context('test', 'wiki', neighborhood='Projects')
+    with mock.patch.dict(config, {'markdown_cache.enabled': 'true'}):
+        html = g.markdown.convert('Some *text*')
+        assert_equal(g.markdown.convert('Some *text*'), html)
+        assert_equal(M.MarkdownCache.stats['misses'], 1)
+        assert_equal(M.MarkdownCache.stats['local_hits'], 1)
+        doc = MarkdownCacheDoc.m.find().one()
+        assert_equal(doc.html, html)
+        assert doc.expires is None
+        # links are cached with the link version of their project
+        g.markdown.convert('See [Home]')
+        doc = MarkdownCacheDoc.m.get(_id=g.markdown.cache_key('See [Home]'))
+        assert doc.expires is None
+        assert_equal([ lv.project_id for lv in doc.link_versions ],
+                     [ c.project._id ])
+        # macros are not cached
+        g.markdown.convert('[[include ref=Home]]')
+        doc = MarkdownCacheDoc.m.get(
+            _id=g.markdown.cache_key('[[include ref=Home]]'))
+        assert doc.html is None
+        g.markdown.convert('[[include ref=Home]]')
+        assert_equal(M.MarkdownCache.stats['uncacheable'], 1)
+
+@with_setup(setUp)
+def test_new_shortlink_invalidates_links():
+    h.set_context('test', 'wiki', neighborhood='Projects')
+    with mock.patch.dict(config, {'markdown_cache.enabled': 'true'}):
+        html = g.markdown_wiki.convert('See [NewPage]')
+        assert 'notfound' in html
+        assert_equal(g.markdown_wiki.convert('See [NewPage]'), html)
+        assert_equal(M.MarkdownCache.stats['local_hits'], 1)
+        WM.Page(title='NewPage')
+        ThreadLocalORMSession.flush_all()
+        misses = M.MarkdownCache.stats['misses']
+        html = g.markdown_wiki.convert('See [NewPage]')
+        assert 'notfound' not in html
+        assert_equal(M.MarkdownCache.stats['misses'], misses + 1)
+        # other processes see the change too
+        M.MarkdownCache.clear_local()
+        assert_equal(g.markdown_wiki.convert('See [NewPage]'), html)
+        assert_equal(M.MarkdownCache.stats['hits'], 1)
+
+@with_setup(setUp)
+def test_link_versions_once_per_request():
+    pid = c.project._id
+    with mock.patch('allura.model.markdown_cache.request') as request:
+        request.environ = {}
+        assert_equal(M.MarkdownCache.link_versions([pid]), {pid: 0})
+        with mock.patch('allura.model.markdown_cache.MarkdownLinkVersionDoc') as doc:
+            assert_equal(M.MarkdownCache.link_versions([pid]), {pid: 0})
+            assert not doc.m.find.called
+        M.MarkdownCache.invalidate_links(pid)
+        assert_equal(M.MarkdownCache.link_versions([pid]), {pid: 1})
@@ -1,5 +1,12 @@
+import time
 import pprint
-from nose.tools import with_setup
+import threading
+
+import mock
+import pymongo
+from nose.tools import with_setup, assert_equal
+from tg import config
+from pylons import c
 
 from ming.orm import ThreadLocalORMSession
 
@@ -21,3 +28,164 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+@with_setup(setUp)
+def test_get_many():
+    for i in range(5):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    tasks = M.MonQTask.get_many(3, process='worker-1')
+    assert len(tasks) == 3, tasks
+    assert all(t.state == 'busy' and t.process == 'worker-1' for t in tasks)
+    more_tasks = M.MonQTask.get_many(3, process='worker-2')
+    assert len(more_tasks) == 2, more_tasks
+    assert M.MonQTask.get_many(3, process='worker-3') == []
+    args = sorted(t.args[0][0] for t in tasks + more_tasks)
+    assert args == range(5), args
+    task = more_tasks[0]
+    task()
+    assert task.result == 'I%s' % task.args[0], task.result
+
+@with_setup(setUp)
+def test_coalesce():
+    t1 = M.MonQTask.post(pprint.pformat, ([1, 2],), coalesce_key='k')
+    t2 = M.MonQTask.post(pprint.pformat, ([3],), coalesce_key='k')
+    t3 = M.MonQTask.post(pprint.pformat, ([4],), coalesce_key='other')
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    assert t1._id == t2._id
+    assert t1._id != t3._id
+    assert M.MonQTask.query.find().count() == 2
+    task = M.MonQTask.query.get(_id=t1._id)
+    assert task.args == [[1, 2, 3]], task.args
+    task = M.MonQTask.get()
+    task()
+    t4 = M.MonQTask.post(pprint.pformat, ([5],), coalesce_key='k')
+    ThreadLocalORMSession.flush_all()
+    assert t4._id != t1._id, 'coalesced into a task that is no longer ready'
+
+@with_setup(setUp)
+def test_coalesce_per_user():
+    t1 = M.MonQTask.post(pprint.pformat, ([1],), coalesce_key='k')
+    c.user = M.User.by_username('test-user')
+    try:
+        t2 = M.MonQTask.post(pprint.pformat, ([2],), coalesce_key='k')
+    finally:
+        c.user = M.User.by_username('test-admin')
+    ThreadLocalORMSession.flush_all()
+    assert t1._id != t2._id, 'coalesced tasks from different users'
+    assert t1.args == [[1]], t1.args
+
+class _CappedCollection(object):
+    '''Just enough of a capped collection for MonQWakeup to tail: mim has
+    no tailable cursors'''
+
+    def __init__(self):
+        self.docs = [ dict(_id=0, task_id=None, task_name=None) ]
+        self.posted = threading.Condition()
+
+    def insert(self, doc):
+        with self.posted:
+            # decreasing, like ObjectIds from a process with a slow clock
+            doc['_id'] = -len(self.docs)
+            self.docs.append(doc)
+            self.posted.notify_all()
+
+    def find(self, spec=None, tailable=False, await_data=False):
+        assert not spec
+        if tailable:
+            return _TailCursor(self)
+        return mock.Mock(**{'sort.return_value.limit.return_value': self.docs[-1:]})
+
+    def find_one(self, spec):
+        for doc in self.docs:
+            if doc['_id'] == spec['_id']:
+                return doc
+
+class _TailCursor(object):
+    alive = True
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.pos = -1
+
+    def next(self):
+        with self.collection.posted:
+            if len(self.collection.docs) <= self.pos + 1:
+                self.collection.posted.wait(0.5) # awaitData
+            if len(self.collection.docs) <= self.pos + 1:
+                raise StopIteration
+            self.pos += 1
+            return self.collection.docs[self.pos]
+
+@with_setup(setUp)
+def test_wakeup_on_post():
+    collection = _CappedCollection()
+    woken = []
+    def worker():
+        woken.append(M.MonQWakeup().wait(10))
+    with mock.patch.object(M.MonQWakeup, 'collection', return_value=collection), \
+            mock.patch.dict(config, {'monq.wakeup': 'tail'}):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.2)
+        start = time.time()
+        task = M.MonQTask.post(pprint.pformat, ([1],))
+        thread.join(5)
+    assert_equal(woken, [True])
+    assert time.time() - start < 2
+    assert_equal(collection.docs[-1]['task_id'], task._id)
+
+@with_setup(setUp)
+def test_wakeup_timeout():
+    with mock.patch.object(M.MonQWakeup, 'collection',
+                           return_value=_CappedCollection()):
+        assert not M.MonQWakeup().wait(0.2)
+
+@with_setup(setUp)
+def test_wakeup_resumes_in_natural_order():
+    collection = _CappedCollection()
+    with mock.patch.object(M.MonQWakeup, 'collection', return_value=collection):
+        wakeup = M.MonQWakeup()
+        assert not wakeup.wait(0.1)
+        collection.insert(dict(task_id=1, task_name='a'))
+        assert wakeup.wait(1)
+        # a new cursor must not replay the posts already seen
+        wakeup.cursor.alive = False
+        assert not wakeup.wait(0.2)
+        collection.insert(dict(task_id=2, task_name='b'))
+        wakeup.cursor.alive = False
+        assert wakeup.wait(1)
+        assert_equal(wakeup.last_id, collection.docs[-1]['_id'])
+
+@with_setup(setUp)
+def test_wakeup_creates_collection():
+    db = mock.MagicMock()
+    db.collection_names.return_value = []
+    with mock.patch('allura.model.monq_model.main_doc_session') as session, \
+            mock.patch.object(M.MonQWakeup, '_collection', None):
+        session.db = db
+        assert M.MonQWakeup.collection() is db.__getitem__.return_value
+        db.create_collection.assert_called_once_with(
+            M.MonQWakeup.collection_name, capped=True, size=1024 * 1024)
+        # with a document, as tailing an empty capped collection fails
+        assert db.__getitem__.return_value.insert.called
+        # another process may create it first
+        db.reset_mock()
+        db.collection_names.return_value = []
+        db.create_collection.side_effect = pymongo.errors.CollectionInvalid
+        M.MonQWakeup._collection = None
+        assert M.MonQWakeup.collection() is db.__getitem__.return_value
+
+@with_setup(setUp)
+def test_wakeup_without_capped_collection():
+    # e.g. the collection was dropped, and notify() recreated it uncapped
+    collection = mock.Mock()
+    collection.find.return_value.sort.return_value.limit.return_value = [dict(_id=1)]
+    collection.find.return_value.next.side_effect = pymongo.errors.OperationFailure(
+        'tailable cursor requested on non capped collection')
+    with mock.patch.object(M.MonQWakeup, 'collection', return_value=collection):
+        start = time.time()
+        assert not M.MonQWakeup().wait(0.2)
+        assert time.time() - start >= 0.2
@@ -117,15 +117,36 @@ def test_email(self):
         assert not mboxes[1].queue_empty
 
         email_tasks = M.MonQTask.query.find({'state': 'ready'}).all()
-        assert_equal(len(email_tasks), 2)  # make sure both subscribers will get an email
+        # both subscribers get the same email, sent once
+        assert_equal(len(email_tasks), 1)
 
-        first_destinations = [e.kwargs['destinations'][0] for e in email_tasks]
-        assert_in(str(c.user._id), first_destinations)
-        assert_in(str(user2._id), first_destinations)
+        destinations = email_tasks[0].kwargs['destinations']
+        assert_in(str(c.user._id), destinations)
+        assert_in(str(user2._id), destinations)
         assert_equal(email_tasks[0].kwargs['fromaddr'], '"Test Admin" <test-admin@users.localhost>')
-        assert_equal(email_tasks[1].kwargs['fromaddr'], '"Test Admin" <test-admin@users.localhost>')
         assert email_tasks[0].kwargs['text'].startswith('WikiPage Home modified by Test Admin')
         assert 'you indicated interest in ' in email_tasks[0].kwargs['text']
+        assert M.Mailbox.stats['delivered'] >= 2
+        assert M.Mailbox.stats['fired'] >= 2
+
+    def test_email_readers(self):
+        self._subscribe()
+        user2 = M.User.query.get(username='test-user-2')
+        self._subscribe(user=user2)
+        self._post_notification()
+        ThreadLocalORMSession.flush_all()
+        from allura.model.notification import security
+        orig = security.has_access
+        def patched_has_access(obj, permission, user=None, project=None):
+            return lambda: user._id != user2._id
+        security.has_access = patched_has_access
+        try:
+            M.MonQTask.run_ready()
+        finally:
+            security.has_access = orig
+        email_tasks = M.MonQTask.query.find({'state': 'ready'}).all()
+        assert_equal(len(email_tasks), 1)
+        assert_equal(email_tasks[0].kwargs['destinations'], [ str(c.user._id) ])
 
     def test_permissions(self):
         # Notification should only be delivered if user has read perms on the
@@ -2,8 +2,13 @@
 """
 Model tests for project
 """
-from nose.tools import with_setup
+from datetime import datetime
+
+import mock
+from bson import ObjectId
+from nose.tools import with_setup, assert_equal
 from pylons import c
+from tg import config
 from ming.orm.ormsession import ThreadLocalORMSession
 
 from allura import model as M
@@ -69,3 +74,62 @@ def test_subproject():
     ThreadLocalORMSession.flush_all()
     sp.delete()
     ThreadLocalORMSession.flush_all()
+
+@with_setup(setUp)
+def test_sitemap_cache():
+    M.NavCache.clear_local()
+    for k in M.NavCache.stats:
+        M.NavCache.stats[k] = 0
+    with mock.patch.dict(config, {'nav_cache.enabled': 'true'}):
+        labels = [ s.label for s in c.project.sitemap() ]
+        assert_equal([ s.label for s in c.project.sitemap() ], labels)
+        assert_equal(M.NavCache.stats, dict(hits=1, misses=1))
+        assert_equal(M.Project.menus([c.project])[c.project._id][0].label, labels[0])
+        # installing a tool changes the nav version of the project
+        c.project.install_app('Wiki', 'nav-cache-wiki', 'Nav Cache Wiki')
+        ThreadLocalORMSession.flush_all()
+        assert 'Nav Cache Wiki' in [ s.label for s in c.project.sitemap() ]
+        assert_equal(M.NavCache.stats['misses'], 3)
+        c.project.uninstall_app('nav-cache-wiki')
+        ThreadLocalORMSession.flush_all()
+        assert_equal([ s.label for s in c.project.sitemap() ], labels)
+
+@with_setup(setUp)
+def test_subproject_nav_version():
+    sp = c.project.new_subproject('nav-version')
+    ThreadLocalORMSession.flush_all()
+    def version():
+        return M.NavCache.versions([c.project._id])[c.project._id]
+    v = version()
+    sp.last_updated = datetime.utcnow()
+    ThreadLocalORMSession.flush_all()
+    assert_equal(version(), v)
+    sp.name = 'Renamed Subproject'
+    ThreadLocalORMSession.flush_all()
+    assert_equal(version(), v + 1)
+
+@with_setup(setUp)
+def test_project_directory():
+    q = dict(neighborhood_id=c.project.neighborhood_id)
+    listed = M.ProjectDirectory.count(q)
+    assert M.ProjectDirectory.find(dict(q, _id=c.project._id)) == [c.project._id]
+    c.project.labels = [ 'directory' ]
+    c.project.private = True
+    ThreadLocalORMSession.flush_all()
+    assert_equal(M.ProjectDirectory.find(dict(q, labels='directory')), [c.project._id])
+    assert_equal(M.ProjectDirectory.count(dict(q, private=True)), 1)
+    assert_equal(M.ProjectDirectory.sample(dict(q, labels='directory')), [c.project._id])
+    # entries of projects that are gone are removed by a rebuild
+    M.project_directory.ProjectDirectoryDoc(dict(
+            _id=ObjectId.from_datetime(datetime(2000, 1, 1)),
+            neighborhood_id=c.project.neighborhood_id)).m.save()
+    assert_equal(M.ProjectDirectory.count(q), listed + 1)
+    assert_equal(M.ProjectDirectory.rebuild(c.project.neighborhood_id), listed)
+    assert_equal(M.ProjectDirectory.count(q), listed)
+    assert_equal(M.ProjectDirectory.find(dict(q, labels='directory')), [c.project._id])
+    sp = c.project.new_subproject('directory-sub')
+    ThreadLocalORMSession.flush_all()
+    assert_equal(M.ProjectDirectory.count(q), listed + 1)
+    sp.deleted = True
+    ThreadLocalORMSession.flush_all()
+    assert_equal(M.ProjectDirectory.count(q), listed)
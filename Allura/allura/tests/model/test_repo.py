@@ -135,6 +135,30 @@ def test_count_revisions(self):
         self.repo._impl.commit = mock.Mock(return_value=ci)
         assert self.repo.count() == 42
 
+    def test_count_stored(self):
+        self.repo.heads = [ ming.base.Object(name='master', object_id='foo0', count=7) ]
+        self.repo._impl.commit = mock.Mock()
+        assert_equal(self.repo.count(), 7)
+        assert_equal(self.repo.count('foo0'), 7)
+        assert_equal(self.repo.count(None), 7)
+        assert not self.repo._impl.commit.called
+
+    def test_refresh_counts(self):
+        ci = mock.Mock()
+        ci.count_revisions = mock.Mock(return_value=3)
+        self.repo._impl.commit = mock.Mock(return_value=ci)
+        self.repo._impl.all_commit_ids = mock.Mock(return_value=['foo2', 'foo1', 'foo0'])
+        self.repo.heads = [ ming.base.Object(name='master', object_id='foo2') ]
+        assert self.repo.refresh_counts()
+        assert_equal(self.repo.commit_count, 3)
+        assert_equal(self.repo.heads[0].count, 3)
+        assert not self.repo.refresh_counts()
+        # with the number of commits given, the history isn't walked again
+        self.repo._impl.all_commit_ids.reset_mock()
+        assert self.repo.refresh_counts(4)
+        assert_equal(self.repo.commit_count, 4)
+        assert not self.repo._impl.all_commit_ids.called
+
     def test_latest(self):
         ci = mock.Mock()
         self.repo._impl.commit = mock.Mock(return_value=ci)
@@ -203,6 +227,85 @@ def set_heads():
         assert M.Feed.query.find(dict(
             title='New commit',
             author_name='Test Committer')).count()
+        assert_equal(self.repo.commit_count, 100)
+
+    def test_refresh_resumes_checkpoint(self):
+        commit_ids = ['foo%d' % i for i in range(10) ]
+        for oid in commit_ids:
+            M.repo.CommitDoc(dict(_id=oid, parent_ids=[], child_ids=[])).m.insert()
+        M.repo_refresh.RefreshCheckpoint.start(
+            self.repo, False, commit_ids).save('runs')
+        self.repo._impl.all_commit_ids = mock.Mock(return_value=commit_ids)
+        self.repo._impl.refresh_commit_info = mock.Mock()
+        M.repo_refresh.refresh_repo(self.repo, notify=False)
+        # commit info was done before the interruption, and nothing is new
+        assert not self.repo._impl.refresh_commit_info.called
+        assert M.repo.CommitRunDoc.m.find(dict(commit_ids='foo0')).count()
+        assert M.repo.RefreshCheckpointDoc.m.get(_id=self.repo._id) is None
+        assert not M.repo.RefreshCheckpointChunkDoc.m.find().count()
+
+    def test_refresh_children_across_chunks(self):
+        # newest first, like all_commit_ids(): foo0's parent is foo1, ...
+        commit_ids = ['foo%d' % i for i in range(5) ]
+        def refresh_commit_info(oid, seen, lazy=False):
+            i = int(oid[3:])
+            parent_ids = commit_ids[i+1:i+2]
+            # like ForgeGit, which resets the child_ids
+            M.repo.CommitDoc.m.update_partial(
+                dict(_id=oid),
+                {'$set': dict(parent_ids=parent_ids, child_ids=[])},
+                upsert=True)
+        self.repo._impl.all_commit_ids = mock.Mock(return_value=commit_ids)
+        self.repo._impl.refresh_commit_info = refresh_commit_info
+        with mock.patch.object(M.repo_refresh, 'CHUNKSIZE', 2):
+            M.repo_refresh.refresh_repo(self.repo, all_commits=True, notify=False)
+        for child, parent in zip(commit_ids, commit_ids[1:]):
+            assert_equal(M.repo.CommitDoc.m.get(_id=parent).child_ids, [child])
+        assert_equal(M.repo.CommitDoc.m.get(_id='foo0').child_ids, [])
+
+    def test_checkpoint_chunks(self):
+        commit_ids = ['foo%d' % i for i in range(5) ]
+        with mock.patch.object(M.repo_refresh, 'CHECKPOINT_CHUNKSIZE', 2):
+            M.repo_refresh.RefreshCheckpoint.start(
+                self.repo, False, commit_ids).save('diffs', 3)
+            assert_equal(M.repo.RefreshCheckpointChunkDoc.m.find().count(), 3)
+            # a refresh resuming with a commit pushed since
+            checkpoint = M.repo_refresh.RefreshCheckpoint.start(
+                self.repo, False, ['foo5'] + commit_ids)
+        assert_equal(checkpoint.commit_ids, ['foo5'] + commit_ids)
+        assert_equal((checkpoint.stage, checkpoint.position), ('commits', 0))
+        # an incomplete list is not trusted
+        M.repo.RefreshCheckpointChunkDoc.m.remove({'chunk': 1})
+        checkpoint = M.repo_refresh.RefreshCheckpoint.start(
+            self.repo, False, commit_ids)
+        assert_equal(checkpoint.commit_ids, commit_ids)
+
+    def test_refresh_commit_repos(self):
+        commit_ids = ['foo%d' % i for i in range(3) ]
+        for oid in commit_ids:
+            M.repo.CommitDoc(dict(_id=oid, repo_ids=[])).m.insert()
+        M.repo_refresh.refresh_commit_repos(commit_ids, self.repo)
+        for oid in commit_ids:
+            ci = M.repo.CommitDoc.m.get(_id=oid)
+            assert_equal(ci.repo_ids, [self.repo._id])
+            index_id = 'allura.model.repo.Commit#' + oid
+            assert M.index.ArtifactReferenceDoc.m.get(_id=index_id)
+            links = M.index.ShortlinkDoc.m.find(dict(ref_id=index_id)).all()
+            assert_equal(sorted(l.link for l in links), sorted([oid, oid[:6]]))
+        # redoing commits whose repo_ids were not written yet, as a resumed
+        # refresh does, leaves one set of links
+        M.repo.CommitDoc.m.update_partial(
+            {}, {'$set': dict(repo_ids=[])}, multi=True)
+        M.repo_refresh.refresh_commit_repos(commit_ids, self.repo)
+        for oid in commit_ids:
+            index_id = 'allura.model.repo.Commit#' + oid
+            assert_equal(M.index.ShortlinkDoc.m.find(dict(ref_id=index_id)).count(), 2)
+
+    def test_load_commits(self):
+        for oid in ('a', 'b', 'c'):
+            M.repo.CommitDoc(dict(_id=oid)).m.insert()
+        cis = M.repo_refresh.load_commits(['c', 'missing', 'a', 'b'])
+        assert_equal([ci._id for ci in cis], ['c', 'a', 'b'])
 
     def test_refresh_private(self):
         ci = mock.Mock()
@@ -300,6 +403,32 @@ def test_get_last_commit_missing(self):
         lc1 = M.repo.LastCommitDoc.m.get(object_id=obj._id)
         assert lc1 is None
 
+    def test_set_dir_last_commit(self):
+        lhs = Object(_id='lhs', tree_ids=[], other_ids=[], blob_ids=[
+                Object(name='a', id='a1'), Object(name='b', id='b1')])
+        rhs = Object(_id='rhs', tree_ids=[], other_ids=[], blob_ids=[
+                Object(name='a', id='a1'), Object(name='b', id='b2')])
+        old_info = M.repo_refresh.get_commit_info(self.ci)
+        new_info = dict(old_info, id='bar')
+        # without any info for 'a', nothing is materialized
+        assert M.repo_refresh.set_dir_last_commit(
+            self.repo._id, '/', rhs, lhs, set(['b']), new_info) is None
+        M.repo_refresh.set_last_commit(self.repo._id, '/', 'a', 'a1', old_info)
+        M.repo_refresh.set_dir_last_commit(
+            self.repo._id, '/', rhs, lhs, set(['b']), new_info)
+        doc = M.repo.DirLastCommitDoc.m.get(
+            _id=M.repo.dir_last_commit_id(self.repo._id, '/', 'rhs'))
+        assert_equal(
+            dict((e.name, e.commit_info.id) for e in doc.entries),
+            dict(a='foo', b='bar'))
+
+    def test_ls_uses_dir_last_commit(self):
+        tree = self.ci.tree
+        M.repo.DirLastCommitDoc(dict(
+                _id=M.repo.dir_last_commit_id(self.repo._id, '/', tree._id),
+                entries=[])).m.save()
+        assert_equal(tree.ls(), [])
+
     def test_artifact_methods(self):
         assert self.ci.index_id() == 'allura/model/repo/Commit#foo', self.ci.index_id()
         assert self.ci.primary() is self.ci, self.ci.primary()
@@ -322,6 +451,20 @@ def setUp(self):
         self.repo._impl.shorthand_for_commit = impl.shorthand_for_commit
         self.repo._impl.url_for_commit = impl.url_for_commit
 
+    def test_ls_saves_dir_last_commit_at_head(self):
+        info = M.repo_refresh.get_commit_info(self.ci)
+        M.repo_refresh.set_last_commit(
+            self.repo._id, '/', 'a', self.tree.tree_ids[0].id, info)
+        lc_id = M.repo.dir_last_commit_id(self.repo._id, '/', self.tree._id)
+        self.tree.set_context(self.ci)
+        # the tree of an older commit, which may have changed since
+        self.repo.heads = [ Object(name='master', object_id='bar') ]
+        assert_equal(self.tree.ls()[0]['last_commit']['id'], 'foo')
+        assert M.repo.DirLastCommitDoc.m.get(_id=lc_id) is None
+        self.repo.heads = [ Object(name='master', object_id='foo') ]
+        assert_equal(self.tree.ls()[0]['last_commit']['id'], 'foo')
+        assert M.repo.DirLastCommitDoc.m.get(_id=lc_id)
+
     def test_upsert(self):
         obj0, isnew0 = M.repo.Commit.upsert('foo')
         obj1, isnew1 = M.repo.Commit.upsert('foo')
@@ -457,6 +600,126 @@ def open_blob(blob):
     def test_context(self):
         self.ci.context()
 
+class TestCommitGraph(_TestWithRepo):
+
+    def setUp(self):
+        super(TestCommitGraph, self).setUp()
+        # a - b - c - e - f
+        #  \         /
+        #   --- d ---
+        # committed in the order a, b, d, c, e, f
+        self.parents = dict(a=[], b=['a'], c=['b'], d=['a'], e=['c', 'd'], f=['e'])
+        self.days = dict(a=1, b=2, c=4, d=3, e=5, f=6)
+        for oid, parent_ids in self.parents.iteritems():
+            M.repo.CommitDoc(dict(
+                    _id=oid, parent_ids=parent_ids,
+                    committed=dict(date=datetime(2012, 1, self.days[oid])))).m.insert()
+        M.repo.CommitGraph._cache.clear()
+
+    def test_refresh_commit_graph(self):
+        M.repo_refresh.refresh_commit_graph(self.repo, ['f', 'e', 'd', 'c', 'b', 'a'])
+        M.repo.CommitGraph._cache.clear()
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        assert_equal(len(graph), 6)
+        # newest first, like commitlog
+        assert_equal(graph.log('f'), ['f', 'e', 'c', 'd', 'b', 'a'])
+        assert_equal(graph.log('f', 2, 2), ['c', 'd'])
+        assert_equal(graph.log('c'), ['c', 'b', 'a'])
+        assert_equal(graph.log('c', 1), ['b', 'a'])
+        assert_equal(graph.log('d', 1, 5), ['a'])
+        assert_equal(graph.count('f'), 6)
+        assert_equal(graph.count('d'), 2)
+        assert graph.is_ancestor('a', 'f')
+        assert graph.is_ancestor('d', 'e')
+        assert not graph.is_ancestor('d', 'c')
+        assert not graph.is_ancestor('f', 'a')
+
+    def test_incremental(self):
+        M.repo_refresh.refresh_commit_graph(self.repo, ['c', 'b', 'a'])
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        assert_equal(len(graph), 3)
+        M.repo_refresh.refresh_commit_graph(self.repo, ['f', 'e', 'd', 'c', 'b', 'a'])
+        # cached graphs are replaced, never changed
+        assert_equal(len(graph), 3)
+        assert_equal(len(M.repo.CommitGraph.get(self.repo._id)), 6)
+        # a stale cached graph is replaced by a reloaded copy
+        M.repo.CommitGraph._cache[self.repo._id] = graph
+        new_graph = M.repo.CommitGraph.get(self.repo._id)
+        assert new_graph is not graph
+        assert_equal(len(graph), 3)
+        assert_equal(len(new_graph), 6)
+        assert_equal(new_graph.count('f'), 6)
+        assert_equal(new_graph.log('f'), ['f', 'e', 'c', 'd', 'b', 'a'])
+
+    def test_clock_skew(self):
+        # e claims to be older than c and d, but still comes before them
+        M.repo.CommitDoc.m.update_partial(
+            dict(_id='e'), {'$set': {'committed.date': datetime(2012, 1, 2)}})
+        M.repo_refresh.refresh_commit_graph(self.repo, ['f', 'e', 'd', 'c', 'b', 'a'])
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        assert_equal(graph.log('f'), ['f', 'e', 'd', 'c', 'b', 'a'])
+
+    def test_rebuild(self):
+        M.repo_refresh.refresh_commit_graph(self.repo, ['f', 'e', 'd', 'c', 'b', 'a'])
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        # e and f were force-pushed away, and g replaces them
+        M.repo.CommitDoc(dict(_id='g', parent_ids=['c'])).m.insert()
+        M.repo_refresh.refresh_commit_graph(self.repo, ['g', 'd', 'c', 'b', 'a'])
+        assert 'f' in graph
+        # a graph cached before the rebuild is reloaded in full
+        M.repo.CommitGraph._cache[self.repo._id] = graph
+        new_graph = M.repo.CommitGraph.get(self.repo._id)
+        assert_equal(len(new_graph), 5)
+        assert 'f' not in new_graph
+        assert_equal(new_graph.log('g'), ['g', 'c', 'b', 'a'])
+        # and so is its layout, without the commits that are gone
+        size, width, rows = M.repo.CommitLayout.window(new_graph, 0, 10)
+        assert_equal(size, 5)
+        assert_equal(sorted(row[0] for row in rows), ['a', 'b', 'c', 'd', 'g'])
+
+    def test_count_merges(self):
+        # g merges c and f back together
+        M.repo.CommitDoc(dict(_id='g', parent_ids=['c', 'f'])).m.insert()
+        M.repo_refresh.refresh_commit_graph(
+            self.repo, ['g', 'f', 'e', 'd', 'c', 'b', 'a'])
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        assert_equal(graph.count('e'), 5)
+        assert_equal(graph.count('g'), 7)
+
+    def test_commit_uses_graph(self):
+        M.repo_refresh.refresh_commit_graph(self.repo, ['f', 'e', 'd', 'c', 'b', 'a'])
+        ci = M.repo.Commit.query.get(_id='f')
+        ci.set_context(self.repo)
+        assert_equal(ci.count_revisions(), 6)
+        assert_equal([c._id for c in ci.log(1, 2)], ['e', 'c'])
+
+    def test_commit_layout(self):
+        M.repo_refresh.refresh_commit_graph(self.repo, ['c', 'b', 'a'])
+        M.repo_refresh.refresh_commit_graph(self.repo, ['f', 'e', 'd', 'c', 'b', 'a'])
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        size, width, rows = M.repo.CommitLayout.window(graph, 0, 3)
+        assert_equal(size, 6)
+        assert_equal(width, 2)
+        assert_equal(rows, [
+                ('f', 0, 0, [(1, 0, 0)]),
+                ('e', 1, 0, [(3, 0, 0), (2, 1, 1)]),
+                ('d', 2, 1, [(5, 0, 1)])])
+        size, width, rows = M.repo.CommitLayout.window(graph, 3, 10)
+        assert_equal(rows, [
+                ('c', 3, 0, [(4, 0, 0)]),
+                ('b', 4, 0, [(5, 0, 0)]),
+                ('a', 5, 0, [])])
+        # a new branch from c gets a column that was free since c
+        M.repo.CommitDoc(dict(_id='g', parent_ids=['c'])).m.insert()
+        M.repo_refresh.refresh_commit_graph(
+            self.repo, ['g', 'f', 'e', 'd', 'c', 'b', 'a'])
+        graph = M.repo.CommitGraph.get(self.repo._id)
+        size, width, rows = M.repo.CommitLayout.window(graph, 0, 1)
+        assert_equal((size, width), (7, 3))
+        assert_equal(rows, [('g', 0, 2, [(4, 0, 2)])])
+        assert_equal(M.repo.CommitLayout.window(graph, 1, 1)[2],
+                     [('f', 1, 0, [(2, 0, 0)])])
+
 class TestGitLikeTree(object):
 
     def test_set_blob(self):
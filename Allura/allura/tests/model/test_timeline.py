@@ -0,0 +1,67 @@
+import mock
+from bson import ObjectId
+from nose.tools import with_setup, assert_equal
+
+from ming.orm import ThreadLocalORMSession
+
+from alluratest.controller import setup_basic_test, setup_global_objects
+from allura import model as M
+from allura.lib import helpers as h
+from allura.model.timeline import filter_timeline, get_timeline
+
+def setUp():
+    setup_basic_test()
+    setup_global_objects()
+    h.set_context('test', 'wiki', neighborhood='Projects')
+
+def tearDown():
+    ThreadLocalORMSession.close_all()
+
+def _activity(allura_id):
+    return dict(obj=dict(activity_extras=dict(allura_id=allura_id)))
+
+@with_setup(setUp, tearDown)
+def test_filter_timeline():
+    d1 = M.Discussion(shortname='d1', name='d1')
+    d2 = M.Discussion(shortname='d2', name='d2')
+    ThreadLocalORMSession.flush_all()
+    user = M.User.by_username('test-admin')
+    activities = [
+        _activity(d1.allura_id),
+        _activity(d2.allura_id),
+        _activity(d1.allura_id),
+        dict(obj=dict()),
+        _activity('Discussion:%s' % ObjectId()),
+        ]
+    with mock.patch('allura.lib.security.has_access') as has_access:
+        has_access.return_value = True
+        assert_equal(filter_timeline(activities, user), activities[:4])
+        # same tool and ACL, so one decision covers both discussions
+        assert_equal(has_access.call_count, 1)
+        has_access.return_value = False
+        assert_equal(filter_timeline(activities, user), activities[3:4])
+    d2.acl = [ M.ACE.allow(M.EVERYONE, 'read') ]
+    ThreadLocalORMSession.flush_all()
+    with mock.patch('allura.lib.security.has_access') as has_access:
+        has_access.return_value = True
+        filter_timeline(activities, user)
+        assert_equal(has_access.call_count, 2)
+
+@with_setup(setUp, tearDown)
+def test_get_timeline_fills_page():
+    d = M.Discussion(shortname='d', name='d')
+    ThreadLocalORMSession.flush_all()
+    user = M.User.by_username('test-admin')
+    hidden = _activity('Discussion:%s' % ObjectId())
+    raw = [hidden, _activity(d.allura_id)] * 5
+    def raw_timeline(node, page, limit, actor_only):
+        return raw[page * limit:(page + 1) * limit]
+    with mock.patch('pylons.g') as g, \
+            mock.patch('allura.lib.security.has_access') as has_access:
+        has_access.return_value = True
+        g.director.get_timeline.side_effect = raw_timeline
+        timeline = get_timeline(None, user, page=0, limit=3)
+        assert_equal(len(timeline), 3)
+        assert_equal(g.director.get_timeline.call_count, 2)
+        timeline = get_timeline(None, user, page=1, limit=3)
+        assert_equal(len(timeline), 2)
@@ -125,6 +125,52 @@ def test_update_neighborhood():
     assert nb.has_home_tool == False
 
 
+class TestReindexCommand(object):
+
+    def test_run(self):
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--chunk-size', '1'])
+        p = M.Project.query.get(shortname='test')
+        docs = cmd.globals.solr.db.values()
+        assert docs
+        assert all(d['project_id_s'] == str(p._id) for d in docs), docs
+        assert M.ArtifactReference.query.find(
+            {'artifact_reference.project_id': p._id}).count() >= len(docs)
+        assert M.index.ReindexCheckpointDoc.m.find().count() == 0
+
+    def test_resume(self):
+        p = M.Project.query.get(shortname='test')
+        # Pretend a reindex died after indexing every artifact class
+        done = [ show_models._class_name(cls)
+                 for cls in show_models.build_model_inheritance_graph() ]
+        M.index.ReindexCheckpointDoc(dict(
+                _id='reindex:test:*:solr',
+                project_id=p._id,
+                done_classes=done)).m.save()
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--solr', '--resume'])
+        assert cmd.num_docs == 0
+        assert M.index.ReindexCheckpointDoc.m.find().count() == 0
+        # Without --resume the checkpoint is ignored
+        M.index.ReindexCheckpointDoc(dict(
+                _id='reindex:test:*:solr',
+                project_id=p._id,
+                done_classes=done)).m.save()
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.run([test_config, '-p', 'test', '--solr'])
+        assert cmd.num_docs == len(cmd.globals.solr.db) > 0
+
+    def test_solr_batches(self):
+        docs = [ dict(id=i, text='x' * size)
+                 for i, size in enumerate([1, 1, 1, 10, 1]) ]
+        batches = list(show_models._solr_batches(docs, 2, 5))
+        assert_equal([ [d['id'] for d in b] for b in batches ],
+                     [ [0, 1], [2], [3], [4] ])
+        # list text is measured joined
+        docs = [ dict(id=0, text=['xx', 'xx']), dict(id=1, text='x') ]
+        batches = list(show_models._solr_batches(docs, 2, 5))
+        assert_equal([ [d['id'] for d in b] for b in batches ], [ [0], [1] ])
+
 class TestEnsureIndexCommand(object):
 
     def test_run(self):
@@ -200,6 +200,25 @@ def test_markdown():
 def foo(): pass
 ~~~~''')
 
+@with_setup(setUp)
+def test_markdown_engines_reused():
+    h.set_context('test', 'wiki', neighborhood='Projects')
+    md = g.markdown
+    assert g.markdown is md
+    assert g.forge_markdown(email=True) is not md
+    assert g.forge_markdown(email=True) is g.forge_markdown(email=True)
+    # each conversion starts from a clean state
+    md.convert('[Home]')
+    assert md.postprocessors['forge'].parent.alinks
+    md.convert('No links')
+    assert not md.postprocessors['forge'].parent.alinks
+    # an engine that is converting is not handed out again
+    md.in_use = True
+    try:
+        assert g.markdown is not md
+    finally:
+        md.in_use = False
+
 @with_setup(setUp)
 def test_sort_alpha():
     p_nbhd = M.Neighborhood.query.get(name='Projects')
@@ -0,0 +1,44 @@
+from nose.tools import assert_equal
+
+from allura.lib import query_profiler
+
+
+class FakeCollection(object):
+    name = 'fake'
+
+    def find_one(self, spec):
+        return spec
+
+    def update(self, spec, document):
+        return None
+
+
+def test_query_shape():
+    assert_equal(query_profiler.shape_key(query_profiler.query_shape(
+                {'_id': {'$in': [1, 2]}, 'deleted': False,
+                 '$or': [{'a': 1}, {'b': 'x'}]})),
+                 '{$or: [{a: ?}, {b: ?}], _id: {$in: [?]}, deleted: ?}')
+    assert_equal(query_profiler.solr_query_shape('type_s:"Ticket" AND ticket_num_i:42'),
+                 'type_s:? AND ticket_num_i:?')
+
+
+def test_profiling():
+    query_profiler.instrument(FakeCollection, 'mongo', 'find_one', 'update')
+    coll = FakeCollection()
+    assert_equal(coll.find_one({'_id': 1}), {'_id': 1})
+    with query_profiler.profiling(threshold=3) as profile:
+        for i in range(3):
+            coll.find_one({'_id': i})
+        coll.update({'_id': 1}, {'$set': {'a': 1}})
+    assert query_profiler.current() is None
+    report = profile.report()
+    assert_equal(report['ops'], 4)
+    assert_equal([ (s['op'], s['count']) for s in report['shapes'] ],
+                 [ ('find_one', 3), ('update', 1) ])
+    assert_equal(len(report['suspects']), 1)
+    assert_equal(report['suspects'][0]['shape'], '{_id: ?}')
+    assert 'test_query_profiler.py' in report['suspects'][0]['sites'][0]
+    report_id = query_profiler.QueryProfiler.add('wiki /Home', '/p/test/wiki/Home/', report)
+    assert_equal(query_profiler.QueryProfiler.get(report_id)['ops'], 4)
+    assert_equal(query_profiler.QueryProfiler.endpoints['wiki /Home']['suspects'],
+                 {'mongo fake.find_one {_id: ?}': 1})
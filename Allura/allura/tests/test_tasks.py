@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import mailbox
 import operator
+import Queue
 import sys
 import shutil
+import tempfile
 import unittest
 from base64 import b64encode
+from contextlib import contextmanager
 
 import mock
+import tg
 import pylons
 pylons.c = pylons.tmpl_context
 pylons.g = pylons.app_globals
@@ -104,6 +109,15 @@ def test_del_artifacts(self, solr):
         solr.delete.assert_called_once_with(q=solr_query)
 
 
+@contextmanager
+def mock_smtp_client():
+    '''Send the mail of mail_tasks over a single mock SMTP connection'''
+    _client = mock.Mock()
+    pool = Queue.LifoQueue()
+    pool.put(_client)
+    with mock.patch.object(mail_tasks.smtp_client, '_pool', pool):
+        yield _client
+
 class TestMailTasks(unittest.TestCase):
 
     def setUp(self):
@@ -115,7 +129,7 @@ def setUp(self):
 
     def test_send_email_ascii_with_user_lookup(self):
         c.user = M.User.by_username('test-admin')
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock_smtp_client() as _client:
             mail_tasks.sendmail(
                 fromaddr=str(c.user._id),
                 destinations=[ str(c.user._id) ],
@@ -137,7 +151,7 @@ def test_send_email_ascii_with_user_lookup(self):
             assert_in('<div class="markdown_content"><p>This is a test</p></div>', body)
 
     def test_send_email_nonascii(self):
-        with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+        with mock_smtp_client() as _client:
             mail_tasks.sendmail(
                 fromaddr=u'"По" <foo@bar.com>',
                 destinations=[ 'blah@blah.com' ],
@@ -161,6 +175,56 @@ def test_send_email_nonascii(self):
             assert_in('Content-Transfer-Encoding: base64', body)
             assert_in(b64encode(u'Громады стройные теснятся'.encode('utf-8')), body)
 
+    def test_send_email_max_recipients(self):
+        destinations = [ 'blah%d@blah.com' % i for i in range(5) ]
+        with mock_smtp_client() as _client:
+            with mock.patch.dict(tg.config, {'smtp_max_recipients': '2'}):
+                mail_tasks.sendmail(
+                    fromaddr=u'foo@bar.com',
+                    destinations=destinations,
+                    text=u'This is a test',
+                    reply_to=u'noreply@sf.net',
+                    subject=u'Test subject',
+                    message_id=h.gen_message_id())
+            assert_equal(_client.sendmail.call_count, 3)
+            assert_equal([ args[0][1] for args in _client.sendmail.call_args_list ],
+                         [ destinations[0:2], destinations[2:4], destinations[4:] ])
+
+    def test_send_email_sink(self):
+        path = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(mail_tasks.smtp_client, '_pool', None), \
+                    mock.patch.dict(tg.config, {'smtp_sink': path}):
+                mail_tasks.sendmail(
+                    fromaddr=u'foo@bar.com',
+                    destinations=[ 'blah@blah.com', 'blah2@blah.com' ],
+                    text=u'This is a test',
+                    reply_to=u'noreply@sf.net',
+                    subject=u'Test subject',
+                    message_id=h.gen_message_id())
+            messages = mailbox.Maildir(path, factory=None).values()
+            assert_equal(len(messages), 1)
+            assert_equal(messages[0]['X-Envelope-To'], 'blah@blah.com, blah2@blah.com')
+            assert_equal(messages[0]['Subject'], 'Test subject')
+        finally:
+            shutil.rmtree(path)
+
+    def test_send_email_reuses_connection(self):
+        with mock.patch.object(mail_tasks.smtp_client, '_pool', None), \
+                mock.patch.dict(tg.config, {'smtp_pool_size': '2'}), \
+                mock.patch.object(mail_tasks.smtp_client, '_connect') as _connect:
+            for i in range(3):
+                mail_tasks.sendmail(
+                    fromaddr=u'foo@bar.com',
+                    destinations=[ 'blah@blah.com' ],
+                    text=u'This is a test',
+                    reply_to=u'noreply@sf.net',
+                    subject=u'Test subject',
+                    message_id=h.gen_message_id())
+            assert_equal(_connect.call_count, 1)
+            assert_equal(_connect.return_value.sendmail.call_count, 3)
+            assert_equal(mail_tasks.smtp_client._pool.qsize(), 2)
+
     @td.with_wiki
     def test_receive_email_ok(self):
         c.user = M.User.by_username('test-admin')
@@ -208,7 +272,7 @@ def test_init(self):
     def test_clone(self):
         ns = M.Notification.query.find().count()
         with mock.patch.object(c.app.repo, 'init_as_clone') as f:
-            with mock.patch.object(mail_tasks.smtp_client, '_client') as _client:
+            with mock_smtp_client() as _client:
                 repo_tasks.clone('foo', 'bar', 'baz')
                 M.main_orm_session.flush()
                 f.assert_called_with('foo', 'bar', 'baz', False)
@@ -30,6 +30,42 @@ def test_can_iterate(self):
         assert len(chunks) > 1, chunks
         assert len(chunks[0]) == 2, chunks[0]
 
+class TestKeysetPaging(unittest.TestCase):
+
+    def setUp(self):
+        from allura import model as M
+        setup_unit_test()
+        for i in range(10):
+            p = M.User.upsert('keyset-user-%d' % i)
+
+    def test_pages(self):
+        from allura import model as M
+        query = dict(username={'$regex': '^keyset-user-'})
+        sort = [ ('username', -1) ]
+        names = []
+        after = None
+        while True:
+            if after:
+                q = M.User.query.find(utils.keyset_query(query, sort, after))
+            else:
+                q = M.User.query.find(query)
+            users = q.sort(utils.keyset_sort(sort)).limit(3).all()
+            names.extend(u.username for u in users)
+            if len(users) < 3: break
+            after = utils.keyset_token(users[-1], sort)
+        assert names == [ 'keyset-user-%d' % i for i in reversed(range(10)) ], names
+
+    def test_invalid_token(self):
+        self.assertRaises(ValueError, utils.keyset_query, {}, [], 'garbage')
+
+    def test_and_query(self):
+        assert utils.and_query({'a': 1}, {'b': 2}) == {'a': 1, 'b': 2}
+        assert utils.and_query(
+            {'$or': [{'a': 1}, {'a': 2}]}, {'$or': [{'b': 1}]}) == {
+            '$or': [{'a': 1, 'b': 1}, {'a': 2, 'b': 1}]}
+        assert utils.and_query({'$or': [{'a': 1}]}, {'$or': [{'a': 2}]}) == {
+            '$and': [{'$or': [{'a': 1}]}, {'$or': [{'a': 2}]}]}
+
 class TestAntispam(unittest.TestCase):
 
     def setUp(self):
@@ -104,6 +104,11 @@ def blob(name, id):
 
 
 class TestRefreshLastCommit(unittest.TestCase):
+    def setUp(self):
+        patcher = patch('allura.model.repo_refresh.set_dir_last_commit')
+        self.set_dir_last_commit = patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch('allura.model.repo_refresh.TreeDoc.m.get')
     @patch('allura.model.repo_refresh.set_last_commit')
     def test_no_changes(self, set_last_commit, get):
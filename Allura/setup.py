@@ -119,6 +119,8 @@
     create-trove-categories = allura.command:CreateTroveCategoriesCommand
     set-neighborhood-features = allura.command:SetNeighborhoodFeaturesCommand
     reclone-repo = allura.command.reclone_repo:RecloneRepoCommand
+    rebuild-project-directory = allura.command.project_directory:RebuildProjectDirectoryCommand
+    check-commit-counts = allura.command.commit_counts:CheckCommitCountsCommand
 
     [easy_widgets.resources]
     ew_resources=allura.config.resources:register_ew_resources
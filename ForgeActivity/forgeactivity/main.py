@@ -13,7 +13,7 @@
 from allura import version
 from allura.controllers import BaseController
 from allura.lib.security import require_authenticated
-from allura.model.timeline import perm_check
+from allura.model.timeline import get_timeline
 
 from .widgets.follow import FollowToggle
 
@@ -70,9 +70,8 @@ def index(self, **kw):
             actor_only = False
 
         following = g.director.is_connected(c.user, followee)
-        timeline = g.director.get_timeline(followee, page=kw.get('page', 0),
-                limit=kw.get('limit', 100), actor_only=actor_only,
-                filter_func=perm_check(c.user))
+        timeline = get_timeline(followee, c.user, page=int(kw.get('page', 0)),
+                limit=int(kw.get('limit', 100)), actor_only=actor_only)
         return dict(followee=followee, following=following, timeline=timeline)
 
     @expose('json:')
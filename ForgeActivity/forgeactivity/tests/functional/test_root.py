@@ -41,6 +41,7 @@ def test_follow_user(self):
     @td.with_user_project('test-admin')
     @patch('forgeactivity.main.g.director')
     def test_viewing_own_user_project(self, director):
+        director.get_timeline.return_value = []
         resp = self.app.get('/u/test-admin/activity/')
         assert director.get_timeline.call_count == 1
         assert director.get_timeline.call_args[0][0].username == 'test-admin'
@@ -50,6 +51,7 @@ def test_viewing_own_user_project(self, director):
     @td.with_user_project('test-user-1')
     @patch('forgeactivity.main.g.director')
     def test_viewing_other_user_project(self, director):
+        director.get_timeline.return_value = []
         resp = self.app.get('/u/test-user-1/activity/')
         assert director.get_timeline.call_count == 1
         assert director.get_timeline.call_args[0][0].username == 'test-user-1'
@@ -58,6 +60,7 @@ def test_viewing_other_user_project(self, director):
     @td.with_tool('test', 'activity')
     @patch('forgeactivity.main.g.director')
     def test_viewing_project_activity(self, director):
+        director.get_timeline.return_value = []
         resp = self.app.get('/p/test/activity/')
         assert director.get_timeline.call_count == 1
         assert director.get_timeline.call_args[0][0].shortname == 'test'
@@ -5,6 +5,7 @@
 from ming import schema
 from ming.utils import LazyProperty
 from ming.orm import FieldProperty, RelationProperty, ForeignIdProperty, Mapper
+from ming.orm import session
 
 from allura import model as M
 from allura.lib import utils
@@ -237,6 +238,9 @@ def move(self, thread, new_parent_id):
             for att in post.attachments:
                 att.discussion_id=self.discussion_id
                 att.thread_id=self.thread_id
+        session(self).flush()
+        placeholder.thread.update_positions()
+        thread.update_positions()
 
 class ForumAttachment(M.DiscussionAttachment):
     DiscussionClass=Forum
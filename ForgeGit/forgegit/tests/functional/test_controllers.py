@@ -90,7 +90,12 @@ def test_commit_browser_data(self):
                  u'oid': u'df30427c488aeab84b2352bdf88a3b19223f9d7a',
                  u'column': 0,
                  u'parents': [u'6a45885ae7347f1cac5103b0050cc1be6a1496c8'],
+                 u'edges': [[2, 0, 0]],
                  u'message': u'Add README', u'row': 1})
+        resp = self.app.get('/src-git/commit_browser_data?start=2&limit=1')
+        data = json.loads(resp.body);
+        assert_equal(data['max_row'], 3)
+        assert_equal(data['commits'], [u'6a45885ae7347f1cac5103b0050cc1be6a1496c8'])
 
     def test_log(self):
         resp = self.app.get('/src-git/ref/master~/log/')
@@ -234,7 +239,8 @@ def test_timezone(self):
 class TestRestController(_TestCase):
 
     def test_index(self):
-        self.app.get('/rest/p/test/src-git/', status=200)
+        resp = self.app.get('/rest/p/test/src-git/', status=200)
+        assert_equal(json.loads(resp.body)['commit_count'], 4)
 
     def test_commits(self):
         self.app.get('/rest/p/test/src-git/commits', status=200)
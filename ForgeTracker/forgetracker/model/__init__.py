@@ -1 +1 @@
-from ticket import Globals, Bin, Ticket, TicketAttachment
+from ticket import Globals, Bin, Ticket, TicketAttachment, TicketCounter
@@ -0,0 +1,153 @@
+'''Ticket and comment statistics of a tracker, each computed in a single pass
+over its collection: with an aggregation pipeline where MongoDB supports it
+(2.2 and later), otherwise by streaming just the fields needed.'''
+import logging
+from datetime import datetime, timedelta
+
+from pymongo.errors import OperationFailure
+from ming import collection, Field
+from ming import schema as S
+from ming.orm import mapper
+
+from allura.model.session import project_doc_session
+from allura.lib.zarkov_helpers import zero_fill_zarkov_result, to_utc_timestamp
+
+log = logging.getLogger(__name__)
+
+# The counts of the stats page of the tracker TrackerStatsDoc._id (its
+# app_config_id), cached until expire.  They are kept apart from the
+# tracker's Globals, so that caching them never rewrites the Globals.
+TrackerStatsDoc = collection(
+    'tracker_stats', project_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('stats', None),
+    Field('expire', datetime))
+
+def aggregate(cls, pipeline):
+    '''Run an aggregation pipeline on the collection of cls, or return None
+    if the database can't'''
+    try:
+        result = project_doc_session.db.command(
+            'aggregate', mapper(cls).collection.m.collection_name,
+            pipeline=pipeline)
+    except (OperationFailure, NotImplementedError), e:
+        # no aggregation framework before MongoDB 2.2, nor in mim
+        log.debug('Aggregation not available: %s', e)
+        return None
+    return result['result']
+
+def count_since(cls, query, date_field, since, group_field=None):
+    '''Count the documents matching query, and of those the ones whose
+    date_field is at least each of the datetimes in since, grouped by
+    group_field if given.  Returns { group: [ total, n_since... ] }.'''
+    group = dict(
+        _id=group_field and '$' + group_field,
+        total={'$sum': 1})
+    for i, d in enumerate(since):
+        group['since%d' % i] = {'$sum': {
+                '$cond': [ {'$gte': [ '$' + date_field, d ] }, 1, 0 ] } }
+    result = aggregate(cls, [ {'$match': query}, {'$group': group} ])
+    if result is not None:
+        return dict(
+            (r['_id'], [ r['total'] ] + [
+                    r['since%d' % i] for i in range(len(since)) ])
+            for r in result)
+    counts = {}
+    fields = [ date_field ] + (group_field and [ group_field ] or [])
+    for doc in _find(cls, query, fields):
+        key = group_field and doc.get(group_field)
+        n = counts.setdefault(key, [0] * (len(since) + 1))
+        n[0] += 1
+        date = doc.get(date_field)
+        for i, d in enumerate(since):
+            if date is not None and date >= d:
+                n[i + 1] += 1
+    return counts
+
+def count_by_period(cls, query, date_field, begin, end, period):
+    '''Count the documents matching query by the day (period='date') or month
+    (period='month') of date_field, for dates from begin until end.  Returns
+    { first datetime of the period: n }.'''
+    query = dict(query)
+    query[date_field] = {'$gte': begin, '$lt': end}
+    group_id = {
+        'y': {'$year': '$' + date_field},
+        'm': {'$month': '$' + date_field}}
+    if period == 'date':
+        group_id['d'] = {'$dayOfMonth': '$' + date_field}
+    result = aggregate(cls, [
+            {'$match': query},
+            {'$group': {'_id': group_id, 'n': {'$sum': 1}}} ])
+    counts = {}
+    if result is not None:
+        for r in result:
+            k = r['_id']
+            counts[datetime(k['y'], k['m'], k.get('d', 1))] = r['n']
+        return counts
+    for doc in _find(cls, query, [ date_field ]):
+        date = doc[date_field]
+        if period == 'date':
+            k = datetime(date.year, date.month, date.day)
+        else:
+            k = datetime(date.year, date.month, 1)
+        counts[k] = counts.get(k, 0) + 1
+    return counts
+
+def tracker_stats(globals, now=None):
+    '''The counts shown on the tracker stats page'''
+    from forgetracker.model import Ticket
+    from allura.model import Post, AppConfig
+    if now is None: now = datetime.utcnow()
+    since = [ now - timedelta(weeks=n) for n in (1, 2, 4) ]
+    result = dict(total=0, open=0, closed=0,
+                  week_tickets=0, fortnight_tickets=0, month_tickets=0)
+    by_status = count_since(
+        Ticket, dict(app_config_id=globals.app_config_id),
+        'created_date', since, group_field='status')
+    for status, counts in by_status.iteritems():
+        result['total'] += counts[0]
+        if status in globals.set_of_open_status_names:
+            result['open'] += counts[0]
+        elif status in globals.set_of_closed_status_names:
+            result['closed'] += counts[0]
+        result['week_tickets'] += counts[1]
+        result['fortnight_tickets'] += counts[2]
+        result['month_tickets'] += counts[3]
+    app_config = AppConfig.query.get(_id=globals.app_config_id)
+    comments = count_since(
+        Post, dict(discussion_id=app_config.discussion_id),
+        'timestamp', since).get(None, [0, 0, 0, 0])
+    result.update(
+        comments=comments[0],
+        week_comments=comments[1],
+        fortnight_comments=comments[2],
+        month_comments=comments[3])
+    return result
+
+def tracker_stats_data(globals, begin, end):
+    '''Tickets opened and closed over time between begin and end, by day (by
+    month for ranges of over six months), in the format of the Zarkov
+    tracker stats.  The date a ticket was closed is taken to be its last
+    change.'''
+    from forgetracker.model import Ticket
+    period = 'date'
+    if end - begin > timedelta(days=183):
+        period = 'month'
+    until = end + timedelta(days=1)
+    opened = count_by_period(
+        Ticket, dict(app_config_id=globals.app_config_id),
+        'created_date', begin, until, period)
+    closed = count_by_period(
+        Ticket, dict(app_config_id=globals.app_config_id,
+                     status={'$in': list(globals.set_of_closed_status_names)}),
+        'mod_date', begin, until, period)
+    data = dict(
+        opened=[ [ to_utc_timestamp(d), n ] for d, n in opened.iteritems() ],
+        closed=[ [ to_utc_timestamp(d), n ] for d, n in closed.iteritems() ])
+    if period == 'month':
+        begin = begin.replace(day=1)
+    return zero_fill_zarkov_result(dict(data=data), period, begin, end)
+
+def _find(cls, query, fields):
+    return mapper(cls).collection.m.find(
+        query, dict((f, 1) for f in fields), validate=False)
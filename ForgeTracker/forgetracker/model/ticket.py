@@ -14,7 +14,7 @@
 
 from ming import schema
 from ming.utils import LazyProperty
-from ming.orm import Mapper, session
+from ming.orm import Mapper, session, mapper
 from ming.orm import FieldProperty, ForeignIdProperty, RelationProperty
 from ming.orm.declarative import MappedClass
 
@@ -29,6 +29,8 @@
 from allura.lib import utils
 from allura.lib import helpers as h
 
+from .stats import tracker_stats, TrackerStatsDoc
+
 log = logging.getLogger(__name__)
 
 config = utils.ConfigProxy(
@@ -44,6 +46,7 @@ class __mongometa__:
     type_s = 'Globals'
     _id = FieldProperty(schema.ObjectId)
     app_config_id = ForeignIdProperty('AppConfig', if_missing=lambda:c.app.config._id)
+    app_config = RelationProperty('AppConfig')
     last_ticket_num = FieldProperty(int)
     status_names = FieldProperty(str)
     open_status_names = FieldProperty(str)
@@ -55,6 +58,12 @@ class __mongometa__:
     _bin_counts_expire = FieldProperty(datetime)
     _milestone_counts = FieldProperty([dict(name=str,hits=int,closed=int)])
     _milestone_counts_expire = FieldProperty(datetime)
+    _counts_reconciled = FieldProperty(datetime, if_missing=None)
+    _stats = FieldProperty(schema.Deprecated)
+    _stats_expire = FieldProperty(schema.Deprecated)
+
+    # how long the numbers on the stats page are cached
+    stats_ttl = timedelta(minutes=5)
 
     @classmethod
     def next_ticket_num(cls):
@@ -116,8 +125,14 @@ def _refresh_counts(self):
             datetime.utcnow() + timedelta(minutes=60)
 
     def bin_count(self, name):
-        if self._bin_counts_expire < datetime.utcnow():
-            self._refresh_counts()
+        if self._bin_counts_expire < datetime.utcnow() \
+                and not getattr(self, '_refresh_posted', False):
+            # Bins are arbitrary searches, so they can't be counted as
+            # tickets change; recount them in the background and serve the
+            # old counts until then
+            Globals.query.update(dict(_id=self._id), {'$set': dict(
+                        _bin_counts_expire=datetime.utcnow() + timedelta(minutes=60))})
+            self.post_refresh_counts()
         for d in self._bin_counts_data:
             if d['summary'] == name: return d
         return dict(summary=name, hits=0)
@@ -127,15 +142,142 @@ def milestone_count(self, name):
         d = dict(name=name, hits=0, closed=0)
         if not (fld_name and m_name):
             return d
-        mongo_query = {'custom_fields.%s' % fld_name: m_name}
-        r = Ticket.query.find(dict(
-            mongo_query, app_config_id=c.app.config._id))
-        tickets = [t for t in r if security.has_access(t, 'read')]
-        d['hits'] = len(tickets)
-        d['closed'] = sum(1 for t in tickets
-                          if t.status in c.app.globals.set_of_closed_status_names)
+        counts = self.ticket_counts(name)
+        d['hits'] = counts['hits']
+        d['closed'] = counts['closed']
         return d
 
+    def ticket_counts(self, name, user=None):
+        '''Number of tickets, and of closed tickets, counted under name that
+        the user can read (see TicketCounter)'''
+        if user is None: user = c.user
+        self.check_counts()
+        counts = dict(hits=0, closed=0)
+        can_read_private = self.can_read_private(user)
+        for counter in TicketCounter.query.find(dict(
+                app_config_id=self.app_config_id, name=name)):
+            if counter.private and not can_read_private:
+                continue
+            counts['hits'] += counter.hits
+            counts['closed'] += counter.closed
+        if not can_read_private and not user.is_anonymous():
+            # the private tickets the user reported are readable all the same
+            fld_name, value = name.split(':', 1)
+            if fld_name != 'status':
+                fld_name = 'custom_fields.' + fld_name
+            own = {
+                'app_config_id': self.app_config_id,
+                fld_name: value,
+                'acl': {'$ne': []},
+                'deleted': {'$ne': True},
+                'reported_by_id': user._id}
+            hits = Ticket.query.find(own).count()
+            counts['hits'] += hits
+            if fld_name == 'status':
+                if value in self.set_of_closed_status_names:
+                    counts['closed'] += hits
+            else:
+                own['status'] = {'$in': list(self.set_of_closed_status_names)}
+                counts['closed'] += Ticket.query.find(own).count()
+        return counts
+
+    def can_read_private(self, user):
+        '''Whether the user can read every private ticket in the tracker
+        (see Ticket.private)'''
+        project = self.app_config.project
+        developer = ProjectRole.by_name('Developer', project)
+        if developer is not None:
+            roles = security.Credentials.get().user_roles(
+                user_id=user._id, project_id=project.root_project._id)
+            if developer._id in roles.reaching_ids:
+                return True
+        return bool(security.has_access(project, 'admin', user=user)())
+
+    def check_counts(self):
+        '''The ticket counters are kept up to date as tickets are saved, and
+        reconciled with the tickets once a day in the background.  The first
+        time a tracker is counted there is nothing to show meanwhile, so it is
+        counted right away.'''
+        now = datetime.utcnow()
+        if getattr(self, '_refresh_posted', False): return
+        if getattr(self, '_counts_checked', False): return
+        self._counts_checked = True
+        if self._counts_reconciled is None:
+            self.reconcile_counts()
+            return
+        if self._counts_reconciled >= now - timedelta(days=1):
+            return
+        # set just the field, as saving the Globals could undo a concurrent
+        # next_ticket_num
+        Globals.query.update(
+            dict(_id=self._id), {'$set': dict(_counts_reconciled=now)})
+        self.post_refresh_counts()
+
+    def invalidate_counts(self):
+        '''Have the ticket counters reconciled, after tickets were changed
+        in bulk or the meaning of their statuses changed'''
+        self.post_refresh_counts()
+
+    def post_refresh_counts(self):
+        '''Have the counts refreshed in the background, once per request'''
+        if getattr(self, '_refresh_posted', False): return
+        self._refresh_posted = True
+        from forgetracker import tasks
+        with h.push_context(self.app_config.project_id,
+                            app_config_id=self.app_config_id):
+            tasks.refresh_counts.post()
+
+    def reconcile_counts(self):
+        '''Recount the TicketCounters from the tickets themselves'''
+        Globals.query.update(
+            dict(_id=self._id),
+            {'$set': dict(_counts_reconciled=datetime.utcnow())})
+        totals = {}
+        # plain documents, so that 50k tickets don't end up in the session
+        docs = mapper(Ticket).collection.m.find(
+            dict(app_config_id=self.app_config_id),
+            dict(status=1, custom_fields=1, acl=1, deleted=1, _counted=1),
+            validate=False)
+        for doc in docs:
+            counted = counter_state(
+                self, doc.get('status', ''), doc.get('custom_fields') or {},
+                bool(doc.get('acl')), doc.get('deleted', False))
+            for name in counted['names']:
+                counts = totals.setdefault((name, counted['private']), [0, 0])
+                counts[0] += 1
+                if counted['closed']:
+                    counts[1] += 1
+            if doc.get('_counted') != counted:
+                # update just the field, without reindexing the ticket
+                Ticket.query.update(
+                    dict(_id=doc['_id']), {'$set': dict(_counted=counted)})
+        for (name, private), (hits, closed) in totals.iteritems():
+            TicketCounter.query.update(
+                dict(app_config_id=self.app_config_id,
+                     name=name, private=private),
+                {'$set': dict(hits=hits, closed=closed)},
+                upsert=True)
+        for counter in TicketCounter.query.find(dict(
+                app_config_id=self.app_config_id)):
+            if (counter.name, counter.private) not in totals:
+                counter.delete()
+
+    def stats(self):
+        '''Ticket and comment counts for the stats page, cached for stats_ttl
+        or until tickets or comments are added'''
+        now = datetime.utcnow()
+        doc = TrackerStatsDoc.m.get(_id=self.app_config_id)
+        if doc is None or doc.expire < now:
+            doc = TrackerStatsDoc(dict(
+                    _id=self.app_config_id,
+                    stats=tracker_stats(self, now),
+                    expire=now + self.stats_ttl))
+            doc.m.save()
+        return doc.stats
+
+    def invalidate_stats(self):
+        TrackerStatsDoc.m.remove(dict(_id=self.app_config_id))
+
     def invalidate_bin_counts(self):
         '''Expire it just a bit in the future to allow data to propagate through
         the search task
@@ -150,6 +292,51 @@ def sortable_custom_fields_shown_in_search(self):
                 if field.get('show_in_search')]
 
 
+class TicketCounter(MappedClass):
+    '''Number of tickets, and of closed tickets, in a tracker with a given
+    status ('status:<status>') or milestone ('<field name>:<milestone>'),
+    counted separately for private tickets.  Deleted tickets are not
+    counted.  Ticket.update_counts keeps them up to date and
+    Globals.reconcile_counts recounts them.'''
+
+    class __mongometa__:
+        name = 'ticket_counter'
+        session = project_orm_session
+        unique_indexes = [ ('app_config_id', 'name', 'private') ]
+
+    _id = FieldProperty(schema.ObjectId)
+    app_config_id = ForeignIdProperty('AppConfig')
+    name = FieldProperty(str)
+    private = FieldProperty(bool, if_missing=False)
+    hits = FieldProperty(int, if_missing=0)
+    closed = FieldProperty(int, if_missing=0)
+
+    @classmethod
+    def inc(cls, counted, n=1):
+        '''Add n to the counters of a ticket's counter_state'''
+        for name in counted['names']:
+            cls.query.update(
+                dict(app_config_id=counted['app_config_id'], name=name,
+                     private=counted['private']),
+                {'$inc': dict(hits=n, closed=n if counted['closed'] else 0)},
+                upsert=True)
+
+def counter_state(globals, status, custom_fields, private, deleted=False):
+    '''The TicketCounters a ticket with the given fields is counted in, in
+    the tracker of globals'''
+    names = []
+    if not deleted:
+        names.append('status:%s' % status)
+        for fld in globals.milestone_fields:
+            value = custom_fields.get(fld['name'])
+            if value:
+                names.append('%s:%s' % (fld['name'], value))
+    return dict(
+        app_config_id=globals.app_config_id,
+        names=names,
+        closed=status in globals.set_of_closed_status_names,
+        private=private)
+
 class TicketHistory(Snapshot):
 
     class __mongometa__:
@@ -236,6 +423,10 @@ class __mongometa__:
     milestone = FieldProperty(str, if_missing='')
     status = FieldProperty(str, if_missing='')
     custom_fields = FieldProperty({str:None})
+    # the counter_state last added to the TicketCounters
+    _counted = FieldProperty(dict(
+            app_config_id=schema.ObjectId, names=[str], closed=bool,
+            private=bool), if_missing=None)
 
     reported_by = RelationProperty(User, via='reported_by_id')
 
@@ -385,8 +576,49 @@ def _set_private(self, bool_flag):
             self.acl = []
     private = property(_get_private, _set_private)
 
+    def counter_state(self):
+        globals = self.globals
+        if globals.app_config_id != self.app_config_id:
+            # moved to another tracker
+            globals = Globals.query.get(app_config_id=self.app_config_id)
+        return counter_state(
+            globals, self.status, self.custom_fields, self.private,
+            self.deleted)
+
+    def counted_state(self):
+        if self._counted is None:
+            return None
+        return dict(app_config_id=self._counted.app_config_id,
+                    names=list(self._counted.names),
+                    closed=self._counted.closed,
+                    private=self._counted.private)
+
+    def update_counts(self):
+        '''Move the ticket to the TicketCounters for its current fields and
+        tracker, or out of them if it was deleted'''
+        old = self.counted_state()
+        new = self.counter_state()
+        if old == new:
+            return
+        if old is not None:
+            TicketCounter.inc(old, -1)
+        TicketCounter.inc(new, 1)
+        self._counted = new
+
+    def delete(self):
+        old = self.counted_state()
+        if old is not None:
+            TicketCounter.inc(old, -1)
+        super(Ticket, self).delete()
+
+    def update_stats(self):
+        '''Called when a comment is posted on the ticket'''
+        self.globals.invalidate_stats()
+
     def commit(self):
         VersionedArtifact.commit(self)
+        self.update_counts()
+        self.globals.invalidate_stats()
         monitoring_email = self.app.config.options.get('TicketMonitoringEmail')
         if self.version > 1:
             hist = TicketHistory.query.get(artifact_id=self._id, version=self.version-1)
@@ -510,15 +742,33 @@ def __json__(self):
             custom_fields=self.custom_fields)
 
     @classmethod
-    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, **kw):
+    def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None,
+                    after=None, **kw):
         """
         Query tickets, filtering for 'read' permission, sorting and paginating the result.
 
+        Instead of a page number, after can be the next_page token returned
+        with the previous page, which costs the same for any page where
+        skipping to a page number gets slower the further it is.  Raises
+        ValueError for an invalid token.
+
         See also paged_search which does a solr search
         """
         limit, page, start = g.handle_paging(limit, page, default=25)
-        q = cls.query.find(dict(query, app_config_id=app_config._id))
-        q = q.sort('ticket_num')
+        limit = int(limit)
+        mongo_query = dict(query, app_config_id=app_config._id)
+        globals = Globals.query.get(app_config_id=app_config._id)
+        if not globals.can_read_private(user):
+            # leave out the private tickets the user can't read, so that
+            # pages are full and the count is right
+            if user.is_anonymous():
+                readable = {'acl': []}
+            else:
+                readable = {'$or': [
+                        {'acl': []},
+                        {'reported_by_id': user._id}]}
+            mongo_query = utils.and_query(mongo_query, readable)
+        count = cls.query.find(mongo_query).count()
         if sort:
             field, direction = sort.split()
             if field.startswith('_'):
@@ -526,21 +776,25 @@ def paged_query(cls, app_config, user, query, limit=None, page=0, sort=None, **k
             direction = dict(
                 asc=pymongo.ASCENDING,
                 desc=pymongo.DESCENDING)[direction]
-            q = q.sort(field, direction)
-        q = q.skip(start)
-        q = q.limit(limit)
-        tickets = []
-        count = q.count()
-        for t in q:
-            if security.has_access(t, 'read', user, app_config.project):
-                tickets.append(t)
-            else:
-                count = count -1
+            sort_spec = [ (field, direction) ]
+        else:
+            sort_spec = [ ('ticket_num', pymongo.ASCENDING) ]
+        if after:
+            q = cls.query.find(utils.keyset_query(mongo_query, sort_spec, after))
+        else:
+            q = cls.query.find(mongo_query).skip(start)
+        q = q.sort(utils.keyset_sort(sort_spec)).limit(limit)
+        found = q.all()
+        readable = security.has_access_many(found, 'read', user, app_config.project)
+        tickets = [ t for t, allowed in zip(found, readable) if allowed ]
+        next_page = None
+        if len(found) == limit:
+            next_page = utils.keyset_token(found[-1], sort_spec)
 
         return dict(
             tickets=tickets,
             count=count, q=json.dumps(query), limit=limit, page=page, sort=sort,
-            **kw)
+            next_page=next_page, **kw)
 
     @classmethod
     def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, **kw):
@@ -592,13 +846,16 @@ def paged_search(cls, app_config, user, q, limit=None, page=0, sort=None, **kw):
             for t in query:
                 ticket_for_num[t.ticket_num] = t
             # and pull them out in the order given by ticket_numbers
+            found = [ticket_for_num[tn] for tn in ticket_numbers
+                      if tn in ticket_for_num]
+            readable = security.has_access_many(
+                found, 'read', user, app_config.project)
             tickets = []
-            for tn in ticket_numbers:
-                if tn in ticket_for_num:
-                    if security.has_access(ticket_for_num[tn], 'read', user, app_config.project):
-                        tickets.append(ticket_for_num[tn])
-                    else:
-                        count = count -1
+            for t, allowed in zip(found, readable):
+                if allowed:
+                    tickets.append(t)
+                else:
+                    count = count -1
         return dict(tickets=tickets,
                     count=count, q=q, limit=limit, page=page, sort=sort,
                     solr_error=solr_error, **kw)
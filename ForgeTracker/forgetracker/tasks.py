@@ -0,0 +1,17 @@
+import logging
+
+from pylons import c
+from allura.lib.decorators import task
+
+log = logging.getLogger(__name__)
+
+@task
+def refresh_counts():
+    '''Recount the tickets of the current tracker, and the hits of its
+    search bins'''
+    globals = c.app.globals
+    if globals is None:
+        log.error('Error looking up tracker globals for %s', c.app.config._id)
+        return
+    globals.reconcile_counts()
+    globals._refresh_counts()
@@ -1,7 +1,13 @@
-from forgetracker.model import Globals
+from datetime import datetime, timedelta
+
+from forgetracker.model import Globals, Ticket, TicketCounter
+from forgetracker.model.stats import tracker_stats_data
 from forgetracker.tests.unit import TrackerTestWithModel
 from pylons import c
 from allura.lib import helpers as h
+from allura import model as M
+from allura.lib.security import Credentials
+from allura.websetup import bootstrap
 
 from ming.orm.ormsession import ThreadLocalORMSession
 
@@ -28,6 +34,128 @@ def test_ticket_numbers_are_independent(self):
         assert Globals.next_ticket_num() == 1
 
 
+class TestTicketCounts(TrackerTestWithModel):
+    def new_ticket(self, num, status, milestone, private=False):
+        t = Ticket(ticket_num=num, summary='ticket %d' % num, status=status,
+                   custom_fields=dict(_milestone=milestone))
+        t.private = private
+        t.commit()
+        ThreadLocalORMSession.flush_all()
+        return t
+
+    def test_counts_follow_ticket_changes(self):
+        self.new_ticket(1, 'open', '1.0')
+        t = self.new_ticket(2, 'closed', '1.0')
+        assert c.app.globals.milestone_count('_milestone:1.0') == dict(
+            name='_milestone:1.0', hits=2, closed=1)
+        t.status = 'open'
+        t.custom_fields['_milestone'] = '2.0'
+        t.commit()
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.milestone_count('_milestone:1.0')['hits'] == 1
+        assert c.app.globals.milestone_count('_milestone:2.0') == dict(
+            name='_milestone:2.0', hits=1, closed=0)
+
+    def test_private_counts(self):
+        self.new_ticket(1, 'open', '1.0')
+        self.new_ticket(2, 'closed', '1.0', private=True)
+        assert c.app.globals.ticket_counts('_milestone:1.0')['hits'] == 2
+        observer = bootstrap.create_user('Random Non-Project User')
+        Credentials.get().clear()
+        assert c.app.globals.ticket_counts('_milestone:1.0', observer) == dict(
+            hits=1, closed=0)
+
+    def test_first_count_is_synchronous(self):
+        self.new_ticket(1, 'open', '1.0')
+        TicketCounter.query.remove({})
+        assert c.app.globals.milestone_count('_milestone:1.0')['hits'] == 1
+        ThreadLocalORMSession.flush_all()
+        assert not M.MonQTask.query.find(dict(
+                task_name='forgetracker.tasks.refresh_counts')).count()
+        ThreadLocalORMSession.close_all()
+        assert Globals.query.get(
+            app_config_id=c.app.config._id)._counts_reconciled
+
+    def test_deleted_tickets_are_not_counted(self):
+        self.new_ticket(1, 'open', '1.0')
+        t = self.new_ticket(2, 'open', '1.0')
+        t.deleted = True
+        t.commit()
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.milestone_count('_milestone:1.0')['hits'] == 1
+        t = Ticket.query.get(ticket_num=1)
+        t.delete()
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.milestone_count('_milestone:1.0')['hits'] == 0
+
+    def test_anonymous_counts(self):
+        t = self.new_ticket(1, 'open', '1.0', private=True)
+        t.reported_by_id = None
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.ticket_counts(
+            '_milestone:1.0', M.User.anonymous()) == dict(hits=0, closed=0)
+
+    def test_reconcile_counts(self):
+        c.app.globals._counts_reconciled = datetime.utcnow()
+        t = self.new_ticket(1, 'open', '1.0')
+        # a change the counters didn't see
+        t.status = 'closed'
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.milestone_count('_milestone:1.0')['closed'] == 0
+        c.app.globals.reconcile_counts()
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.milestone_count('_milestone:1.0')['closed'] == 1
+        assert not TicketCounter.query.find(dict(name='status:open')).count()
+
+
+class TestTrackerStats(TrackerTestWithModel):
+    def test_stats(self):
+        now = datetime.utcnow()
+        Ticket(ticket_num=1, summary='old', status='closed',
+               created_date=now - timedelta(days=20))
+        Ticket(ticket_num=2, summary='new', status='open', created_date=now)
+        ThreadLocalORMSession.flush_all()
+        stats = c.app.globals.stats()
+        assert stats['total'] == 2
+        assert stats['open'] == 1
+        assert stats['closed'] == 1
+        assert stats['week_tickets'] == 1
+        assert stats['fortnight_tickets'] == 1
+        assert stats['month_tickets'] == 2
+        assert stats['comments'] == 0
+        # cached until tickets change
+        Ticket(ticket_num=3, summary='newer', status='open', created_date=now)
+        ThreadLocalORMSession.flush_all()
+        assert c.app.globals.stats()['total'] == 2
+        c.app.globals.invalidate_stats()
+        assert c.app.globals.stats()['total'] == 3
+
+    def test_ticket_changes_leave_globals_alone(self):
+        globals_id = c.app.globals._id
+        t = Ticket(ticket_num=1, summary='t1', status='open')
+        t.commit()
+        # a next_ticket_num running at the same time
+        Globals.query.update(dict(_id=globals_id),
+                             {'$set': dict(last_ticket_num=42)})
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        assert Globals.query.get(_id=globals_id).last_ticket_num == 42
+
+    def test_stats_data(self):
+        Ticket(ticket_num=1, summary='t1', status='open',
+               created_date=datetime(2012, 1, 2, 10))
+        Ticket(ticket_num=2, summary='t2', status='closed',
+               created_date=datetime(2012, 1, 2, 11))
+        ThreadLocalORMSession.flush_all()
+        # flushing sets mod_date to now
+        Ticket.query.update(dict(ticket_num=2),
+                            {'$set': dict(mod_date=datetime(2012, 1, 3, 12))})
+        data = tracker_stats_data(
+            c.app.globals, datetime(2012, 1, 1), datetime(2012, 1, 3))['data']
+        assert [ n for ts, n in data['opened'] ] == [0, 2, 0]
+        assert [ n for ts, n in data['closed'] ] == [0, 0, 1]
+
+
 class TestCustomFields(TrackerTestWithModel):
     def test_it_has_sortable_custom_fields(self):
         tracker_globals = globals_with_custom_fields(
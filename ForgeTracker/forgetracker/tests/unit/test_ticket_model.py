@@ -109,3 +109,41 @@ def test_private_ticket(self):
         assert not has_access(t, 'update', user=creator)()
         assert has_access(t, 'read', user=observer)()
         assert has_access(t, 'read', user=anon)()
+
+    def test_paged_query_after(self):
+        from allura.websetup import bootstrap
+        for i in range(5):
+            Ticket(summary='ticket %d' % i, ticket_num=i + 1)
+        observer = bootstrap.create_user('Random Non-Project User')
+        t = Ticket(summary='private', ticket_num=6)
+        t.private = True
+        ThreadLocalORMSession.flush_all()
+        result = Ticket.paged_query(c.app.config, c.user, {}, limit=2,
+                                    sort='ticket_num desc')
+        assert [ t.ticket_num for t in result['tickets'] ] == [6, 5]
+        result = Ticket.paged_query(c.app.config, c.user, {}, limit=2,
+                                    sort='ticket_num desc',
+                                    after=result['next_page'])
+        assert [ t.ticket_num for t in result['tickets'] ] == [4, 3]
+        assert result['count'] == 6
+        # the private ticket is neither listed nor counted
+        result = Ticket.paged_query(c.app.config, observer, {}, limit=2,
+                                    sort='ticket_num desc')
+        assert [ t.ticket_num for t in result['tickets'] ] == [5, 4]
+        assert result['count'] == 5
+        assert_raises(ValueError, Ticket.paged_query, c.app.config, c.user,
+                      {}, after='garbage')
+
+    def test_paged_query_anonymous(self):
+        from allura.model import User
+        Ticket(summary='public', ticket_num=1)
+        t = Ticket(summary='private, filed anonymously', ticket_num=2)
+        t.private = True
+        t.reported_by_id = None
+        ThreadLocalORMSession.flush_all()
+        result = Ticket.paged_query(c.app.config, User.anonymous(), {})
+        assert [ t.ticket_num for t in result['tickets'] ] == [1]
+        assert result['count'] == 1
+        result = Ticket.paged_query(c.app.config, c.user, {})
+        assert [ t.ticket_num for t in result['tickets'] ] == [1, 2]
+        assert result['count'] == 2
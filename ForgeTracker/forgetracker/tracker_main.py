@@ -39,6 +39,7 @@
 
 # Local imports
 from forgetracker import model as TM
+from forgetracker.model.stats import tracker_stats_data
 from forgetracker import version
 
 from forgetracker.widgets.admin import OptionsAdmin
@@ -291,6 +292,7 @@ def uninstall(self, project):
         TM.TicketAttachment.query.remove(app_config_id)
         TM.Ticket.query.remove(app_config_id)
         TM.Bin.query.remove(app_config_id)
+        TM.TicketCounter.query.remove(app_config_id)
         TM.Globals.query.remove(app_config_id)
         super(ForgeTrackerApp, self).uninstall(project)
 
@@ -631,40 +633,14 @@ def update_tickets(self, **post_data):
                 setattr(ticket, k, v)
             for k, v in custom_values.iteritems():
                 ticket.custom_fields[k] = v
+            ticket.update_counts()
 
         ThreadLocalORMSession.flush_all()
 
-# tickets
-# open tickets
-# closed tickets
-# new tickets in the last 7/14/30 days
-# of comments on tickets
-# of new comments on tickets in 7/14/30
-# of ticket changes in the last 7/14/30
-
-    def tickets_since(self, when=None):
-        count = 0
-        if when:
-            count = TM.Ticket.query.find(dict(app_config_id=c.app.config._id,
-                created_date={'$gte':when})).count()
-        else:
-            count = TM.Ticket.query.find(dict(app_config_id=c.app.config._id)).count()
-        return count
-
-    def ticket_comments_since(self, when=None):
-        q = dict(
-            discussion_id=c.app.config.discussion_id)
-        if when is not None:
-            q['timestamp'] = {'$gte':when}
-        return M.Post.query.find(q).count()
-
     @with_trailing_slash
     @expose('jinja:forgetracker:templates/tracker/stats.html')
     def stats(self, dates=None, **kw):
         globals = c.app.globals
-        total = TM.Ticket.query.find(dict(app_config_id=c.app.config._id)).count()
-        open = TM.Ticket.query.find(dict(app_config_id=c.app.config._id,status={'$in': list(globals.set_of_open_status_names)})).count()
-        closed = TM.Ticket.query.find(dict(app_config_id=c.app.config._id,status={'$in': list(globals.set_of_closed_status_names)})).count()
         now = datetime.utcnow()
         week = timedelta(weeks=1)
         fortnight = timedelta(weeks=2)
@@ -672,51 +648,30 @@ def stats(self, dates=None, **kw):
         week_ago = now - week
         fortnight_ago = now - fortnight
         month_ago = now - month
-        week_tickets = self.tickets_since(week_ago)
-        fortnight_tickets = self.tickets_since(fortnight_ago)
-        month_tickets = self.tickets_since(month_ago)
-        comments=self.ticket_comments_since()
-        week_comments=self.ticket_comments_since(week_ago)
-        fortnight_comments=self.ticket_comments_since(fortnight_ago)
-        month_comments=self.ticket_comments_since(month_ago)
         c.user_select = ffw.ProjectUserSelect()
         if dates is None:
             today = datetime.utcnow()
             dates = "%s to %s" % ((today - timedelta(days=61)).strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d'))
-        if c.app.config.get_tool_data('sfx', 'group_artifact_id') and config.get('zarkov.webservice_host'):
-            show_stats = True
-        else:
-            show_stats = False
         return dict(
+                globals.stats(),
                 now=str(now),
                 week_ago=str(week_ago),
                 fortnight_ago=str(fortnight_ago),
                 month_ago=str(month_ago),
-                week_tickets=week_tickets,
-                fortnight_tickets=fortnight_tickets,
-                month_tickets=month_tickets,
-                comments=comments,
-                week_comments=week_comments,
-                fortnight_comments=fortnight_comments,
-                month_comments=month_comments,
-                total=total,
-                open=open,
-                closed=closed,
                 globals=globals,
-                dates=dates,
-                show_stats=show_stats)
+                dates=dates)
 
     @expose('json:')
     def stats_data(self, begin=None, end=None, **kw):
+        if begin is None and end is None:
+            end_time = datetime.utcnow()
+            begin_time = (end_time - timedelta(days=61))
+            end = end_time.strftime('%Y-%m-%d')
+            begin = begin_time.strftime('%Y-%m-%d')
+        else:
+            end_time = datetime.strptime(end,'%Y-%m-%d')
+            begin_time = datetime.strptime(begin,'%Y-%m-%d')
         if c.app.config.get_tool_data('sfx', 'group_artifact_id') and config.get('zarkov.webservice_host'):
-            if begin is None and end is None:
-                end_time = datetime.utcnow()
-                begin_time = (end_time - timedelta(days=61))
-                end = end_time.strftime('%Y-%m-%d')
-                begin = begin_time.strftime('%Y-%m-%d')
-            else:
-                end_time = datetime.strptime(end,'%Y-%m-%d')
-                begin_time = datetime.strptime(begin,'%Y-%m-%d')
             time_interval = 'date'
             if end_time - begin_time > timedelta(days=183):
                 time_interval = 'month'
@@ -725,7 +680,9 @@ def stats_data(self, begin=None, end=None, **kw):
             read_zarkov = json.load(urlopen(config.get('zarkov.webservice_host')+'/q', params))
             return zero_fill_zarkov_result(read_zarkov, time_interval, begin, end)
         else:
-            return dict()
+            begin_time = datetime(begin_time.year, begin_time.month, begin_time.day)
+            end_time = datetime(end_time.year, end_time.month, end_time.day)
+            return tracker_stats_data(c.app.globals, begin_time, end_time)
 
     @expose()
     @validate(W.subscribe_form)
@@ -1296,6 +1253,7 @@ def set_custom_fields(self, **post_data):
                                     milestone['name']
 
         self.app.globals.custom_fields=custom_fields
+        self.app.globals.invalidate_counts()
         flash('Fields updated')
         redirect(request.referer)
 
@@ -1308,9 +1266,13 @@ def _check_security(self):
         require_access(c.app, 'read')
 
     @expose('json:')
-    def index(self, limit=100, page=0, **kw):
-        results = TM.Ticket.paged_query(c.app.config, c.user, query={},
-                                        limit=int(limit), page=int(page))
+    def index(self, limit=100, page=0, after=None, **kw):
+        try:
+            results = TM.Ticket.paged_query(c.app.config, c.user, query={},
+                                            limit=int(limit), page=int(page),
+                                            after=after)
+        except ValueError, e:
+            raise exc.HTTPBadRequest(str(e))
         results['tickets'] = [dict(ticket_num=t.ticket_num, summary=t.summary)
                               for t in results['tickets']]
         results.pop('q', None)
@@ -1508,5 +1470,6 @@ def update_tickets(self, **post_data):
                 setattr(ticket, k, v)
             for k, v in custom_values.iteritems():
                 ticket.custom_fields[k] = v
+            ticket.update_counts()
 
         ThreadLocalORMSession.flush_all()
@@ -9,7 +9,7 @@
 from ming.orm import FieldProperty, ForeignIdProperty, Mapper, session
 from ming.orm.declarative import MappedClass
 
-from allura.model import VersionedArtifact, Snapshot, Feed, Thread, Post, User, BaseAttachment
+from allura.model import Artifact, VersionedArtifact, Snapshot, Feed, Thread, Post, User, BaseAttachment
 from allura.model import Notification, project_orm_session
 from allura.model.timeline import ActivityObject
 from allura.lib import helpers as h
@@ -73,6 +73,8 @@ class Page(VersionedArtifact, ActivityObject):
     class __mongometa__:
         name='page'
         history_class = PageHistory
+        indexes = Artifact.__mongometa__.indexes + [
+            ('app_config_id', 'last_edit.timestamp') ]
 
     title=FieldProperty(str)
     text=FieldProperty(schema.String, if_missing='')
@@ -53,6 +53,20 @@ def test_root_browse_pages(self):
         response = self.app.get('/wiki/browse_pages/')
         assert 'Browse Pages' in response
 
+    def test_browse_pages_recent(self):
+        for title in ('aaa', 'bbb'):
+            self.app.post('/wiki/%s/update' % title, params={
+                    'title':title,
+                    'text':'',
+                    'labels':'',
+                    'labels_old':'',
+                    'viewable_by-0.id':'all'})
+        response = self.app.get('/wiki/browse_pages/?sort=recent')
+        assert response.body.index('>bbb<') < response.body.index('>aaa<')
+        response = self.app.get('/wiki/browse_pages/?sort=recent&limit=1')
+        assert '>bbb<' in response
+        assert '>aaa<' not in response
+
     def test_root_new_page(self):
         response = self.app.get('/wiki/new_page?title=tést')
         assert 'tést' in response
@@ -16,10 +16,11 @@
 # Pyforge-specific imports
 from allura import model as M
 from allura.lib import helpers as h
+from allura.lib import utils
 from allura.app import Application, SitemapEntry, DefaultAdminController
 from allura.lib.search import search
 from allura.lib.decorators import require_post, Property
-from allura.lib.security import require_access, has_access
+from allura.lib.security import require_access, has_access, has_access_many
 from allura.controllers import AppDiscussionController, BaseController
 from allura.controllers import DispatchIndex
 from allura.controllers import attachments as ac
@@ -311,43 +312,50 @@ def search(self, q=None, history=None, project=None, limit=None, page=0, **kw):
     @validate(dict(sort=validators.UnicodeString(if_empty='alpha'),
                    show_deleted=validators.StringBool(if_empty=False),
                    page=validators.Int(if_empty=0),
-                   limit=validators.Int(if_empty=None)))
-    def browse_pages(self, sort='alpha', show_deleted=False, page=0, limit=None, **kw):
-        'list of all pages in the wiki'
+                   limit=validators.Int(if_empty=None),
+                   after=validators.UnicodeString(if_empty=None)))
+    def browse_pages(self, sort='alpha', show_deleted=False, page=0, limit=None,
+                     after=None, **kw):
+        """list of all pages in the wiki
+
+        Sorted by title, or by most recent edit, pages can also be fetched
+        after the next_page token of the previous one instead of by number."""
         c.page_list = W.page_list
         c.page_size = W.page_size
         limit, pagenum, start = g.handle_paging(limit, page, default=25)
         count = 0
         pages = []
-        uv_pages = []
         criteria = dict(app_config_id=c.app.config._id)
         can_delete = has_access(c.app, 'delete')()
         show_deleted = show_deleted and can_delete
         if not can_delete:
             criteria['deleted'] = False
-        q = WM.Page.query.find(criteria)
-        if sort == 'alpha':
-            q = q.sort('title')
-        count = q.count()
-        q = q.skip(start).limit(int(limit))
-        for page in q:
-            recent_edit = page.history().first()
-            p = dict(title=page.title, url=page.url(), deleted=page.deleted)
-            if recent_edit:
-                p['updated'] = recent_edit.timestamp
-                p['user_label'] = recent_edit.author.display_name
-                p['user_name'] = recent_edit.author.username
-                pages.append(p)
-            else:
-                if sort == 'recent':
-                    uv_pages.append(p)
-                else:
-                    pages.append(p)
+        count = WM.Page.query.find(criteria).count()
         if sort == 'recent':
-            pages.sort(reverse=True, key=lambda x:(x['updated']))
-            pages = pages + uv_pages
+            # pages never edited have no timestamp, and come last
+            sort_spec = [ ('last_edit.timestamp', -1) ]
+        else:
+            sort_spec = [ ('title', 1) ]
+        if after:
+            try:
+                q = WM.Page.query.find(utils.keyset_query(criteria, sort_spec, after))
+            except ValueError, e:
+                raise exc.HTTPBadRequest(str(e))
+        else:
+            q = WM.Page.query.find(criteria).skip(start)
+        found = q.sort(utils.keyset_sort(sort_spec)).limit(int(limit)).all()
+        next_page = None
+        if len(found) == int(limit):
+            next_page = utils.keyset_token(found[-1], sort_spec)
+        for page in found:
+            p = dict(title=page.title, url=page.url(), deleted=page.deleted)
+            if page.last_edit.timestamp:
+                p['updated'] = page.last_edit.timestamp
+                p['user_label'] = page.last_edit.author.display_name
+                p['user_name'] = page.last_edit.author.username
+            pages.append(p)
         return dict(pages=pages, can_delete=can_delete, show_deleted=show_deleted,
-                    limit=limit, count=count, page=pagenum)
+                    limit=limit, count=count, page=pagenum, next_page=next_page)
 
     @with_trailing_slash
     @expose('jinja:forgewiki:templates/wiki/browse_tags.html')
@@ -507,6 +515,7 @@ def edit(self):
     def delete(self):
         require_access(self.page, 'delete')
         M.Shortlink.query.remove(dict(ref_id=self.page.index_id()))
+        M.MarkdownCache.invalidate_links(c.project._id)
         self.page.deleted = True
         suffix = " {dt.hour}:{dt.minute}:{dt.second} {dt.day}-{dt.month}-{dt.year}".format(dt=datetime.utcnow())
         self.page.title += suffix
@@ -694,13 +703,27 @@ class WikiAttachmentsController(ac.AttachmentsController):
 class RootRestController(RestController):
 
     @expose('json:')
-    def get_all(self, **kw):
-        page_titles = []
-        pages = WM.Page.query.find(dict(app_config_id=c.app.config._id, deleted=False))
-        for page in pages:
-            if has_access(page, 'read')():
-                page_titles.append(page.title)
-        return dict(pages=page_titles)
+    def get_all(self, limit=None, after=None, **kw):
+        """Titles of the pages, all of them or, given a limit, a page of them
+        continued after the next_page token of the previous one"""
+        criteria = dict(app_config_id=c.app.config._id, deleted=False)
+        sort_spec = [ ('title', 1) ]
+        if after:
+            try:
+                criteria = utils.keyset_query(criteria, sort_spec, after)
+            except ValueError, e:
+                raise exc.HTTPBadRequest(str(e))
+        pages = WM.Page.query.find(criteria)
+        if limit is None:
+            return dict(pages=[ page.title for page in pages
+                                if has_access(page, 'read')() ])
+        pages = pages.sort(utils.keyset_sort(sort_spec)).limit(int(limit)).all()
+        page_titles = [ page.title for page, allowed in zip(
+                pages, has_access_many(pages, 'read')) if allowed ]
+        next_page = None
+        if len(pages) == int(limit):
+            next_page = utils.keyset_token(pages[-1], sort_spec)
+        return dict(pages=page_titles, next_page=next_page)
 
     @expose('json:')
     def get_one(self, title, **kw):
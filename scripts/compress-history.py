@@ -0,0 +1,101 @@
+'''
+compress-history - rewrite the snapshots of all versioned artifacts to keep a
+full keyframe every N versions, and deltas of it in between (see
+history.keyframe_interval), or with --interval 1 to store them all in full
+again
+
+    paster script production.ini ../scripts/compress-history.py -- --interval 20
+'''
+import argparse
+import logging
+import sys
+
+from pylons import c, g
+from ming.orm import Mapper, mapper
+
+from allura import model as M
+from allura.model.artifact import history_delta, apply_history_delta
+
+log = logging.getLogger(__name__)
+
+
+def compress(collection, interval):
+    '''Rewrite the snapshots in collection, returning the numbers of
+    keyframes and deltas'''
+    keyframes = deltas = 0
+    artifact_id = None
+    docs = []
+    cursor = collection.find({}, validate=False).sort(
+        [('artifact_id', 1), ('version', 1)])
+    for doc in cursor:
+        if doc['artifact_id'] != artifact_id:
+            k, d = rewrite(collection, docs, interval)
+            keyframes += k
+            deltas += d
+            artifact_id = doc['artifact_id']
+            docs = []
+        docs.append(doc)
+    k, d = rewrite(collection, docs, interval)
+    return keyframes + k, deltas + d
+
+
+def rewrite(collection, docs, interval):
+    '''Rewrite the snapshots docs of one artifact, in order of version'''
+    full_data = {} # of the current keyframes, by version
+    keyframe = None
+    updates = []
+    keyframes = deltas = 0
+    for doc in docs:
+        if doc.get('keyframe') is None:
+            data = full_data[doc['version']] = doc['data']
+        else:
+            data = apply_history_delta(full_data[doc['keyframe']], doc['data'])
+        delta = None
+        if interval > 1 and keyframe is not None \
+                and doc['version'] - keyframe[0] < interval:
+            delta = history_delta(keyframe[1], data)
+        if delta is None:
+            keyframe = (doc['version'], data)
+            keyframes += 1
+            if doc.get('keyframe') is not None:
+                updates.append((True, doc, {'data': data, 'keyframe': None}))
+        else:
+            deltas += 1
+            updates.append((False, doc, {'data': delta, 'keyframe': keyframe[0]}))
+    # Write the new keyframes first, then the deltas from the latest version
+    # down, so that a snapshot only becomes a delta once the later snapshots
+    # no longer need it as a keyframe
+    updates.sort(key=lambda u: (not u[0], -u[1]['version']))
+    for is_keyframe, doc, fields in updates:
+        collection.update_partial({'_id': doc['_id']}, {'$set': fields})
+    return keyframes, deltas
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    c.project = None
+    g.entry_points['tool'] # load the models of all the tools
+    done = set()
+    for m in Mapper.all_mappers():
+        cls = m.mapped_class
+        collection = mapper(cls).collection.m
+        if collection.collection_name is None: continue
+        if not issubclass(cls, M.Snapshot): continue
+        if collection.collection_name in done: continue
+        done.add(collection.collection_name)
+        log.info('Rewriting %s', collection.collection_name)
+        keyframes, deltas = compress(collection, options.interval)
+        log.info('... %d keyframes, %d deltas', keyframes, deltas)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Store artifact history '
+            'as keyframes and deltas.')
+    parser.add_argument('--interval', type=int, required=True, dest='interval',
+            help='Versions between keyframes (1 to store every version '
+            'in full).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))
@@ -0,0 +1,92 @@
+'''
+history-benchmark - compare the storage taken by the history of a wiki page,
+and the time to commit and read back versions of it, with every snapshot in
+full against keyframes every --interval versions and deltas in between
+
+    paster script production.ini ../scripts/history-benchmark.py -- \
+        --project test --edits 200 --size 200000 --interval 20
+'''
+import argparse
+import logging
+import random
+import sys
+import time
+
+import bson
+from pylons import c
+from tg import config
+from ming.orm import ThreadLocalORMSession, mapper
+
+from allura import model as M
+from allura.lib import helpers as h
+from forgewiki import model as WM
+
+log = logging.getLogger(__name__)
+
+LINE = u'Line %d of the page, with some text to make it about as long as a line of prose.\n'
+
+
+def run(label, interval, options):
+    config['history.keyframe_interval'] = str(interval)
+    page = WM.Page(title='history-benchmark %s' % label)
+    lines = [ LINE % i for i in xrange(options.size // len(LINE)) ]
+    begin = time.time()
+    for i in xrange(options.edits):
+        lines[random.randrange(len(lines))] = u'Edit %d\n' % i
+        page.text = u''.join(lines)
+        page.commit()
+        ThreadLocalORMSession.flush_all()
+    commit_time = (time.time() - begin) / options.edits
+    collection = mapper(WM.PageHistory).collection.m
+    size = sum(len(bson.BSON.encode(doc)) for doc in
+               collection.find(dict(artifact_id=page._id), validate=False))
+    begin = time.time()
+    for i in xrange(options.reads):
+        ThreadLocalORMSession.close_all()
+        page.get_version(random.randint(1, options.edits)).text
+    read_time = (time.time() - begin) / options.reads
+    log.info('%s: %.1f MB of history, %.1fms per commit, %.1fms per version read',
+             label, size / 1e6, commit_time * 1000, read_time * 1000)
+    WM.PageHistory.query.remove(dict(artifact_id=page._id))
+    WM.Page.query.remove(dict(_id=page._id))
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    h.set_context(options.project, options.mount_point,
+                  neighborhood=options.neighborhood)
+    c.user = M.User.by_username(options.user)
+    if c.user is None:
+        return 'Unknown user %s' % options.user
+    interval = config.get('history.keyframe_interval', '0')
+    try:
+        run('full', 0, options)
+        run('keyframe every %d' % options.interval, options.interval, options)
+    finally:
+        config['history.keyframe_interval'] = interval
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Measure wiki page history '
+            'storage and latency with and without deltas.')
+    parser.add_argument('--project', required=True, dest='project',
+            help='Project with a wiki to create the test pages in.')
+    parser.add_argument('--neighborhood', default='Projects', dest='neighborhood',
+            help='Neighborhood of the project (default Projects).')
+    parser.add_argument('--mount-point', default='wiki', dest='mount_point',
+            help='Mount point of the wiki (default wiki).')
+    parser.add_argument('--user', default='root', dest='user',
+            help='User to edit the pages as (default root).')
+    parser.add_argument('--edits', type=int, default=200, dest='edits',
+            help='Number of versions to commit (default 200).')
+    parser.add_argument('--size', type=int, default=200000, dest='size',
+            help='Size of the page text in bytes (default 200000).')
+    parser.add_argument('--interval', type=int, default=20, dest='interval',
+            help='Versions between keyframes (default 20).')
+    parser.add_argument('--reads', type=int, default=100, dest='reads',
+            help='Number of random versions to read back (default 100).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))
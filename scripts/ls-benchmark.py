@@ -0,0 +1,88 @@
+'''
+ls-benchmark - compare directory listing latency with and without the
+materialized DirLastCommitDoc
+
+    paster script production.ini ../scripts/ls-benchmark.py -- \
+        --project test --mount-point src-git --path /some/dir/ -n 20
+'''
+import argparse
+import logging
+import sys
+import time
+
+from pylons import c
+
+from allura import model as M
+from allura.lib import helpers as h
+
+log = logging.getLogger(__name__)
+
+
+def time_ls(tree, n):
+    times = []
+    for i in xrange(n):
+        begin = time.time()
+        tree.ls()
+        times.append(time.time() - begin)
+    return min(times), sum(times) / len(times)
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    nbhd = M.Neighborhood.query.get(url_prefix=options.nbhd)
+    if not nbhd:
+        return 'Invalid neighborhood url prefix.'
+    h.set_context(options.project, options.mount_point, neighborhood=nbhd)
+    repo = c.app.repo
+    ci = repo.commit(options.commit)
+    if ci is None:
+        return 'Unknown commit %s' % options.commit
+    tree = ci.tree
+    if options.path.strip('/'):
+        tree = tree.get_obj_by_path(options.path.strip('/'))
+    if not isinstance(tree, M.repo.Tree):
+        return 'Not a directory: %s' % options.path
+    entries = len(tree.tree_ids) + len(tree.blob_ids) + len(tree.other_ids)
+    lc_id = M.repo.dir_last_commit_id(repo._id, tree.path(), tree._id)
+    saved = M.repo.DirLastCommitDoc.m.get(_id=lc_id)
+
+    # before: per-entry LastCommitDoc lookups (ls() saves the doc again
+    # when it finds info for every entry, so remove it before each run)
+    times = []
+    for i in xrange(options.n):
+        M.repo.DirLastCommitDoc.m.remove(dict(_id=lc_id))
+        begin = time.time()
+        tree.ls()
+        times.append(time.time() - begin)
+    log.info('%d entries, per-entry lookup: min %.4fs, mean %.4fs',
+             entries, min(times), sum(times) / len(times))
+
+    if saved is not None:
+        saved.m.save()
+    elif M.repo.DirLastCommitDoc.m.get(_id=lc_id) is None:
+        log.info('No last commit info for every entry; nothing to compare')
+        return
+    best, mean = time_ls(tree, options.n)
+    log.info('%d entries, materialized: min %.4fs, mean %.4fs',
+             entries, best, mean)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Time Tree.ls() for a '
+            'repository directory with and without DirLastCommitDoc.')
+    parser.add_argument('--nbhd', default='/p/', dest='nbhd',
+            help='Neighborhood url prefix (default /p/).')
+    parser.add_argument('--project', required=True, dest='project')
+    parser.add_argument('--mount-point', required=True, dest='mount_point',
+            help='Mount point of the repository tool.')
+    parser.add_argument('--commit', default='HEAD', dest='commit',
+            help='Commit (or branch) to list (default HEAD).')
+    parser.add_argument('--path', default='/', dest='path',
+            help='Directory to list (default /).')
+    parser.add_argument('-n', type=int, default=10, dest='n',
+            help='Number of listings to time (default 10).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))
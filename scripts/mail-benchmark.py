@@ -0,0 +1,79 @@
+'''
+mail-benchmark - time sending one email to many recipients through the
+mail_tasks.sendmail task, into a local maildir sink (see smtp_sink) rather
+than a mail server, with one recipient per SMTP transaction against
+--max-recipients of them
+
+    paster script production.ini ../scripts/mail-benchmark.py -- \
+        --recipients 20000 --max-recipients 100
+'''
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tg import config
+
+from allura.lib import helpers as h
+from allura.model.notification import MAX_DESTINATIONS
+from allura.tasks import mail_tasks
+
+log = logging.getLogger(__name__)
+
+
+def run(label, max_recipients, options):
+    path = tempfile.mkdtemp()
+    config['smtp_sink'] = path
+    config['smtp_max_recipients'] = str(max_recipients)
+    mail_tasks.smtp_client._pool = None
+    destinations = [ 'user%d@example.com' % i for i in xrange(options.recipients) ]
+    try:
+        begin = time.time()
+        for i in xrange(0, len(destinations), MAX_DESTINATIONS):
+            mail_tasks.sendmail(
+                fromaddr=u'noreply@example.com',
+                destinations=destinations[i:i + MAX_DESTINATIONS],
+                text=u'This is a test\n' * 50,
+                reply_to=u'noreply@example.com',
+                subject=u'mail-benchmark %s' % label,
+                message_id=h.gen_message_id())
+        elapsed = time.time() - begin
+        messages = len(os.listdir(os.path.join(path, 'new')))
+        log.info('%s: %d messages in %.2fs, %.0f recipients/s',
+                 label, messages, elapsed, options.recipients / elapsed)
+    finally:
+        mail_tasks.smtp_client._pool = None
+        shutil.rmtree(path)
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    saved = dict((k, config.get(k)) for k in ('smtp_sink', 'smtp_max_recipients'))
+    try:
+        run('1 recipient per transaction', 1, options)
+        run('%d recipients per transaction' % options.max_recipients,
+            options.max_recipients, options)
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                config.pop(k, None)
+            else:
+                config[k] = v
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Measure the throughput '
+            'of sending mail, with and without batching recipients.')
+    parser.add_argument('--recipients', type=int, default=20000, dest='recipients',
+            help='Number of recipients to send to (default 20000).')
+    parser.add_argument('--max-recipients', type=int, default=100,
+            dest='max_recipients',
+            help='Recipients per SMTP transaction when batching (default 100).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))
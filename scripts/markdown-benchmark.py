@@ -0,0 +1,87 @@
+'''
+markdown-benchmark - compare converting markdown with a freshly built engine
+per document against the cached engines handed out by g.markdown
+
+    paster script production.ini ../scripts/markdown-benchmark.py -- -n 200
+'''
+import argparse
+import logging
+import sys
+import time
+
+from pylons import g
+
+from allura.lib import helpers as h
+from allura.lib.app_globals import ForgeMarkdown
+from allura.lib.markdown_extensions import ForgeExtension
+
+log = logging.getLogger(__name__)
+
+SMALL = u'''Thanks, that fixed it.  See [#1] and http://example.com/ for *details*.'''
+
+LARGE_SECTION = u'''
+## Section %d
+
+Some **bold** and _italic_ text with a [link](http://example.com/%d) and a
+reference to [#%d].
+
+* item one
+* item two
+
+    :::python
+    def f(x):
+        return x * %d
+
+| a | b |
+|---|---|
+| 1 | 2 |
+'''
+
+
+def fresh_engine():
+    return ForgeMarkdown(
+        extensions=['codehilite', ForgeExtension(), 'tables', 'toc'],
+        output_format='html4')
+
+
+def cached_engine():
+    return g.markdown
+
+
+def time_convert(get_engine, text, n):
+    begin = time.time()
+    for i in xrange(n):
+        get_engine().convert(text)
+    return (time.time() - begin) / n
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    h.set_context(options.project, neighborhood=options.nbhd)
+    large = u''.join(LARGE_SECTION % ((i,) * 4) for i in xrange(options.sections))
+    for name, text in (('small', SMALL), ('large', large)):
+        # warm up caches (pygments lexers, shortlinks, ...)
+        cached_engine().convert(text)
+        fresh = time_convert(fresh_engine, text, options.n)
+        cached = time_convert(cached_engine, text, options.n)
+        log.info('%s document (%d chars): fresh engine %.2fms, cached engine '
+                 '%.2fms per conversion', name, len(text),
+                 fresh * 1000, cached * 1000)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Time markdown conversion '
+            'with fresh and cached ForgeMarkdown engines.')
+    parser.add_argument('--nbhd', default='Projects', dest='nbhd',
+            help='Neighborhood name (default Projects).')
+    parser.add_argument('--project', default='test', dest='project',
+            help='Project to resolve shortlinks in (default test).')
+    parser.add_argument('--sections', type=int, default=50, dest='sections',
+            help='Number of sections in the large document (default 50).')
+    parser.add_argument('-n', type=int, default=100, dest='n',
+            help='Number of conversions per measurement (default 100).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))
@@ -0,0 +1,37 @@
+import logging
+
+from pylons import c, g
+
+from ming.orm import Mapper, ThreadLocalORMSession
+
+from allura import model as M
+
+log = logging.getLogger(__name__)
+
+def main():
+    c.project = None
+    g.entry_points['tool'] # load the models of all the tools
+    for m in Mapper.all_mappers():
+        cls = m.mapped_class
+        if m.collection.m.collection_name is None: continue
+        if not issubclass(cls, M.VersionedArtifact): continue
+        log.info('Setting last_edit of %s', cls)
+        count = 0
+        query = {'last_edit.timestamp': None}
+        while True:
+            objs = cls.query.find(query).sort('_id').limit(1000).all()
+            if not objs: break
+            for obj in objs:
+                ss = obj.history().first()
+                if ss is not None:
+                    # no flush, which would change mod_date
+                    cls.query.update(
+                        {'_id': obj._id},
+                        {'$set': {'last_edit': cls.last_edit_of(ss)}})
+                    count += 1
+            query['_id'] = {'$gt': objs[-1]._id}
+            ThreadLocalORMSession.close_all()
+        log.info('... updated %d', count)
+
+if __name__ == '__main__':
+    main()
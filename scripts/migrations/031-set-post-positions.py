@@ -0,0 +1,29 @@
+import logging
+
+from pylons import c, g
+
+from ming.orm import Mapper, ThreadLocalORMSession
+
+from allura import model as M
+from allura.lib import utils
+
+log = logging.getLogger(__name__)
+
+def main():
+    '''Number the posts of every thread.  Running it again repairs any
+    duplicate positions left by concurrent posting (see
+    Thread.update_positions).'''
+    c.project = None
+    g.entry_points['tool'] # load the models of all the tools
+    for m in Mapper.all_mappers():
+        cls = m.mapped_class
+        if m.collection.m.collection_name is None: continue
+        if not issubclass(cls, M.Thread): continue
+        log.info('Numbering the posts of %s', cls)
+        for threads in utils.chunked_find(cls):
+            for thread in threads:
+                thread.update_positions()
+            ThreadLocalORMSession.close_all()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+import logging
+
+from allura import model as M
+
+log = logging.getLogger(__name__)
+
+def main():
+    log.info('Building the project directory')
+    count = M.ProjectDirectory.rebuild()
+    log.info('... %d projects listed', count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+'''
+monq-latency - measure how long posted tasks wait before a taskd starts them
+
+Posts no-op event tasks one at a time, waits for each to be picked up by a
+running taskd and reports the time between time_queue and time_start.  Run it
+against a live taskd, e.g. once with monq.wakeup unset and once with
+monq.wakeup = tail:
+
+    paster script production.ini ../scripts/monq-latency.py -- -n 20
+'''
+import argparse
+import logging
+import sys
+import time
+
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.tasks import event_tasks
+
+log = logging.getLogger(__name__)
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    latencies = []
+    for i in xrange(options.num_tasks):
+        task = event_tasks.event.post('monq-latency')
+        ThreadLocalORMSession.flush_all()
+        task.join(poll_interval=0.01)
+        latency = (task.time_start - task.time_queue).total_seconds()
+        latencies.append(latency)
+        log.info('task %s started after %.3fs', task._id, latency)
+        ThreadLocalORMSession.close_all()
+        time.sleep(options.pause)
+    latencies.sort()
+    log.info('post-to-start latency over %d tasks: min %.3fs, median %.3fs, '
+             'mean %.3fs, max %.3fs', len(latencies), latencies[0],
+             latencies[len(latencies) // 2],
+             sum(latencies) / len(latencies), latencies[-1])
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Measure post-to-start '
+            'latency of MonQ tasks against a running taskd.')
+    parser.add_argument('-n', '--num-tasks', type=int, default=10,
+            dest='num_tasks', help='Number of tasks to post (default 10).')
+    parser.add_argument('--pause', type=float, default=1.0, dest='pause',
+            help='Seconds to idle between tasks, so that workers go back to '
+            'waiting (default 1).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))
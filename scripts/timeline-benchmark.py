@@ -0,0 +1,86 @@
+'''
+timeline-benchmark - compare filtering an activity stream timeline one
+activity at a time (perm_check) against the batched filter_timeline
+
+    paster script production.ini ../scripts/timeline-benchmark.py -- \
+        --followee someuser --viewer otheruser --limit 2000
+'''
+import argparse
+import logging
+import sys
+import time
+
+import pymongo
+from pylons import c, g
+from ming.orm import ThreadLocalORMSession
+
+from allura import model as M
+from allura.model.timeline import perm_check, filter_timeline
+
+log = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    '''Count pymongo finds, by wrapping Collection.find'''
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        self._find = pymongo.collection.Collection.find
+        counter = self
+        def find(self, *args, **kwargs):
+            counter.count += 1
+            return counter._find(self, *args, **kwargs)
+        pymongo.collection.Collection.find = find
+        return self
+
+    def __exit__(self, *exc_info):
+        pymongo.collection.Collection.find = self._find
+
+
+def run(label, func, timeline):
+    ThreadLocalORMSession.close_all()
+    M.main_orm_session.clear()
+    import allura
+    allura.credentials.clear()
+    with QueryCounter() as queries:
+        begin = time.time()
+        visible = func(timeline)
+        elapsed = time.time() - begin
+    log.info('%s: %d of %d activities visible, %.3fs, %d queries',
+             label, len(visible), len(timeline), elapsed, queries.count)
+
+
+def main(options):
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    log.setLevel(logging.INFO)
+    followee = M.User.by_username(options.followee)
+    if followee is None:
+        return 'Unknown user %s' % options.followee
+    if options.viewer:
+        viewer = M.User.by_username(options.viewer)
+        if viewer is None:
+            return 'Unknown user %s' % options.viewer
+    else:
+        viewer = M.User.anonymous()
+    c.user = viewer
+    timeline = list(g.director.get_timeline(followee, page=0,
+            limit=options.limit, actor_only=True))
+    run('perm_check', lambda t: filter(perm_check(viewer), t), timeline)
+    run('filter_timeline', lambda t: filter_timeline(t, viewer), timeline)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Time permission '
+            'filtering of a user\'s activity timeline.')
+    parser.add_argument('--followee', required=True, dest='followee',
+            help='User whose activities to filter.')
+    parser.add_argument('--viewer', default=None, dest='viewer',
+            help='User viewing the timeline (default anonymous).')
+    parser.add_argument('--limit', type=int, default=1000, dest='limit',
+            help='Number of activities to filter (default 1000).')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    sys.exit(main(parse_options()))